@@ -67,6 +67,124 @@ class ActionData(MqttData):
         }
 
 
+class ActionDataBatcher:
+    """Items published on the same (topic, action, qos) share one ActionData message
+
+    A batch is published once it holds BATCH_MAX_ITEMS items, or BATCH_MAX_DELAY_MS after
+    the first batch of a window was started. Publishing is left to the flusher task, a
+    batch that failed to publish is put back and retried after BATCH_RETRY_DELAY_MS.
+    """
+
+    BATCH_MAX_ITEMS = 50
+    BATCH_MAX_DELAY_MS = 200
+    BATCH_RETRY_DELAY_MS = 1000
+    # 发送失败时每个批次最多保留的数量，超出丢弃最旧的
+    BATCH_RETRY_MAX_ITEMS = 500
+
+    def __init__(
+        self,
+        meta_mgr: MetaConfigManager,
+        mqtt: MqttModule,
+    ):
+        self.log = get_logger(self.__class__.__name__)
+
+        self.meta_mgr = meta_mgr
+        self.mqtt = mqtt
+
+        # {(topic, action, qos): [timestamp, items]}
+        self._batches: Dict[tuple, list] = {}
+        self._event = asyncio.Event()
+        # 有批次已满，不用等到BATCH_MAX_DELAY_MS
+        self._full = asyncio.Event()
+
+    async def add(self, topic: str, action: str, qos: int, item: MqttData):
+        key = (topic, action, qos)
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = [int(time.time() * 1000), []]
+            self._batches[key] = batch
+            self._event.set()
+
+        batch[1].append(item)
+        if len(batch[1]) >= self.BATCH_MAX_ITEMS:
+            self._full.set()
+
+    def _requeue(self, key: tuple, timestamp: int, items: list):
+        """Put the items of a failed publish back, before the ones added meanwhile"""
+        batch = self._batches.get(key)
+        if batch is not None:
+            items = items + batch[1]
+
+        dropped = len(items) - self.BATCH_RETRY_MAX_ITEMS
+        if dropped > 0:
+            items = items[dropped:]
+            self.log.error(f"batch requeue full, drop: {key[0]} {key[1]} {dropped}")
+
+        self._batches[key] = [timestamp, items]
+        self._event.set()
+        if len(items) >= self.BATCH_MAX_ITEMS:
+            self._full.set()
+
+    async def _flush_batch(self, key: tuple) -> bool:
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            return True
+
+        topic, action, qos = key
+        timestamp, items = batch
+        # 发送期间积累的数据可能超过BATCH_MAX_ITEMS，分多条消息发送
+        for i in range(0, len(items), self.BATCH_MAX_ITEMS):
+            message = ActionData(
+                id="",
+                action=action,
+                timestamp=timestamp,
+                gateway=self.meta_mgr.config.gateway_mac,
+                data=items[i : i + self.BATCH_MAX_ITEMS],
+            )
+
+            try:
+                await self.mqtt.pub(topic, message, qos=qos)
+            except Exception as e:
+                self.log.error(
+                    f"pub batch failed: {topic} {action} {len(items) - i} {e}"
+                )
+                self._requeue(key, timestamp, items[i:])
+                return False
+
+        return True
+
+    async def flush(self) -> bool:
+        """Publish all batches, False if any was put back"""
+        ok = True
+        for key in list(self._batches.keys()):
+            ok = await self._flush_batch(key) and ok
+        return ok
+
+    async def _wait_full(self):
+        try:
+            await asyncio.wait_for_ms(self._full.wait(), self.BATCH_MAX_DELAY_MS)
+        except asyncio.TimeoutError:
+            pass
+        self._full.clear()
+
+    async def _flusher(self):
+        try:
+            while True:
+                await self._event.wait()
+                self._event.clear()
+                await self._wait_full()
+                if not await self.flush():
+                    await asyncio.sleep_ms(self.BATCH_RETRY_DELAY_MS)
+        finally:
+            # 退出前发送未满的批次
+            await self.flush()
+
+    def co_tasks(self) -> list[asyncio.Task]:
+        return [
+            asyncio.create_task(self._flusher()),
+        ]
+
+
 class MessageDispatcher:
     def __init__(
         self,
@@ -84,16 +202,21 @@ class MessageDispatcher:
         self.profile_mgr = profile_mgr
         self.meta_mgr = meta_mgr
 
+        self.batcher = ActionDataBatcher(meta_mgr=meta_mgr, mqtt=mqtt)
+
     async def scan_data_handler(self, scan_data: Dict[str, Any]) -> None:
         self.log.debug("scan data handler", json.dumps(scan_data))
 
-        message = ActionData(
-            id="",
-            action="",
-            timestamp=int(time.time() * 1000),
-            gateway=self.meta_mgr.config.gateway_mac,
-            data=None,
-        )
+        forward_raw = self.meta_mgr.config.forward_raw_scan == FORWORD_RAW_SCAN_ON
+        matched_model = self.profile_mgr.match_indexed(scan_data)
+
+        # Most adverts match no model, skip building objects for them
+        if (
+            matched_model is None
+            and not forward_raw
+            and not self.profile_mgr.fallback_models
+        ):
+            return
 
         scan_data_obj = ScanData(
             device_mac=scan_data["bdaddr"],
@@ -113,16 +236,13 @@ class MessageDispatcher:
             sid=scan_data.get("sid"),
         )
 
-        if self.meta_mgr.config.forward_raw_scan == FORWORD_RAW_SCAN_ON:
-            message.action = "scan_data"
-            message.data = [scan_data_obj]
-            await self.mqtt.pub(self.meta_mgr.topics.scan, message, qos=0)
-
-        matched_model = None
+        if forward_raw:
+            await self.batcher.add(
+                self.meta_mgr.topics.scan, "scan_data", 0, scan_data_obj
+            )
 
-        for _, v in self.profile_mgr.get_models().items():
-            if v.is_model(scan_data_obj):
-                matched_model = v
+        if matched_model is None:
+            matched_model = self.profile_mgr.match_fallback(scan_data_obj)
 
         if matched_model is None or matched_model.scan_handler is None:
             return
@@ -131,7 +251,6 @@ class MessageDispatcher:
         if payload is None:
             return
 
-        message.action = "scan_data_decoded"
         scan_data_decoded = ScanDataParsed(
             device_mac=scan_data["bdaddr"],
             model=matched_model.get_name(),
@@ -140,9 +259,10 @@ class MessageDispatcher:
             rssi=scan_data["rssi"],
             payload=payload,
         )
-        message.data = [scan_data_decoded]
 
-        await self.mqtt.pub(self.meta_mgr.topics.scan, message, qos=0)
+        await self.batcher.add(
+            self.meta_mgr.topics.scan, "scan_data_decoded", 0, scan_data_decoded
+        )
 
     async def notify_data_handler(self, notify: Dict[str, Any]) -> None:
         self.log.debug("notify data:", notify)
@@ -154,16 +274,10 @@ class MessageDispatcher:
         )
 
         if self.meta_mgr.config.forward_raw_notify == FORWORD_RAW_NOTIFY_ON:
-            message = ActionData(
-                id="",
-                action="notification",
-                timestamp=int(time.time() * 1000),
-                gateway=self.meta_mgr.config.gateway_mac,
-                data=[notify_data],
+            await self.batcher.add(
+                self.meta_mgr.topics.notify, "notification", 1, notify_data
             )
 
-            await self.mqtt.pub(self.meta_mgr.topics.notify, message, qos=1)
-
         device_mac = notify["id"]
         current_task = await self.task_mgr.get_current_task(device_mac)
         if current_task is None:
@@ -187,16 +301,10 @@ class MessageDispatcher:
             reason=data.get("reason"),
         )
 
-        message = ActionData(
-            id="",
-            action="connection_state",
-            timestamp=int(time.time() * 1000),
-            gateway=self.meta_mgr.config.gateway_mac,
-            data=[state_data],
+        await self.batcher.add(
+            self.meta_mgr.topics.state, "connection_state", 1, state_data
         )
 
-        await self.mqtt.pub(self.meta_mgr.topics.state, message, qos=1)
-
         if state_data.connection_state != "disconnected":
             return
 
@@ -269,3 +377,6 @@ class MessageDispatcher:
         except Exception as e:
             self.log.info(f"execute error: {e}")
             # todo返回响应
+
+    def co_tasks(self) -> list[asyncio.Task]:
+        return self.batcher.co_tasks()
@@ -66,6 +66,9 @@ class CassiaDevice(Model):
     def is_model(self, scan_data: ScanData):
         return scan_data.name.startswith(CassiaDevice.ADV_FLAG)
 
+    def get_scan_filters(self):
+        return {"name_prefix": [CassiaDevice.ADV_FLAG]}
+
     async def sleep_more(self):
         """这里需要根据一次处理notification耗时情况，主动让出，方便其他命令响应处理，否则可能响应时间会较长"""
         await asyncio.sleep_ms(1000)
@@ -1,3 +1,5 @@
+import os
+import time
 import asyncio
 import json
 import cassiablue
@@ -172,12 +174,41 @@ class DeviceInfo:
         self,
         name: str,
         addr_type: str,
+        last_success_ts: int = 0,
+        gatt: Any = None,
     ):
         self.name = name
         self.addr_type = addr_type
+        self.last_success_ts = last_success_ts
+        self.gatt = gatt
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "addr_type": self.addr_type,
+            "last_success_ts": self.last_success_ts,
+            "gatt": self.gatt,
+        }
+
+    @staticmethod
+    def from_dict(data: dict):
+        return DeviceInfo(
+            name=data.get("name", "(unknown)"),
+            addr_type=data.get("addr_type"),
+            last_success_ts=data.get("last_success_ts", 0),
+            gatt=data.get("gatt"),
+        )
 
 
 class CassiaBlueManager:
+    """Device info learned by successful connections (address type, GATT) is saved
+    to DEVICE_INFO_FILE, reconnects within the TTL reuse it and skip the GATT discovery"""
+
+    DEVICE_INFO_FILE = "device_info.json"
+    DEVICE_INFO_TTL_MS = 7 * 24 * 3600 * 1000
+    DEVICE_INFO_SAVE_INTERVAL_MS = 60000
+    # Flash/RAM budget: only the most recently connected devices are kept in the file
+    DEVICE_INFO_SAVE_MAX = 1000
 
     def __init__(
         self,
@@ -190,8 +221,70 @@ class CassiaBlueManager:
         self.stater = None
 
         self.device_info: Dict[str, DeviceInfo] = {}
+        self._device_info_dirty = False
+        # 每个芯片同时只发起一个连接，避免GatewayChipIsBusy: {chip: Lock}
+        self._connect_locks: Dict[str, asyncio.Lock] = {}
         self.meta_mgr = meta_mgr
 
+        self._load_device_info()
+
+    def _load_device_info(self):
+        try:
+            with open(self.DEVICE_INFO_FILE, "r") as f:
+                data = json.load(f)
+        except OSError:
+            return
+        except ValueError as e:
+            self.log.warn(f"load device info failed: {e}")
+            return
+
+        for mac, info in data.items():
+            self.device_info[mac] = DeviceInfo.from_dict(info)
+        self.log.info(f"load device info ok: {len(self.device_info)}")
+
+    def _save_device_info(self):
+        infos = [
+            (info.last_success_ts, mac, info)
+            for mac, info in self.device_info.items()
+            if info.last_success_ts
+        ]
+        infos.sort(reverse=True)
+        infos = infos[: self.DEVICE_INFO_SAVE_MAX]
+        data = {mac: info.to_dict() for _, mac, info in infos}
+
+        tmp_file = self.DEVICE_INFO_FILE + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(data, f)
+        os.rename(tmp_file, self.DEVICE_INFO_FILE)
+
+        self._device_info_dirty = False
+        self.log.info(f"save device info ok: {len(data)}")
+
+    def _device_info_valid(self, info: DeviceInfo) -> bool:
+        """Learned by a successful connection within DEVICE_INFO_TTL_MS"""
+        if not info.last_success_ts:
+            return False
+        age = int(time.time() * 1000) - info.last_success_ts
+        return age < self.DEVICE_INFO_TTL_MS
+
+    def _on_connected(self, mac: str, params: Dict):
+        info = self.device_info.get(mac)
+        if info is None:
+            info = DeviceInfo(name="(unknown)", addr_type=None)
+            self.device_info[mac] = info
+
+        info.addr_type = params.get("type") or info.addr_type
+        self._device_info_dirty = True
+
+    def on_task_success(self, mac: str):
+        """The task of a device succeeded, trust what its connection learned"""
+        info = self.device_info.get(mac)
+        if info is None:
+            return
+
+        info.last_success_ts = int(time.time() * 1000)
+        self._device_info_dirty = True
+
     async def _print_ret_raw(
         self, ok, prefix=None, mac=None, ret=None, ignore_ex=False
     ):
@@ -210,40 +303,72 @@ class CassiaBlueManager:
 
     async def connect(self, mac: str, params: Dict = None):
         if params is None:
+            params = {}
             info = self.device_info.get(mac)
-            if info is not None:
-                params = {"type": info.addr_type}
-            else:
-                params = {}
+            if info is not None and info.addr_type:
+                params["type"] = info.addr_type
 
+        if self.meta_mgr.config.conn_chip:
+            params["chip"] = self.meta_mgr.config.conn_chip
         params["timeout"] = self.meta_mgr.config.conn_timeout
         params["fail_retry_times"] = self.meta_mgr.config.conn_fail_retry_times
 
-        params = json.dumps(params)
-        self.log.info(f"[{mac}] connect start: {params}")
+        params_json = json.dumps(params)
 
-        ok, ret = await cassiablue.connect(mac, params)
+        # No chip set: the gateway picks one, all connects share one gate
+        chip = params.get("chip", "")
+        lock = self._connect_locks.get(chip)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._connect_locks[chip] = lock
+
+        async with lock:
+            self.log.info(f"[{mac}] connect start: {params_json}")
+            ok, ret = await cassiablue.connect(mac, params_json)
         await self._print_ret_raw(ok=ok, prefix="connect done", mac=mac, ret=ret)
+        self._on_connected(mac, params)
 
     async def write_handle(self, mac, handle, value):
         self.log.info(f"[{mac}] write handle start: {handle} {value}")
         ok, ret = await cassiablue.gatt_write(mac, handle, value)
+        if not ok:
+            self.invalidate_gatt(mac)
         await self._print_ret_raw(ok=ok, prefix="write handle done", mac=mac, ret=ret)
 
     async def read_handle(self, mac, handle):
         self.log.info(f"[{mac}] read handle start: {handle}")
         ok, ret = await cassiablue.gatt_read(mac, handle)
+        if not ok:
+            self.invalidate_gatt(mac)
         return await self._print_ret_json(
             ok=ok, ret=ret, prefix="read handle done", mac=mac
         )
 
+    def invalidate_gatt(self, mac: str):
+        """GATT access failed, the cached layout may be stale: discover again next time"""
+        info = self.device_info.get(mac)
+        if info is not None and info.gatt is not None:
+            info.gatt = None
+            self._device_info_dirty = True
+            self.log.info(f"[{mac}] gatt cache invalidated")
+
     async def discover_gatt_all(self, mac):
+        info = self.device_info.get(mac)
+        if info is not None and info.gatt and self._device_info_valid(info):
+            self.log.info(f"[{mac}] discover gatt all cached")
+            return info.gatt
+
         self.log.info(f"[{mac}] discover gatt all start")
-        ok, ret = await cassiablue.gatt_read(mac)
-        return await self._print_ret_json(
+        ok, ret = await cassiablue.gatt_discover(mac)
+        gatt = await self._print_ret_json(
             ok=ok, ret=ret, prefix="discover gatt all done", mac=mac
         )
 
+        if info is not None:
+            info.gatt = gatt
+            self._device_info_dirty = True
+        return gatt
+
     async def get_connected(self):
         self.log.info(f"get connected start")
         ok, ret = await cassiablue.get_connected_devices()
@@ -295,6 +420,17 @@ class CassiaBlueManager:
         async for state in cassiablue.connection_result():
             await self.stater(state)
 
+    async def co_device_info_saver(self) -> None:
+        self.log.info(f"co device info saver start")
+        while True:
+            await asyncio.sleep_ms(self.DEVICE_INFO_SAVE_INTERVAL_MS)
+            if not self._device_info_dirty:
+                continue
+            try:
+                self._save_device_info()
+            except Exception as e:
+                self.log.error(f"save device info failed: {e}")
+
     def set_handler(self, scanner, notifier, stater):
         self.scanner = scanner
         self.notifier = notifier
@@ -305,4 +441,5 @@ class CassiaBlueManager:
             asyncio.create_task(self.co_scanner()),
             asyncio.create_task(self.co_notifier()),
             asyncio.create_task(self.co_stater()),
+            asyncio.create_task(self.co_device_info_saver()),
         ]
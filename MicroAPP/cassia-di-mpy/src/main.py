@@ -77,6 +77,7 @@ async def main():
     co_tasks.extend(cassiablue_mgr.co_tasks())
     co_tasks.extend(task_mgr.co_tasks())
     co_tasks.extend(mqtt.co_tasks())
+    co_tasks.extend(msg_dsp.co_tasks())
 
     """
     Linux/MacOS不支持，否则发送HTTP请求时会导致segment fault
@@ -85,7 +86,11 @@ async def main():
     if sys.platform == "esp32":
         co_tasks.extend(http_srv.co_tasks())
 
-    await asyncio.gather(*co_tasks)
+    try:
+        await asyncio.gather(*co_tasks)
+    finally:
+        # 退出前发送未满的批次，不依赖flusher任务的取消
+        await msg_dsp.batcher.flush()
 
 
 if __name__ == "__main__":
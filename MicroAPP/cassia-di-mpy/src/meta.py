@@ -64,6 +64,7 @@ class Config:
         conn_chip: str = CONN_CHIP_DEFAULT,
         conn_timeout: str = "15000",
         conn_fail_retry_times: str = "3",
+        conn_max: str = "20",
     ):
         self.log = get_logger(self.__class__.__name__)
 
@@ -93,6 +94,8 @@ class Config:
         self.conn_chip = conn_chip
         self.conn_timeout = conn_timeout
         self.conn_fail_retry_times = conn_fail_retry_times
+        # 网关最大同时连接数，任务调度按此限制并发
+        self.conn_max = conn_max
 
     def to_dict(self):
         return {k: v for k, v in self.__dict__.items() if k != "log"}
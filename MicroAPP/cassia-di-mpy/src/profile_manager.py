@@ -1,11 +1,61 @@
+import binascii
+
 try:
-    from typing import Dict, Optional
+    from typing import Dict, Optional, List, Any
 except ImportError:
     pass
 
 from cassia_log import get_logger
+from cassiablue_manager import ScanData
 from profile_model import Model
 
+# 完整128位形式的16位UUID: 0000xxxx-0000-1000-8000-00805f9b34fb
+BLE_BASE_UUID_SUFFIX = "00001000800000805f9b34fb"
+
+AD_TYPE_UUID16 = (0x02, 0x03)
+AD_TYPE_UUID128 = (0x06, 0x07)
+AD_TYPE_SERVICE_DATA16 = 0x16
+AD_TYPE_MANUFACTURER = 0xFF
+
+
+def _norm_uuid(uuid: str) -> str:
+    uuid = uuid.lower().replace("-", "")
+    if len(uuid) == 32 and uuid.startswith("0000") and uuid[8:] == BLE_BASE_UUID_SUFFIX:
+        return uuid[4:8]
+    return uuid
+
+
+def _parse_ad(ad_hex: str, uuids: List[str], company_ids: List[int]):
+    """Service UUIDs and manufacturer company IDs of an advertisement payload"""
+    try:
+        buf = bytes.fromhex(ad_hex)
+    except ValueError:
+        return
+
+    i = 0
+    while i + 1 < len(buf):
+        length = buf[i]
+        if length == 0 or i + 1 + length > len(buf):
+            return
+
+        ad_type = buf[i + 1]
+        start = i + 2
+        end = i + 1 + length
+
+        if ad_type in AD_TYPE_UUID16 or ad_type == AD_TYPE_SERVICE_DATA16:
+            if ad_type == AD_TYPE_SERVICE_DATA16:
+                end = min(end, start + 2)
+            for j in range(start, end - 1, 2):
+                uuids.append("%04x" % (buf[j] | (buf[j + 1] << 8)))
+        elif ad_type in AD_TYPE_UUID128:
+            for j in range(start, end - 15, 16):
+                uuid = binascii.hexlify(bytes(reversed(buf[j : j + 16])))
+                uuids.append(_norm_uuid(uuid.decode()))
+        elif ad_type == AD_TYPE_MANUFACTURER and end - start >= 2:
+            company_ids.append(buf[start] | (buf[start + 1] << 8))
+
+        i = end
+
 
 class ProfileManager:
 
@@ -14,9 +64,19 @@ class ProfileManager:
 
         self.models: Dict[str, Model] = {}
 
+        # 由模型的get_scan_filters生成，add_model时重建
+        self._name_trie: Dict[str, Any] = {}
+        self._mac_prefixes: Dict[str, Model] = {}
+        self._mac_prefix_lens: List[int] = []
+        self._service_uuids: Dict[str, Model] = {}
+        self._manufacturer_ids: Dict[int, Model] = {}
+        # 未声明匹配条件的模型，逐个调用is_model
+        self.fallback_models: List[Model] = []
+
     def add_model(self, model: Model):
         self.log.info("add model:", model.get_name())
         self.models[model.get_name()] = model
+        self._build_index()
 
     def get_model(self, model_name: str) -> Optional[Model]:
         self.log.info("get model:", model_name)
@@ -24,3 +84,88 @@ class ProfileManager:
 
     def get_models(self) -> Dict[str, Model]:
         return self.models
+
+    def _build_index(self):
+        self._name_trie = {}
+        self._mac_prefixes = {}
+        self._service_uuids = {}
+        self._manufacturer_ids = {}
+        self.fallback_models = []
+
+        for model in self.models.values():
+            filters = model.get_scan_filters()
+            if filters is None:
+                self.fallback_models.append(model)
+                continue
+
+            for prefix in filters.get("name_prefix", []):
+                node = self._name_trie
+                for ch in prefix:
+                    node = node.setdefault(ch, {})
+                # None: the model of the prefix ending at this node
+                node[None] = model
+
+            for prefix in filters.get("mac_prefix", []):
+                self._mac_prefixes[prefix.upper()] = model
+
+            for uuid in filters.get("service_uuid", []):
+                self._service_uuids[_norm_uuid(uuid)] = model
+
+            for company_id in filters.get("manufacturer_id", []):
+                self._manufacturer_ids[company_id] = model
+
+        # Longest prefix first
+        self._mac_prefix_lens = sorted(
+            set(len(x) for x in self._mac_prefixes), reverse=True
+        )
+
+        self.log.info(
+            f"build model index ok: {len(self.models)} models, {len(self.fallback_models)} fallback"
+        )
+
+    def match_indexed(self, scan_data: Dict[str, Any]) -> Optional[Model]:
+        """Model of a raw scan report from the filter index, name > MAC > UUID > manufacturer"""
+        model = None
+        node = self._name_trie
+        for ch in scan_data.get("name") or "":
+            node = node.get(ch)
+            if node is None:
+                break
+            model = node.get(None, model)
+        if model is not None:
+            return model
+
+        if self._mac_prefixes:
+            mac = scan_data.get("bdaddr") or ""
+            for length in self._mac_prefix_lens:
+                model = self._mac_prefixes.get(mac[:length])
+                if model is not None:
+                    return model
+
+        if not self._service_uuids and not self._manufacturer_ids:
+            return None
+
+        uuids = []
+        company_ids = []
+        for key in ("adData", "scanData"):
+            if scan_data.get(key):
+                _parse_ad(scan_data[key], uuids, company_ids)
+
+        for uuid in uuids:
+            model = self._service_uuids.get(uuid)
+            if model is not None:
+                return model
+
+        for company_id in company_ids:
+            model = self._manufacturer_ids.get(company_id)
+            if model is not None:
+                return model
+
+        return None
+
+    def match_fallback(self, scan_data: ScanData) -> Optional[Model]:
+        matched_model = None
+        for model in self.fallback_models:
+            if model.is_model(scan_data):
+                matched_model = model
+        return matched_model
@@ -87,6 +87,14 @@ class Model:
     def is_model(self, scan_data: ScanData) -> bool:
         raise NotImplementedError
 
+    def get_scan_filters(self) -> Optional[Dict[str, list]]:
+        """广播匹配条件，任一命中即为本模型，ProfileManager据此建索引
+
+        {"name_prefix": [str], "mac_prefix": [str], "service_uuid": [str], "manufacturer_id": [int]}
+        返回None时，每条广播都调用is_model判断
+        """
+        return None
+
     async def scan_handler(self, scan_data: ScanData) -> Optional[any]:
         raise NotImplementedError
 
@@ -72,3 +72,5 @@ class DeviceTaskEntry:
         self.create_ts = create_ts
         self.results = results
         self.fails = fails
+        # 重试退避，此时间(ms)之前不会被调度
+        self.ready_ts = 0
@@ -1,6 +1,8 @@
 import sys
 import asyncio
 import time
+import random
+import heapq
 import collections
 
 from cassia_uuid import uuid4
@@ -19,6 +21,7 @@ from task_entry import TaskResultRecord
 from task_entry import DeviceTaskEntry
 
 from mqtt import MqttModule, MqttData
+from meta import CONN_CHIP_DEFAULT
 
 try:
     from typing import Dict, Optional, Any, Deque, List
@@ -45,6 +48,21 @@ NEED_RETRY_ERRORS = [
     Error.GATEWAY_OPERATION_TIMEOUT,
 ]
 
+# 重试退避(ms): (base, max)，第n次同类错误等待 base * 2^(n-1)，不超过max，再加抖动
+RETRY_BACKOFF_CHIP = (500, 8000)
+RETRY_BACKOFF_DEVICE = (1000, 16000)
+RETRY_BACKOFF_LINK = (200, 4000)
+
+RETRY_BACKOFF = {
+    Error.GATEWAY_CHIP_IS_NOT_READY: RETRY_BACKOFF_CHIP,
+    Error.GATEWAY_INCORRECT_MODE: RETRY_BACKOFF_CHIP,
+    Error.GATEWAY_CHIP_IS_BUSY: RETRY_BACKOFF_CHIP,
+    Error.GATEWAY_DEVICE_NOT_FOUND: RETRY_BACKOFF_DEVICE,
+    Error.GATEWAY_DEVICE_NOT_SCAN: RETRY_BACKOFF_DEVICE,
+    Error.GATEWAY_DEVICE_DISCONNECTING: RETRY_BACKOFF_DEVICE,
+    Error.GATEWAY_DEVICE_CAN_NOT_SCAN: RETRY_BACKOFF_DEVICE,
+}
+
 
 class DeviceTaskQueue:
     def __init__(self, device_mac: str):
@@ -55,6 +73,9 @@ class DeviceTaskQueue:
 
 
 class DeviceTaskQueueManager:
+    # Longest timer sleep without any backoff pending, keeps the ticks_ms clock unwrapped
+    IDLE_INTERVAL_MS = 60000
+
     def __init__(
         self,
         mqtt: MqttModule,
@@ -69,7 +90,28 @@ class DeviceTaskQueueManager:
         self.profile_mgr = profile_mgr
         self._devices_tasks_queue: Dict[str, DeviceTaskQueue] = {}
         self._lock = asyncio.Lock()
-        self._scheduler_check_interval = 1000
+
+        # Devices with queued tasks to look at, in signal order; the set dedups the list
+        self._ready: List[str] = []
+        self._ready_set = set()
+        self._ready_event = asyncio.Event()
+
+        # Running tasks hold a connection slot on a chip: {chip: [used, max]}, a cap on the
+        # connections only, CassiaBlueManager.connect lets one connect per chip run at once
+        self._chip_slots: Dict[str, List[int]] = self._create_chip_slots()
+
+        # Devices whose head task is backing off: heap [(ready_ts, device_mac)]
+        self._delayed: List[tuple] = []
+        # Backoff clock, not stepped by NTP/RTC updates like the wall clock
+        self._clock = 0
+        self._last_ticks = time.ticks_ms()
+
+    def _now_ms(self) -> int:
+        """Monotonic ms since start, ticks_ms wraps around and can't be ordered in a heap"""
+        ticks = time.ticks_ms()
+        self._clock += time.ticks_diff(ticks, self._last_ticks)
+        self._last_ticks = ticks
+        return self._clock
 
     async def create_task(self, meta: TaskMeta) -> str:
         self.log.info(f"create task start: {meta}")
@@ -109,6 +151,8 @@ class DeviceTaskQueueManager:
                 else:
                     device_queue.queue.append(task)
 
+        self._set_ready(device_mac)
+
         self.log.info(f"add task to queue ok: {task_id} {device_mac}")
 
     async def set_task_fail_with_reason(self, task: DeviceTaskEntry, reason: Error):
@@ -187,6 +231,7 @@ class DeviceTaskQueueManager:
 
         if task.results:
             task.results[-1].end_ts = int(time.time() * 1000)
+        self.cassiablue_mgr.on_task_success(task.meta.device_mac)
 
         self.log.info(f"set task success ok: {task}")
         await self.send_res_ok(task, res_body)
@@ -223,35 +268,143 @@ class DeviceTaskQueueManager:
     def _need_retry_error(self, reason: Error) -> bool:
         return reason in NEED_RETRY_ERRORS
 
-    async def _select_task_and_execute(self, device_queue: DeviceTaskQueue):
+    def _retry_max(self) -> int:
+        """Retries of a task for all reasons, the connect retry setting"""
+        config = self.mqtt.meta_mgr.config
+        try:
+            return int(config.conn_fail_retry_times)
+        except ValueError:
+            self.log.warn(f"invalid retry times, use 3: {config.conn_fail_retry_times}")
+            return 3
+
+    def _retry_delay(self, task: DeviceTaskEntry, reason: Error) -> int:
+        """Backoff before the next attempt (ms), -1 if the retry budget is used up"""
+        if sum(task.fails.values()) > self._retry_max():
+            self.log.warn(f"task retry budget used up: {task.meta.id} {task.fails}")
+            return -1
+
+        base, cap = RETRY_BACKOFF.get(reason, RETRY_BACKOFF_LINK)
+        delay = min(cap, base << (task.fails[reason] - 1))
+        # Half fixed, half random: devices failing together don't retry together
+        half = delay // 2
+        delay = half + random.getrandbits(16) % (half + 1)
+
+        # The task timeout is in wall clock time, like create_ts
+        if task.meta.timeout != 0:
+            deadline = task.create_ts + task.meta.timeout * 1000
+            if int(time.time() * 1000) + delay > deadline:
+                self.log.warn(f"task retry after timeout: {task.meta.id} {delay}")
+                return -1
+
+        return delay
+
+    def _set_delayed(self, device_mac: str, ready_ts: int):
+        heapq.heappush(self._delayed, (ready_ts, device_mac))
+        # The timer may be sleeping past the new ready time
+        self._ready_event.set()
+
+    def _wake_delayed(self) -> Optional[int]:
+        """Signal the devices whose backoff is over, return ms until the next one (None if none)"""
+        now = self._now_ms()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, device_mac = heapq.heappop(self._delayed)
+            self._set_ready(device_mac)
+
+        if not self._delayed:
+            return None
+        return self._delayed[0][0] - now
+
+    def _create_chip_slots(self) -> Dict[str, List[int]]:
+        """One pool on the configured chip, or on the gateway's own choice if none is set"""
+        config = self.mqtt.meta_mgr.config
+
+        try:
+            conn_max = max(1, int(config.conn_max))
+        except ValueError:
+            self.log.warn(f"invalid conn max, use 1: {config.conn_max}")
+            conn_max = 1
+
+        chip = config.conn_chip or CONN_CHIP_DEFAULT
+        self.log.info(f"create chip slots ok: chip={chip} max={conn_max}")
+        return {chip: [0, conn_max]}
+
+    def _acquire_chip_slot(self) -> Optional[str]:
+        """Chip with the most free slots, None if all are in use"""
+        best = None
+        best_free = 0
+        for chip, slot in self._chip_slots.items():
+            free = slot[1] - slot[0]
+            if free > best_free:
+                best = chip
+                best_free = free
+
+        if best is not None:
+            self._chip_slots[best][0] += 1
+        return best
+
+    def _release_chip_slot(self, chip: str):
+        self._chip_slots[chip][0] -= 1
+        # Devices left waiting for a slot
+        if self._ready:
+            self._ready_event.set()
+
+    def _set_ready(self, device_mac: str):
+        """Wake the scheduler for a device that has queued tasks"""
+        if device_mac in self._ready_set:
+            return
+
+        self._ready_set.add(device_mac)
+        self._ready.append(device_mac)
+        self._ready_event.set()
+
+    async def _set_current_done(self, device_queue: DeviceTaskQueue):
         async with device_queue._lock:
-            if not device_queue.queue:
-                self.log.warn(f"select device task, no task: {device_queue.device_mac}")
-                return
+            device_queue.current = None
+            has_task = len(device_queue.queue) > 0
+
+        if has_task:
+            self._set_ready(device_queue.device_mac)
+
+    def _select_task(self, device_queue: DeviceTaskQueue) -> Optional[DeviceTaskEntry]:
+        """Pop the next task and make it current, called with the device queue locked"""
+        if device_queue.current is not None:
+            self.log.info(
+                f"scheduler task is running: {device_queue.device_mac} {device_queue.current.meta.id}"
+            )
+            return None
+
+        if not device_queue.queue:
+            self.log.info(f"select device task, no task: {device_queue.device_mac}")
+            return None
 
-            task = device_queue.queue.popleft()
-            device_mac = device_queue.device_mac
+        # The device is signalled again once the backoff is over
+        if device_queue.queue[0].ready_ts > self._now_ms():
+            self.log.info(f"select device task, backing off: {device_queue.device_mac}")
+            return None
 
+        task = device_queue.queue.popleft()
+        device_queue.current = task
+        return task
+
+    async def _select_task_and_execute(
+        self, device_queue: DeviceTaskQueue, task: DeviceTaskEntry
+    ):
         task_id = task.meta.id
+        device_mac = device_queue.device_mac
         self.log.info(f"select task one: {task_id} {device_mac}")
 
         if task.state == State.DONE:
             self.log.info(f"select task fail, task has done: {task.meta.device_mac}")
+            await self._set_current_done(device_queue)
             return
 
         self.log.info(f"select task ok: {task_id} {device_mac}")
 
         self._set_task_running(task)
 
-        async with device_queue._lock:
-            device_queue.current = task
-
         if self._is_task_timeout(task):
-            async with device_queue._lock:
-                await self.set_task_fail_with_reason(
-                    task, Error.TASK_TIMEOUT_BY_SCHEDULER
-                )
-                device_queue.current = None
+            await self.set_task_fail_with_reason(task, Error.TASK_TIMEOUT_BY_SCHEDULER)
+            await self._set_current_done(device_queue)
             return
 
         self.log.info(
@@ -285,36 +438,69 @@ class DeviceTaskQueueManager:
             else:
                 task.fails[reason] = 1
 
+            delay = -1
             if self._need_retry_error(reason):
+                delay = self._retry_delay(task, reason)
+            if delay >= 0:
                 task.state = State.WAITING
-                self.log.info(f"is task need retry error: {task.meta.id} {reason}")
+                task.ready_ts = self._now_ms() + delay
+                self.log.info(
+                    f"is task need retry error: {task.meta.id} {reason} {delay}"
+                )
                 await self._add_task_to_queue(task, True)
+                self._set_delayed(device_mac, task.ready_ts)
             else:
                 await self.set_task_fail_with_reason(task, reason)
-
-            async with device_queue._lock:
-                device_queue.current = None
         else:
             await self.set_task_success(task, result)
-            async with device_queue._lock:
-                device_queue.current = None
+
+        # A retried task was queued again above, the device becomes ready here
+        await self._set_current_done(device_queue)
+
+    async def _run_task(
+        self, device_queue: DeviceTaskQueue, task: DeviceTaskEntry, chip: str
+    ):
+        try:
+            await self._select_task_and_execute(device_queue, task)
+        finally:
+            self._release_chip_slot(chip)
 
     async def _scheduler(self):
+        """Start the next task of the devices signalled ready, idle devices are not visited
+
+        At most conn_max tasks run at once. Devices wait for a slot in signal order, and a
+        device goes to the back of the list after each task, so the slots rotate fairly.
+        """
         self.log.info("scheduler handler start")
 
-        async with self._lock:
-            device_queues = list(self._devices_tasks_queue.values())
+        ready = self._ready
+        count = 0
+        while count < len(ready):
+            chip = self._acquire_chip_slot()
+            if chip is None:
+                self.log.info(f"scheduler no free slot: {len(ready) - count} waiting")
+                break
 
-        for device_queue in device_queues:
-            async with device_queue._lock:
-                if device_queue.current is None:
-                    asyncio.create_task(self._select_task_and_execute(device_queue))
-                else:
-                    self.log.info(
-                        f"scheduler task is running: {device_queue.device_mac} {device_queue.current.meta.id}"
-                    )
+            device_mac = ready[count]
+            count += 1
+            self._ready_set.discard(device_mac)
+
+            task = None
+            device_queue = self._devices_tasks_queue.get(device_mac)
+            if device_queue is not None:
+                async with device_queue._lock:
+                    task = self._select_task(device_queue)
+
+            if task is None:
+                self._chip_slots[chip][0] -= 1
+                continue
+
+            asyncio.create_task(self._run_task(device_queue, task, chip))
+
+        # Signals that arrived while visiting stay after the unvisited devices
+        del ready[:count]
 
-        self.log.info("scheduler handler done")
+        self.log.info(f"scheduler handler done: {count}")
 
     async def _device_has_task(self, device_mac: str) -> bool:
         async with self._lock:
@@ -338,7 +524,14 @@ class DeviceTaskQueueManager:
         self.log.info("create scheduler timer start")
 
         while True:
-            await asyncio.sleep(self._scheduler_check_interval / 1000)
+            delay = self._wake_delayed()
+            if delay is None:
+                delay = self.IDLE_INTERVAL_MS
+            try:
+                await asyncio.wait_for_ms(self._ready_event.wait(), delay)
+            except asyncio.TimeoutError:
+                continue
+            self._ready_event.clear()
             await self._scheduler()
 
     def co_tasks(self) -> list[asyncio.Task]:
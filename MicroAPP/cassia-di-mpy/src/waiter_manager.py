@@ -1,4 +1,5 @@
 import asyncio
+import heapq
 import time
 
 from cassia_log import get_logger
@@ -47,11 +48,13 @@ class Future:
 class LastActive:
     def __init__(
         self,
-        last_time: any,
+        deadline: int,
         timeout: int,
+        seq: int,
     ):
-        self.last_time = last_time
+        self.deadline = deadline
         self.timeout = timeout
+        self.seq = seq
 
 
 class Waiter:
@@ -70,7 +73,10 @@ class Waiter:
 
 # TODO: lock
 class WaiterManager:
-    CHECK_INTERVAL = 1
+    # Longest timer sleep without any deadline, keeps the ticks_ms clock unwrapped
+    IDLE_INTERVAL_MS = 60000
+    # Rebuild the heap when stale entries outnumber the live ones by this factor
+    COMPACT_RATIO = 2
 
     @staticmethod
     def gen_task_id(prefix: str, device_mac: str, action: str):
@@ -80,23 +86,59 @@ class WaiterManager:
         self.log = get_logger(self.__class__.__name__)
         self.waits: dict[str, Waiter] = {}
         self.last_active: dict[str, LastActive] = {}
+        # Heap of (deadline, seq, id), refreshed/ended waiters are fixed up lazily at the top
+        self._deadlines: list = []
+        self._seq = 0
+        self._clock = 0
+        self._last_ticks = time.ticks_ms()
+        self._wakeup = asyncio.Event()
         self.loop = asyncio.get_event_loop()
         self._timer = self.loop.create_task(self._timer_checker())
 
+    def _now_ms(self):
+        """Monotonic ms since start, ticks_ms wraps around and can't be ordered in a heap"""
+        ticks = time.ticks_ms()
+        self._clock += time.ticks_diff(ticks, self._last_ticks)
+        self._last_ticks = ticks
+        return self._clock
+
     async def _timer_checker(self):
         while True:
-            now = time.ticks_ms()
-            expired_ids = []
+            delay = self._expire(self._now_ms())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for_ms(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _expire(self, now):
+        """Time out the due waiters, return the ms to the next deadline"""
+        heap = self._deadlines
+        while heap:
+            deadline, seq, id = heap[0]
+            active = self.last_active.get(id)
+
+            if active is None or active.seq != seq:
+                heapq.heappop(heap)
+            elif active.deadline > deadline:
+                heapq.heappop(heap)
+                heapq.heappush(heap, (active.deadline, seq, id))
+            elif deadline > now:
+                return min(deadline - now, self.IDLE_INTERVAL_MS)
+            else:
+                heapq.heappop(heap)
+                self._handle_timeout(id)
 
-            for id, (last_time, timeout) in self.last_active.items():
-                if time.ticks_diff(now, last_time) >= timeout * 1000:
-                    expired_ids.append(id)
+        return self.IDLE_INTERVAL_MS
 
-            for id in expired_ids:
-                self._handle_timeout(id)
+    def _compact(self):
+        if len(self._deadlines) <= self.COMPACT_RATIO * len(self.last_active) + 16:
+            return
 
-            self.log.info(f"wait timer checker")
-            await asyncio.sleep(self.CHECK_INTERVAL)
+        self._deadlines = [
+            (active.deadline, active.seq, id) for id, active in self.last_active.items()
+        ]
+        heapq.heapify(self._deadlines)
 
     def _handle_timeout(self, id):
         self.log.info(f"[{id}] wait handle timeout")
@@ -112,7 +154,12 @@ class WaiterManager:
         self.log.info(f"[{id}] wait add {args} {timeout}")
 
         future = Future(id)
-        self.last_active[id] = (time.ticks_ms(), timeout)
+        self._seq += 1
+        deadline = self._now_ms() + timeout * 1000
+        self.last_active[id] = LastActive(deadline, timeout, self._seq)
+        heapq.heappush(self._deadlines, (deadline, self._seq, id))
+        if self._deadlines[0][1] == self._seq:
+            self._wakeup.set()
 
         self.waits[id] = Waiter(
             id=id,
@@ -130,12 +177,12 @@ class WaiterManager:
         return self.waits.get(id)
 
     def refresh(self, id):
-        if id not in self.waits:
+        active = self.last_active.get(id)
+        if active is None:
             self.log.warn(f"[{id}] refresh no id")
             return
 
-        timeout = self.waits[id].timeout
-        self.last_active[id] = (time.ticks_ms(), timeout)
+        active.deadline = self._now_ms() + active.timeout * 1000
         self.log.info(f"[{id}] refresh timeouter ok")
 
     def end(self, id, data=None, error=None):
@@ -144,8 +191,8 @@ class WaiterManager:
         else:
             self.log.info(f"[{id}] wait end {id} {error} {data}")
 
-        if id in self.last_active:
-            del self.last_active[id]
+        if self.last_active.pop(id, None) is not None:
+            self._compact()
 
         wait = self.waits.pop(id, None)
         if wait and not wait.future.done():
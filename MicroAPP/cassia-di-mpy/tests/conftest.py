@@ -0,0 +1,13 @@
+"""Run the gateway modules under CPython: src on the path, the gateway-only modules faked"""
+
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "src"))
+
+# cassiablue_manager imports the gateway firmware module cassiablue, only its names are needed
+cassiablue_manager = types.ModuleType("cassiablue_manager")
+for name in ("CassiaBlueManager", "ScanData", "ScanDataParsed", "NotifyData"):
+    setattr(cassiablue_manager, name, type(name, (), {}))
+sys.modules.setdefault("cassiablue_manager", cassiablue_manager)
@@ -0,0 +1,106 @@
+from profile_manager import ProfileManager, _norm_uuid, _parse_ad
+
+NUS_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"
+
+
+class FakeModel:
+    def __init__(self, name, scan_filters=None):
+        self.name = name
+        self.scan_filters = scan_filters
+
+    def get_name(self):
+        return self.name
+
+    def get_scan_filters(self):
+        return self.scan_filters
+
+    def is_model(self, scan_data):
+        return scan_data.get("name") == self.name
+
+
+def _uuid128_le(uuid):
+    return bytes.fromhex(uuid.replace("-", ""))[::-1].hex()
+
+
+def _parse(ad_hex):
+    uuids = []
+    company_ids = []
+    _parse_ad(ad_hex, uuids, company_ids)
+    return uuids, company_ids
+
+
+def test_norm_uuid():
+    assert _norm_uuid("0000FFF0-0000-1000-8000-00805F9B34FB") == "fff0"
+    assert _norm_uuid("FFF0") == "fff0"
+    assert _norm_uuid(NUS_UUID) == NUS_UUID.replace("-", "")
+
+
+def test_parse_ad_fields():
+    ad_hex = (
+        "020106"  # flags
+        + "0503F0FFAAFE"  # complete 16 bit UUIDs: fff0 feaa
+        + "1107"
+        + _uuid128_le(NUS_UUID)
+        + "0516D2FC0102"  # service data, only its UUID counts
+        + "05FF4C000215"  # manufacturer data, Apple
+    )
+    uuids, company_ids = _parse(ad_hex)
+    assert uuids == ["fff0", "feaa", NUS_UUID.replace("-", ""), "fcd2"]
+    assert company_ids == [0x004C]
+
+
+def test_parse_ad_malformed():
+    assert _parse("zz") == ([], [])
+    # Zero length ends the payload, a field running past the end is ignored
+    assert _parse("0303F0FF00FFFF") == (["fff0"], [])
+    assert _parse("0303F0FF05FF4C") == (["fff0"], [])
+
+
+def _manager(*models):
+    profile_mgr = ProfileManager()
+    for model in models:
+        profile_mgr.add_model(model)
+    return profile_mgr
+
+
+def test_match_indexed_priority():
+    device = FakeModel("device", {"name_prefix": ["cassia-device"]})
+    generic = FakeModel("generic", {"name_prefix": ["cassia"], "mac_prefix": ["C0:00"]})
+    service = FakeModel(
+        "service", {"service_uuid": ["0000FFF0-0000-1000-8000-00805F9B34FB", NUS_UUID]}
+    )
+    apple = FakeModel("apple", {"manufacturer_id": [0x004C]})
+    profile_mgr = _manager(device, generic, service, apple)
+
+    def match(**scan_data):
+        return profile_mgr.match_indexed(scan_data)
+
+    # Longest name prefix
+    assert match(name="cassia-device-1", bdaddr="AA") is device
+    assert match(name="cassia-x", bdaddr="AA") is generic
+    assert match(name="cas", bdaddr="C0:00:00:00:00:01") is generic
+    # Name before MAC before UUID before manufacturer
+    assert match(name="cassia-device", bdaddr="AA", adData="0303F0FF") is device
+    assert match(name="", bdaddr="AA", adData="020106" + "0303F0FF") is service
+    assert match(name="", bdaddr="AA", adData="05FF4C000215" + "0303F0FF") is service
+    assert (
+        match(
+            name="",
+            bdaddr="AA",
+            adData="020106",
+            scanData="1107" + _uuid128_le(NUS_UUID),
+        )
+        is service
+    )
+    assert match(name="", bdaddr="AA", adData="05FF4C000215") is apple
+    assert match(name="zz", bdaddr="AA", adData="05FF") is None
+
+
+def test_models_without_filters_fall_back():
+    indexed = FakeModel("indexed", {"name_prefix": ["cassia"]})
+    legacy = FakeModel("legacy")
+    profile_mgr = _manager(indexed, legacy)
+
+    assert profile_mgr.fallback_models == [legacy]
+    assert profile_mgr.match_indexed({"name": "legacy", "bdaddr": "AA"}) is None
+    assert profile_mgr.match_fallback({"name": "legacy"}) is legacy
@@ -0,0 +1,161 @@
+from const import ChipId
+from util import get_timestamp
+
+
+class AdaptiveConnectController:
+    """Tune connect_by_list parameters online from the observed connects
+
+    - Per chip: list length from the success rate and connect latency (grows while requests
+      connect quickly, halves when they keep failing), timeout from the connect latency
+    - Per device: PHY, devices that keep failing on 2M fall back to 1M and try 2M again later
+    - A device seen in earlier sessions starts on the PHY it last connected with (DeviceCache)
+    """
+
+    def __init__(self, device_cache=None):
+        self.BATCH_MIN = 2
+        self.BATCH_MAX = 8
+        self.TIMEOUT_MIN = 3000
+        self.TIMEOUT_MAX = 10000
+
+        # Smoothing factors of the latency average/deviation (same as TCP RTO estimation)
+        self.ALPHA = 0.125
+        self.BETA = 0.25
+
+        # Smoothed share of connect_by_list requests that connected a device
+        self.SUCCESS_HIGH = 0.8
+        self.SUCCESS_LOW = 0.5
+
+        self.PHY_DEFAULT = "2M"
+        self.PHY_FALLBACK = "1M"
+        self.PHY_FALLBACK_FAILS = 3
+        # A device on the fallback PHY tries the default one again after this long (s)
+        self.PHY_RETRY_INTERVAL = 600
+
+        self.chips = {
+            chip: {
+                # The fixed list length before tuning, failures bring it down
+                "batch_size": self.BATCH_MAX,
+                "timeout": self.TIMEOUT_MAX,
+                "success_rate": 1.0,
+                "latency_avg": None,
+                "latency_dev": 0.0,
+                "connects": 0,
+                "fails": 0,
+            }
+            for chip in (ChipId.H0, ChipId.H1)
+        }
+        # {mac: {"phy": str, "fails": float, "latency": float, "fallback_ts": float}}
+        self.devices = {}
+        self._device_cache = device_cache
+
+    def _cached_phy(self, mac):
+        phy, phy_ts = self._device_cache.phy(mac) if self._device_cache else (None, 0)
+        return phy or self.PHY_DEFAULT, phy_ts
+
+    def _device(self, mac):
+        device = self.devices.get(mac)
+        if device is None:
+            # A cached fallback expires as if it had been decided in this session
+            phy, phy_ts = self._cached_phy(mac)
+            device = {"phy": phy, "fails": 0.0, "latency": None, "fallback_ts": phy_ts}
+            self.devices[mac] = device
+        return device
+
+    def batch_size(self, chip):
+        return self.chips[chip]["batch_size"]
+
+    def timeout(self, chip):
+        return self.chips[chip]["timeout"]
+
+    def phy(self, mac):
+        device = self._device(mac)
+        if (
+            device["phy"] != self.PHY_DEFAULT
+            and get_timestamp() - device["fallback_ts"] > self.PHY_RETRY_INTERVAL
+        ):
+            # The link may have improved, another failure streak falls back again
+            device["phy"] = self.PHY_DEFAULT
+            device["fails"] = 0.0
+        return device["phy"]
+
+    def group_by_phy(self, macs):
+        """PHY of the first device, and the devices in order that use it (one PHY per request)"""
+        if not macs:
+            return self.PHY_DEFAULT, []
+        phy = self.phy(macs[0])
+        return phy, [mac for mac in macs if self.phy(mac) == phy]
+
+    def is_fallback(self, mac):
+        device = self.devices.get(mac)
+        return device is not None and device["phy"] != self.PHY_DEFAULT
+
+    def on_connected(self, chip, mac, latency):
+        """A device of the list connected after latency seconds"""
+        stat = self.chips[chip]
+        stat["connects"] += 1
+
+        if stat["latency_avg"] is None:
+            stat["latency_avg"] = latency
+            stat["latency_dev"] = latency / 2
+        else:
+            err = latency - stat["latency_avg"]
+            stat["latency_avg"] += self.ALPHA * err
+            stat["latency_dev"] += self.BETA * (abs(err) - stat["latency_dev"])
+
+        timeout = int((stat["latency_avg"] + 4 * stat["latency_dev"]) * 1000)
+        stat["timeout"] = min(max(timeout, self.TIMEOUT_MIN), self.TIMEOUT_MAX)
+
+        device = self._device(mac)
+        device["fails"] = 0.0
+        device["latency"] = latency
+
+    def on_connect_done(self, chip, attempted, connected):
+        """A connect_by_list request finished, connected or not
+
+        attempted: devices of the list still waiting when the request gave up, the ones
+        handed over or dropped meanwhile are not charged.
+        """
+        stat = self.chips[chip]
+        stat["success_rate"] += self.ALPHA * (
+            (1.0 if connected else 0.0) - stat["success_rate"]
+        )
+
+        if not connected:
+            # Nothing connected in the timeout window: wait longer next time
+            stat["fails"] += 1
+            stat["timeout"] = min(stat["timeout"] * 2, self.TIMEOUT_MAX)
+
+            # The list failed as a whole, its devices share one failure
+            for mac in attempted:
+                self._device_failed(mac, 1.0 / len(attempted))
+
+        self._tune_batch_size(stat)
+
+    def _device_failed(self, mac, share):
+        device = self._device(mac)
+        device["fails"] += share
+        if (
+            device["phy"] == self.PHY_DEFAULT
+            and device["fails"] >= self.PHY_FALLBACK_FAILS
+        ):
+            device["phy"] = self.PHY_FALLBACK
+            device["fails"] = 0.0
+            device["fallback_ts"] = get_timestamp()
+
+    def _tune_batch_size(self, stat):
+        """Additive increase while requests connect well within the timeout, halve when they fail"""
+        if stat["success_rate"] < self.SUCCESS_LOW:
+            # Failing lists hold the chip for a whole timeout, keep them to the best candidates
+            stat["batch_size"] = max(stat["batch_size"] // 2, self.BATCH_MIN)
+            return
+
+        latency_avg = stat["latency_avg"]
+        fast = latency_avg is None or latency_avg * 1000 < stat["timeout"] / 2
+        if stat["success_rate"] >= self.SUCCESS_HIGH and fast:
+            stat["batch_size"] = min(stat["batch_size"] + 1, self.BATCH_MAX)
+
+    def snapshot(self):
+        return {
+            "chips": self.chips,
+            "devices": self.devices,
+        }
@@ -0,0 +1,131 @@
+"""Throughput benchmark of the connection scheduler against the mock gateway (or a real one).
+
+Reports tasks/min, connect and data latency percentiles and worker utilisation.
+"""
+
+import os
+import json
+import asyncio
+
+from logger import logger
+from gateway import CassiaGatewayAsync
+from device_profile import DeviceProfile
+from task import TaskScheduler
+from const import TaskState
+from util import get_timestamp
+from mock_gateway import MockGateway, MOCK_HOST, MOCK_PORT
+
+WORKER_NUM = int(os.getenv("WORKER_NUM") or "2")
+# Unset: start an in-process mock gateway (see mock_gateway.py for its settings)
+BASE_URL = os.getenv("BASE_URL")
+BENCH_DURATION = float(os.getenv("BENCH_DURATION") or "60")
+# Tasks finished during the warmup are not counted
+BENCH_WARMUP = float(os.getenv("BENCH_WARMUP") or "5")
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return round(values[index], 3)
+
+
+class BenchmarkStat:
+    def __init__(self, worker_cnt):
+        self.worker_cnt = worker_cnt
+        self.tasks = []
+
+    def on_task_done(self, task):
+        self.tasks.append(dict(task))
+
+    def report(self, start_ts, end_ts):
+        duration = end_ts - start_ts
+        tasks = [t for t in self.tasks if start_ts <= t["exec_done_ts"] <= end_ts]
+        success = [t for t in tasks if t["state"] == TaskState.SUCCESS]
+
+        connect_latency = [
+            t["exec_connect_end_ts"] - t["exec_connect_start_ts"]
+            for t in tasks
+            if t["exec_connect_end_ts"] and t["exec_connect_start_ts"]
+        ]
+        data_latency = [
+            t["exec_data_end_ts"] - t["exec_data_start_ts"] for t in success
+        ]
+
+        # A worker is busy from the hand-over of a connected device to its release
+        busy = sum(
+            t["exec_done_ts"] - max(t["exec_data_start_ts"], start_ts)
+            for t in tasks
+            if t["exec_data_start_ts"]
+        )
+
+        return {
+            "duration": round(duration, 1),
+            "workers": self.worker_cnt,
+            "tasks": len(tasks),
+            "success": len(success),
+            "failed": len(tasks) - len(success),
+            "tasks_per_min": round(len(success) * 60 / duration, 1),
+            "connect_latency_p50": percentile(connect_latency, 50),
+            "connect_latency_p99": percentile(connect_latency, 99),
+            "data_latency_p50": percentile(data_latency, 50),
+            "data_latency_p99": percentile(data_latency, 99),
+            "worker_utilisation": round(busy / (self.worker_cnt * duration), 3),
+        }
+
+
+async def benchmark():
+    mock_gateway = None
+    base_url = BASE_URL
+    if base_url is None:
+        mock_gateway = MockGateway()
+        mock_runner = await mock_gateway.start()
+        base_url = f"http://{MOCK_HOST}:{MOCK_PORT}"
+
+    stat = BenchmarkStat(WORKER_NUM)
+    scan_filter = {"filter_name": "BLE_Sample_Dev"}
+
+    async with CassiaGatewayAsync(base_url, scan_filter) as gateway:
+        device_profile = DeviceProfile(gateway)
+        gateway.reg_notification_handler(device_profile.notifier)
+        gateway.reg_scan_handler(device_profile.scanner)
+
+        task_scheduler = TaskScheduler(gateway, device_profile, WORKER_NUM, None)
+        gateway.reg_state_handler(task_scheduler.stater)
+        device_profile.reg_scanned_handler(task_scheduler.wakeup)
+        task_scheduler.reg_done_handler(stat.on_task_done)
+
+        task_list = gateway.run_tasks() + task_scheduler.run_tasks()
+        logger.warning(
+            "benchmark start: %s workers, %ss (+%ss warmup)",
+            WORKER_NUM,
+            BENCH_DURATION,
+            BENCH_WARMUP,
+        )
+
+        await asyncio.sleep(BENCH_WARMUP)
+        start_ts = get_timestamp()
+        await asyncio.sleep(BENCH_DURATION)
+        end_ts = get_timestamp()
+
+        for task in task_list:
+            task.cancel()
+        await asyncio.gather(*task_list, return_exceptions=True)
+
+        report = stat.report(start_ts, end_ts)
+        report["gateway_pool"] = gateway.pool_stats()
+
+    if mock_gateway is not None:
+        report["mock_gateway"] = mock_gateway.stat
+        await mock_gateway.stop(mock_runner)
+
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    """Scheduler throughput on a laptop, no BLE hardware needed
+
+    LOG_LEVEL=WARNING MOCK_DEVICES=100 WORKER_NUM=4 BENCH_DURATION=60 python3 benchmark.py
+    """
+    asyncio.run(benchmark())
@@ -0,0 +1,181 @@
+from logger import logger
+from util import get_timestamp
+from gateway import CassiaGatewayAsync
+from device_profile import DeviceProfile
+from task import TaskScheduler
+
+
+class GatewayCluster:
+    """Multi-gateway mode, one TaskScheduler per gateway
+
+    - Every device is owned by one gateway, only the owner queues and connects it
+    - The owner is the gateway that hears the device best (scan SSE RSSI)
+    - A device moves to the next best gateway when its owner is down (no scan data) or saturated,
+      when every gateway is saturated the RSSI alone decides
+    """
+
+    def __init__(self, nodes):
+        """nodes: [(CassiaGatewayAsync, DeviceProfile, TaskScheduler)]"""
+        # Keep the current owner unless another gateway hears the device this much better (dB)
+        self.RSSI_HYSTERESIS = 5
+        # RSSI readings older than this are ignored (s)
+        self.RSSI_EXPIRE = 10
+        # A gateway without any scan data for this long is considered down (s)
+        self.GATEWAY_DOWN_TIMEOUT = 10
+        # A gateway with this share of its workers busy is saturated
+        self.SATURATION_LOAD = 1.0
+        # Devices not heard by any gateway for this long are forgotten (s)
+        self.DEVICE_EXPIRE = 300
+        self.PRUNE_INTERVAL = 60
+
+        self._nodes = nodes
+        self._last_scan_ts = [0] * len(nodes)
+        self._owners = {}  # {mac: node index}
+        self._rssi = {}  # {mac: {node index: (rssi, ts)}}
+        self._prune_ts = 0
+
+        for index, (gateway, _, _) in enumerate(nodes):
+            gateway.reg_scan_handler(self._scanner(index))
+
+    def _scanner(self, index):
+        device_profile: DeviceProfile = self._nodes[index][1]
+
+        def scanner(scan_data):
+            """Gateway Scan SSE Data Processing, routed to the owner gateway"""
+            device_info = device_profile.parse_scan_data(scan_data)
+            if device_info is not None:
+                self._route(index, device_info)
+
+        return scanner
+
+    def _live(self, index, now):
+        return now - self._last_scan_ts[index] <= self.GATEWAY_DOWN_TIMEOUT
+
+    def _saturated(self, index):
+        task_scheduler: TaskScheduler = self._nodes[index][2]
+        return task_scheduler.load() >= self.SATURATION_LOAD
+
+    def _select_owner(self, mac, owner, now):
+        candidates = {
+            index: rssi
+            for index, (rssi, ts) in self._rssi[mac].items()
+            if now - ts <= self.RSSI_EXPIRE and self._live(index, now)
+        }
+        if not candidates:
+            return owner
+
+        free = {
+            index: rssi
+            for index, rssi in candidates.items()
+            if not self._saturated(index)
+        }
+        # Saturation only matters while some gateway has room, else the RSSI decides
+        pool = free or candidates
+        best = max(pool, key=pool.get)
+
+        if owner in pool and pool[owner] + self.RSSI_HYSTERESIS >= pool[best]:
+            return owner
+
+        return best
+
+    def _prune(self, now):
+        """Forget devices no gateway has heard for DEVICE_EXPIRE"""
+        for mac in list(self._rssi):
+            if any(
+                now - ts <= self.DEVICE_EXPIRE for _, ts in self._rssi[mac].values()
+            ):
+                continue
+
+            owner = self._owners.get(mac)
+            if owner is not None:
+                if self._nodes[owner][2].task_active(mac):
+                    continue
+                self._nodes[owner][1].remove_scanned_device(mac)
+                del self._owners[mac]
+            del self._rssi[mac]
+
+    def _route(self, index, device_info):
+        now = get_timestamp()
+        self._last_scan_ts[index] = now
+        if now - self._prune_ts >= self.PRUNE_INTERVAL:
+            self._prune_ts = now
+            self._prune(now)
+
+        mac = device_info["mac"]
+        self._rssi.setdefault(mac, {})[index] = (device_info["rssi"], now)
+
+        owner = self._owners.get(mac)
+        new_owner = self._select_owner(mac, owner, now)
+
+        if new_owner != owner:
+            # Never move a device that is being connected or served
+            if owner is not None and self._nodes[owner][2].task_active(mac):
+                new_owner = owner
+            else:
+                self._reassign(mac, owner, new_owner)
+
+                # Queue it right away with the RSSI the new owner heard
+                if new_owner != index:
+                    rssi, _ = self._rssi[mac][new_owner]
+                    device_info = {**device_info, "rssi": rssi}
+                    self._nodes[new_owner][1].add_scanned_device(device_info)
+                    return
+
+        if new_owner == index:
+            self._nodes[index][1].add_scanned_device(device_info)
+
+    def _reassign(self, mac, owner, new_owner):
+        if owner is not None:
+            old_profile: DeviceProfile = self._nodes[owner][1]
+            old_profile.remove_scanned_device(mac)
+
+        self._owners[mac] = new_owner
+        logger.info(
+            "[%s] device owner: %s -> %s",
+            mac,
+            self._base_url(owner),
+            self._base_url(new_owner),
+        )
+
+    def _base_url(self, index):
+        if index is None:
+            return None
+        gateway: CassiaGatewayAsync = self._nodes[index][0]
+        return gateway.base_url
+
+    @property
+    def devices_task(self):
+        """Tasks of all gateways, tagged with the gateway"""
+        devices_task = {}
+        for gateway, _, task_scheduler in self._nodes:
+            for mac, task in task_scheduler.devices_task.items():
+                # A device left in INIT on its previous owner
+                if mac in devices_task and devices_task[mac]["state"] > task["state"]:
+                    continue
+                devices_task[mac] = {**task, "gateway": gateway.base_url}
+        return devices_task
+
+    @property
+    def tasks_stat(self):
+        return {
+            gateway.base_url: task_scheduler.tasks_stat
+            for gateway, _, task_scheduler in self._nodes
+        }
+
+    @property
+    def test_devices(self):
+        return self._nodes[0][2].test_devices
+
+    def snapshot(self):
+        return {
+            "owners": {
+                mac: self._base_url(index) for mac, index in self._owners.items()
+            },
+            "gateways": {
+                gateway.base_url: task_scheduler.snapshot()
+                for gateway, _, task_scheduler in self._nodes
+            },
+        }
+
+    def pool_stats(self):
+        return {gateway.base_url: gateway.pool_stats() for gateway, _, _ in self._nodes}
@@ -0,0 +1,129 @@
+"""Per-device connection profile learned in earlier sessions, persisted as JSON.
+
+{mac: {"addr_type", "phy", "phy_ts", "gatt", "last_success_ts"}}
+
+"phy" is only set for a device that connected on the fallback PHY, since "phy_ts".
+"""
+
+import os
+import json
+import asyncio
+
+import aiofiles
+
+from logger import logger
+from util import get_timestamp
+
+DEVICE_CACHE_FILE = os.getenv("DEVICE_CACHE_FILE") or "device_cache.json"
+# Entries are trusted for this long after the last successful session (s), 7 days
+DEVICE_CACHE_TTL = float(os.getenv("DEVICE_CACHE_TTL") or "604800")
+
+
+class DeviceCache:
+    def __init__(self, file_name=DEVICE_CACHE_FILE, ttl=DEVICE_CACHE_TTL):
+        """file_name: None keeps the cache in memory only"""
+        # Changes are written at most this often (s)
+        self.SAVE_INTERVAL = 10
+
+        self.file_name = file_name
+        self.ttl = ttl
+        self.devices = {}
+        self._dirty = False
+
+        self.load()
+
+    def load(self):
+        if not self.file_name or not os.path.exists(self.file_name):
+            return
+
+        try:
+            with open(self.file_name, "r", encoding="utf-8") as f:
+                self.devices = json.load(f)
+            logger.info(
+                "device cache load ok: %s %s", self.file_name, len(self.devices)
+            )
+        except Exception as ex:
+            logger.warning("device cache load failed, start empty: %s", ex)
+            self.devices = {}
+
+    async def save(self):
+        if not self.file_name or not self._dirty:
+            return
+
+        self._dirty = False
+        tmp_file = f"{self.file_name}.tmp"
+        async with aiofiles.open(tmp_file, "w") as f:
+            await f.write(json.dumps(self.devices))
+        # A crash while writing leaves the previous file intact
+        os.replace(tmp_file, self.file_name)
+        logger.info("device cache save ok: %s %s", self.file_name, len(self.devices))
+
+    def get(self, mac):
+        """Entry of a device that succeeded within the TTL, else None"""
+        device = self.devices.get(mac)
+        if device is None:
+            return None
+        if get_timestamp() - device.get("last_success_ts", 0) > self.ttl:
+            return None
+        return device
+
+    def addr_type(self, mac, default="random"):
+        device = self.get(mac)
+        return device["addr_type"] if device and device.get("addr_type") else default
+
+    def phy(self, mac):
+        """-> (fallback PHY, when it connected with it), (None, 0) for the default PHY"""
+        device = self.get(mac)
+        if not device or not device.get("phy"):
+            return None, 0
+        return device["phy"], device.get("phy_ts", 0)
+
+    def set_phy(self, mac, phy):
+        """Fallback PHY a device just connected with, None once it connects on the default"""
+        device = self.devices.setdefault(mac, {})
+        if phy is None:
+            if device.pop("phy", None) is not None:
+                device.pop("phy_ts", None)
+                self._dirty = True
+            return
+
+        device["phy"] = phy
+        device["phy_ts"] = get_timestamp()
+        self._dirty = True
+
+    def gatt(self, mac):
+        device = self.get(mac)
+        return device.get("gatt") if device else None
+
+    def update(self, mac, **fields):
+        """Record what a connection learned, None values are skipped"""
+        device = self.devices.setdefault(mac, {})
+        for key, value in fields.items():
+            if value is not None and device.get(key) != value:
+                device[key] = value
+                self._dirty = True
+
+    def on_success(self, mac):
+        self.update(mac, last_success_ts=get_timestamp())
+
+    def invalidate_gatt(self, mac):
+        """The cached handles were rejected, discover again next time"""
+        device = self.devices.get(mac)
+        if device is not None and device.pop("gatt", None) is not None:
+            self._dirty = True
+
+    async def _saver(self):
+        try:
+            while True:
+                await asyncio.sleep(self.SAVE_INTERVAL)
+                try:
+                    await self.save()
+                except Exception as ex:
+                    logger.warning("device cache save failed: %s", ex)
+        finally:
+            await self.save()
+
+    def run_tasks(self):
+        return [
+            asyncio.create_task(self._saver(), name="device_cache"),
+        ]
@@ -1,33 +1,84 @@
 """Simulated log protocol implementation using an nRF52840 Dongle. Please modify it according to your specific device."""
 
+import bisect
 import struct
-import json
+import logging
 import asyncio
 
+import aiohttp
+
+import metrics
 from logger import logger
 from wait import WaitFuture
 from const import TaskPriority
 from const import DeviceType
+from util import get_timestamp
 from gateway import CassiaGatewayAsync
+from ready_queue import DeviceReadyQueue
+from device_cache import DeviceCache
+from state_store import StateStore
+
+
+def _cover(starts, ends, start, end):
+    """Merge [start, end) into sorted disjoint intervals, returns the bytes newly covered
+
+    In-order packets keep a single interval, overlapping retransmissions are counted once.
+    """
+    # Intervals overlapping or touching [start, end)
+    i = bisect.bisect_left(ends, start)
+    j = bisect.bisect_right(starts, end)
+
+    covered = 0
+    for k in range(i, j):
+        covered += min(ends[k], end) - max(starts[k], start)
+    starts[i:j] = [min(start, starts[i]) if i < j else start]
+    ends[i:j] = [max(end, ends[j - 1]) if i < j else end]
+    return end - start - covered
 
 
 class DeviceProfile:
-    def __init__(self, gateway: CassiaGatewayAsync):
+    def __init__(
+        self,
+        gateway: CassiaGatewayAsync,
+        device_cache: DeviceCache = None,
+        state_store: StateStore = None,
+    ):
         # Sample GATT handles and commands below; replace with your actual device values
         self.NOTIFY_DATA_HANDLE = 0x17
         self.NOTIFY_HANDLE = 0x18
         self.WRITE_HANDLE = 0x17
+        self.GATT_HANDLES = {
+            "notify_data": self.NOTIFY_DATA_HANDLE,
+            "notify": self.NOTIFY_HANDLE,
+            "write": self.WRITE_HANDLE,
+        }
+        # Log characteristic UUID: set it to discover the handles of each device once
+        # (then cached), instead of using the fixed handles above
+        self.GATT_CHAR_UUID = None
+        self.GATT_CCCD_UUID = "00002902-0000-1000-8000-00805f9b34fb"
 
         self.GATT_REQ_GET_LOGS_SIZE = "b56201"
         self.GATT_REQ_GET_LOGS = "b56206"
 
         self.gateway = gateway
 
-        # Scan data cache
-        self.scanned_devices = {}
+        # Connection profile of the devices from earlier sessions, in memory only if not given
+        self.device_cache = device_cache or DeviceCache(None)
+        # Last task state/success per device, kept across restarts
+        self.state_store = state_store or StateStore(None)
+
+        # Scan data cache, ordered by scheduling priority
+        self.scanned_devices = DeviceReadyQueue()
+        self.scanned_handler = None
+
+        # Scan reports coalesced per MAC between scheduler ticks, only the latest is kept
+        self.scan_pending = {}  # {mac: device_info}
+        # Smoothing factor of the per-device RSSI average
+        self.RSSI_ALPHA = 0.25
 
         # Device task data cache
         self.devices_logs_buf = {}
+        self.devices_running = {}  # {mac: {"link_lost": str | None, "handles": dict}}
 
         self.devices_waiter = WaitFuture()
 
@@ -35,9 +86,10 @@ class DeviceProfile:
         self.devices_last_seq_gw = {}  # Gateway packet sequence number
         self.devices_seq_stats_gw = {}
 
-    def _parse_addata(self, scan_data):
+    def parse_scan_data(self, scan_data):
+        """Scan SSE data -> device info for scheduling, None if not a target device"""
         if scan_data.get("adData") is None:
-            return
+            return None
 
         mac = scan_data["bdaddrs"][0]["bdaddr"]
         type = scan_data["bdaddrs"][0]["bdaddrType"]
@@ -46,7 +98,7 @@ class DeviceProfile:
         try:
             # TODO: Parser
             buf = bytes.fromhex(scan_data["adData"])
-            self.scanned_devices[mac] = {
+            return {
                 "mac": mac,
                 "type": type,
                 "priority": TaskPriority.HIGH,
@@ -54,7 +106,50 @@ class DeviceProfile:
                 "rssi": rssi,
             }
         except Exception as e:
-            logger.debug(f"parse addata failed: {e} {scan_data}")
+            logger.debug("parse addata failed: %s %s", e, scan_data)
+            return None
+
+    def add_scanned_device(self, device_info):
+        """Coalesce a scan report, the scheduler moves it into the queue on its next tick"""
+        mac = device_info["mac"]
+
+        # Smoothed RSSI carries over ticks, seen counts the reports of this tick
+        last = self.scan_pending.get(mac)
+        if last is not None:
+            rssi_avg = last["rssi_avg"]
+            seen = last["seen"]
+        else:
+            last = self.scanned_devices.get(mac)
+            rssi_avg = (
+                last.get("rssi_avg", last["rssi"]) if last else device_info["rssi"]
+            )
+            seen = 0
+
+        device_info["rssi_avg"] = rssi_avg + self.RSSI_ALPHA * (
+            device_info["rssi"] - rssi_avg
+        )
+        device_info["seen"] = seen + 1
+        self.scan_pending[mac] = device_info
+
+        # Only a device new to the queue is worth waking the scheduler for
+        if last is None and self.scanned_handler is not None:
+            self.scanned_handler(mac)
+
+    def flush_scanned_devices(self):
+        """Move the coalesced scan reports into the queue, returns the number moved"""
+        pending = self.scan_pending
+        if not pending:
+            return 0
+
+        self.scan_pending = {}
+        now = get_timestamp()
+        for mac, device_info in pending.items():
+            device_info["served_recently"] = self.state_store.served_recently(
+                mac, device_info["priority"], now
+            )
+            self.scanned_devices.put(device_info)
+
+        return len(pending)
 
     def _pkt_seq_stat_gateway(self, mac, seq_num):
         """[Gateway Packet] Packet Loss Detection"""
@@ -63,16 +158,19 @@ class DeviceProfile:
         # logger.debug(f"[{mac}] pkt seq checker gateway: {seq_num} {last_seq_num}")
 
         if last_seq_num != -1 and seq_num - last_seq_num > 1:
-            logger.error(f"[{mac}] pkt seq error gateway: {seq_num} {last_seq_num}")
+            logger.error(
+                "[%s] pkt seq error gateway: %s %s", mac, seq_num, last_seq_num
+            )
             self.devices_seq_stats_gw[mac] = self.devices_seq_stats_gw.setdefault(
                 mac, 0
             )
             self.devices_seq_stats_gw[mac] += 1
+            metrics.NOTIFY_SEQ_ERRORS.labels(self.gateway.base_url).inc()
         self.devices_last_seq_gw[mac] = seq_num
 
     def _pkt_seq_stat_print(self, mac):
         logger.info("xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx")
-        logger.info(f"[{mac}] seq stat gw: {self.devices_seq_stats_gw.get(mac)}")
+        logger.info("[%s] seq stat gw: %s", mac, self.devices_seq_stats_gw.get(mac))
         logger.info("xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx")
 
     def _pkt_seq_stat_clear(self, mac):
@@ -81,95 +179,211 @@ class DeviceProfile:
 
     def _get_logs_size_res(self, mac, value_buf):
         id = self.gatt_gen_id(mac, "gatt_get_logs_size")
-        logger.info(f"[{mac}] get logs size res: {value_buf.hex()}")
+        logger.info("[%s] get logs size res: %s", mac, value_buf.hex())
         packs = struct.unpack("<I", value_buf[:4])
         self.devices_waiter.end(id, data=packs[0])
 
+    def _logs_buf_alloc(self, mac, logs_size):
+        """Reassembly buffer of a log pull, sized once from gatt_get_logs_size"""
+        buf = bytearray(logs_size)
+        self.devices_logs_buf[mac] = {
+            "buf": buf,
+            "view": memoryview(buf),
+            # Byte ranges [start, end) received so far
+            "received_starts": [],
+            "received_ends": [],
+            "received": 0,
+        }
+
+    def _logs_buf_release(self, mac):
+        logs_buf = self.devices_logs_buf.pop(mac, None)
+        if logs_buf is None:
+            return None
+
+        # The buffer can't be resized (nor freed early) while a view is exported
+        logs_buf["view"].release()
+        return logs_buf["buf"]
+
     def _get_logs_res(self, mac, value_buf):
         # logger.debug(f"[{mac}] get logs res: {value_buf.hex()}")
 
         # Refresh timeout timer
         id = self.gatt_gen_id(mac, "gatt_get_logs")
         waiter = self.devices_waiter.get(id)
-        if not waiter:
+        logs_buf = self.devices_logs_buf.get(mac)
+        if not waiter or logs_buf is None:
             return
 
-        expect_logs_size = waiter["args"]["logs_size"]
-        packs = struct.unpack("<I", value_buf[3 : 3 + 4])
+        expect_logs_size = len(logs_buf["buf"])
+        packs = struct.unpack_from("<I", value_buf, 3)
         pkt_offset = packs[0]
         pkt_size = len(value_buf)
-        logger.debug(
-            f"[{mac}] [{expect_logs_size}] [{pkt_offset}] [{pkt_size}] add logs: {value_buf.hex()}"
-        )
-
-        self.devices_logs_buf.setdefault(mac, bytearray()).extend(value_buf)
-        expect_offset = len(self.devices_logs_buf[mac]) - pkt_size
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "[%s] [%s] [%s] [%s] add logs: %s",
+                mac,
+                expect_logs_size,
+                pkt_offset,
+                pkt_size,
+                value_buf.hex(),
+            )
 
-        if pkt_offset != expect_offset:
+        if pkt_offset >= expect_logs_size:
             error = (
-                f"[{mac}] logs pkt offset check failed: {pkt_offset} {expect_offset}"
+                f"[{mac}] logs pkt offset check failed: {pkt_offset} {expect_logs_size}"
             )
             logger.error(error)
             self.devices_waiter.end(id, error=error)
-            self.devices_logs_buf.pop(mac, None)
+            self._logs_buf_release(mac)
+            return
+
+        # Out-of-order packets land at their own offset, the last one may run past the size
+        pkt_end = min(pkt_offset + pkt_size, expect_logs_size)
+
+        # Retransmissions may overlap earlier packets with another segmentation,
+        # only the bytes not covered yet count
+        added = _cover(
+            logs_buf["received_starts"], logs_buf["received_ends"], pkt_offset, pkt_end
+        )
+        if not added:
+            logger.debug("[%s] logs pkt duplicate: %s", mac, pkt_offset)
+            return
 
-        if pkt_offset + pkt_size >= expect_logs_size:
-            logger.info(f"[{mac}] [{expect_logs_size}] [{pkt_offset}] get logs ok:")
-            self.devices_waiter.end(id, data=self.devices_logs_buf[mac])
-            self.devices_logs_buf.pop(mac, None)
+        logs_buf["view"][pkt_offset:pkt_end] = memoryview(value_buf)[
+            : pkt_end - pkt_offset
+        ]
+        logs_buf["received"] += added
+
+        if logs_buf["received"] >= expect_logs_size:
+            logger.info(
+                "[%s] [%s] [%s] get logs ok:", mac, expect_logs_size, pkt_offset
+            )
+            self.devices_waiter.end(id, data=self._logs_buf_release(mac))
         else:
-            logger.debug(f"[{mac}] logs pkt ...")
-            pass
+            logger.debug("[%s] logs pkt ...", mac)
 
     def gatt_gen_id(self, mac, ops):
         """Generate a unique operation ID for waiting"""
         return f"{mac}_{ops}"
 
+    def _gatt_wait(self, mac, id, args=None):
+        """Add a waiter, failed at once if the device has already disconnected"""
+        future = self.devices_waiter.add(id, args)
+
+        running = self.devices_running.get(mac)
+        if running is not None and running["link_lost"]:
+            self.devices_waiter.end(id, error=running["link_lost"])
+
+        return future
+
+    def device_disconnected(self, mac, reason=None):
+        """Connection-state SSE: the link is gone, fail the running GATT waits of the device"""
+        running = self.devices_running.get(mac)
+        if running is None:
+            return
+
+        error = f"[{mac}] device disconnected: {reason}"
+        logger.warning(error)
+        running["link_lost"] = error
+        self.devices_waiter.end_by_id_prefix(self.gatt_gen_id(mac, ""), error)
+
     async def gatt_get_logs(self, mac, logs_size):
         """Read internal device logs"""
         id = self.gatt_gen_id(mac, "gatt_get_logs")
-        logger.info(f"[{mac}] get logs start: {logs_size}")
+        logger.info("[%s] get logs start: %s", mac, logs_size)
+        if logs_size == 0:
+            return bytearray()
 
-        await self.gateway.write_handle(mac, self.WRITE_HANDLE, self.GATT_REQ_GET_LOGS)
+        self._logs_buf_alloc(mac, logs_size)
+        await self.gateway.write_handle(
+            mac, self._handles(mac)["write"], self.GATT_REQ_GET_LOGS
+        )
+
+        ret = await self._gatt_wait(mac, id, {"logs_size": logs_size})
 
-        ret = await self.devices_waiter.add(id, {"logs_size": logs_size})
+        logger.info("[%s] get logs ok: %s %s...", mac, len(ret), ret[:32].hex())
+        return ret
 
-        logger.info(f"[{mac}] get logs ok: {len(ret)} {ret[:32]}...")
+    def _handles(self, mac):
+        running = self.devices_running.get(mac)
+        return running["handles"] if running is not None else self.GATT_HANDLES
+
+    def _parse_gatt_handles(self, services):
+        """discover_gatt_all response -> handles of GATT_CHAR_UUID, None if not found"""
+        for service in services:
+            for char in service.get("characteristics", []):
+                if char.get("uuid", "").lower() != self.GATT_CHAR_UUID.lower():
+                    continue
+
+                cccd = None
+                for descriptor in char.get("descriptors", []):
+                    if descriptor.get("uuid", "").lower() == self.GATT_CCCD_UUID:
+                        cccd = descriptor["handle"]
+                return {
+                    "notify_data": char["handle"],
+                    "notify": cccd,
+                    "write": char["handle"],
+                }
+        return None
+
+    async def gatt_handles(self, mac):
+        """Handles of the device: fixed, cached from an earlier session, or discovered"""
+        if self.GATT_CHAR_UUID is None:
+            return self.GATT_HANDLES
+
+        handles = self.device_cache.gatt(mac)
+        if handles is not None:
+            logger.info("[%s] gatt handles cached: %s", mac, handles)
+            return handles
+
+        services = await self.gateway.discover_gatt_all(mac)
+        handles = self._parse_gatt_handles(services)
+        if handles is None:
+            error = f"[{mac}] gatt characteristic not found: {self.GATT_CHAR_UUID}"
+            raise Exception(error)
+
+        logger.info("[%s] gatt handles discovered: %s", mac, handles)
+        self.device_cache.update(mac, gatt=handles)
+        return handles
 
     async def gatt_open_notify(self, mac):
-        logger.info(f"[{mac}] open gatt notify start")
-        await self.gateway.write_handle(mac, self.NOTIFY_HANDLE, "0100")
-        logger.info(f"[{mac}] open gatt notify ok")
+        logger.info("[%s] open gatt notify start", mac)
+        await self.gateway.write_handle(mac, self._handles(mac)["notify"], "0100")
+        logger.info("[%s] open gatt notify ok", mac)
 
     async def gatt_get_logs_size(self, mac):
         id = self.gatt_gen_id(mac, "gatt_get_logs_size")
-        logger.info(f"[{mac}] get logs size start")
+        logger.info("[%s] get logs size start", mac)
 
-        waiter = self.devices_waiter.add(id)
+        waiter = self._gatt_wait(mac, id)
         await self.gateway.write_handle(
-            mac, self.WRITE_HANDLE, self.GATT_REQ_GET_LOGS_SIZE
+            mac, self._handles(mac)["write"], self.GATT_REQ_GET_LOGS_SIZE
         )
 
         ret = await waiter
-        logger.info(f"[{mac}] get logs size ok: {ret}")
+        logger.info("[%s] get logs size ok: %s", mac, ret)
 
         return ret
 
-    def scanner(self, event):
+    def reg_scanned_handler(self, handler):
+        """Called with the MAC when a device is newly added to the scan cache"""
+        self.scanned_handler = handler
+
+    def scanner(self, scan_data):
         """Gateway Scan SSE Data Processing"""
-        logger.debug(f"scan sse event: {event}")
-        scan_data = json.loads(event.data)
-        self._parse_addata(scan_data)
+        logger.debug("scan sse event: %s", scan_data)
+        device_info = self.parse_scan_data(scan_data)
+        if device_info is not None:
+            self.add_scanned_device(device_info)
 
-    def notifier(self, event):
+    def notifier(self, data):
         """Gateway Notification SSE Data Processing"""
-        # logger.info(f"notify sse event: {event}")
-        data = json.loads(event.data)
+        # logger.info(f"notify sse event: {data}")
 
         # [Gateway] <--> [APP]: Transmission Packet Loss Detection
         self._pkt_seq_stat_gateway(data["id"], data["seqNum"])
 
-        if data["handle"] != self.NOTIFY_DATA_HANDLE:
+        if data["handle"] != self._handles(data["id"])["notify_data"]:
             return
 
         value_buf = bytes.fromhex(data["value"])
@@ -180,27 +394,37 @@ class DeviceProfile:
 
     async def task_get_logs(self, mac):
         """Device Task: Retrieve Logs"""
+        running = {"link_lost": None, "handles": self.GATT_HANDLES}
+        self.devices_running[mac] = running
         try:
-            logger.info(f"[{mac}] task get logs start")
+            logger.info("[%s] task get logs start", mac)
+            running["handles"] = await self.gatt_handles(mac)
             await self.gatt_open_notify(mac)
             logs_size = await self.gatt_get_logs_size(mac)
-            logger.info(f"[{mac}] task logs size: {logs_size}")
+            logger.info("[%s] task logs size: %s", mac, logs_size)
             logs = await self.gatt_get_logs(mac, logs_size)
-            logger.info(f"[{mac}] task logs: {logs}")
+            logger.info("[%s] task logs: %s bytes", mac, len(logs))
             self._pkt_seq_stat_print(mac)
+            self.device_cache.on_success(mac)
         except Exception as ex:
-            logger.error(f"[{mac}] task get logs failed: {ex}")
+            logger.error("[%s] task get logs failed: %s", mac, ex)
+            if isinstance(ex, aiohttp.ClientResponseError):
+                # GATT request rejected, the cached handles may be stale
+                self.device_cache.invalidate_gatt(mac)
             raise ex
         finally:
-            self.devices_logs_buf.pop(mac, None)
+            self.devices_running.pop(mac, None)
+            self._logs_buf_release(mac)
             self._pkt_seq_stat_clear(mac)
 
     def get_scanned_devices(self):
         return self.scanned_devices
 
     def remove_scanned_device(self, mac):
-        self.scanned_devices.pop(mac, None)
-        logger.info(f"[{mac}] removed in scanned data")
+        self.scan_pending.pop(mac, None)
+        self.scanned_devices.remove(mac)
+        logger.info("[%s] removed in scanned data", mac)
 
     def clear_scanned_devices(self):
+        self.scan_pending.clear()
         self.scanned_devices.clear()
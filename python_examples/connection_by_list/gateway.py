@@ -1,18 +1,64 @@
+import os
 import asyncio
 import json
 from urllib.parse import urlencode
 
 import aiohttp
-from aiohttp_sse_client import client as sse_client_async
 
+import metrics
 from logger import logger
 
+try:
+    # Optional, several times faster than json on the notification SSE
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Concurrent REST requests per gateway, keep it within what the gateway HTTP server handles
+HTTP_LIMIT = int(os.getenv("HTTP_LIMIT") or "6")
+HTTP_KEEPALIVE_TIMEOUT = 30
+DNS_CACHE_TTL = 300
+
+
+def _connector_count(connector, attr):
+    """Entries of a private connector structure, None if this aiohttp version has no such"""
+    value = getattr(connector, attr, None)
+    try:
+        if isinstance(value, dict):
+            return sum(len(entries) for entries in value.values())
+        return len(value)
+    except TypeError:
+        return None
+
 
 class CassiaGatewayAsync:
-    def __init__(self, base_url, scan_filter):
+    def __init__(self, base_url, scan_filter, http_limit=HTTP_LIMIT):
         self.base_url = base_url
-        self.session = aiohttp.ClientSession()
-        self.sse_sess = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None))
+
+        # REST: bounded keep-alive pool, requests over the limit wait for a free connection
+        self.pool_stat = {
+            "limit": http_limit,
+            "created": 0,
+            "reused": 0,
+        }
+        connector = aiohttp.TCPConnector(
+            limit=http_limit,
+            limit_per_host=http_limit,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=DNS_CACHE_TTL,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector, trace_configs=[self._pool_trace_config()]
+        )
+
+        # SSE: long-lived streams, kept out of the REST limit
+        sse_connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=DNS_CACHE_TTL)
+        self.sse_sess = aiohttp.ClientSession(
+            connector=sse_connector, timeout=aiohttp.ClientTimeout(total=None)
+        )
+
         self.scan_filter = scan_filter
         self.scan_handler = None
         self.state_handler = None
@@ -25,62 +71,159 @@ class CassiaGatewayAsync:
         await self.session.close()
         await self.sse_sess.close()
 
-    async def _open_sse(self, url, handler, session, wait=False):
+    def _pool_trace_config(self):
+        stat = self.pool_stat
+
+        def counter(key, delta):
+            async def on_event(_session, _ctx, _params):
+                stat[key] += delta
+
+            return on_event
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(counter("created", 1))
+        trace_config.on_connection_reuseconn.append(counter("reused", 1))
+        return trace_config
+
+    def pool_stats(self):
+        """REST connection pool metrics
+
+        Occupancy is read from the connector: a connection is in use until the response is
+        released (body read, stream closed), and cancelled requests give theirs back.
+        aiohttp has no public API for it, the counts are None if its internals change.
+        """
+        stat = self.pool_stat
+        acquired = stat["created"] + stat["reused"]
+        connector = self.session.connector
+        return {
+            **stat,
+            "in_use": _connector_count(connector, "_acquired"),
+            "idle": _connector_count(connector, "_conns"),
+            "waiting": _connector_count(connector, "_waiters"),
+            "reuse_ratio": stat["reused"] / acquired if acquired else 0,
+        }
+
+    async def _read_sse(self, resp):
+        """Yield the decoded JSON data of each SSE event
+
+        Events are split on a blank line over one reusable buffer. The gateway sends one
+        `data:` line per event, other fields and `:` comments (keep-alive) are skipped.
+        """
+        buf = bytearray()
+        async for chunk in resp.content.iter_any():
+            buf += chunk
+
+            start = 0
+            while True:
+                end = buf.find(b"\n\n", start)
+                if end < 0:
+                    break
+
+                if buf.find(b"\n", start, end) < 0:
+                    # Single line event, the common case
+                    if buf.startswith(b"data:", start):
+                        data = buf[start + 5 : end]
+                    else:
+                        data = None
+                else:
+                    lines = bytes(buf[start:end]).split(b"\n")
+                    data = b"\n".join(
+                        line[5:] for line in lines if line.startswith(b"data:")
+                    )
+
+                start = end + 2
+                if not data:
+                    continue
+
+                try:
+                    yield json_loads(data)
+                except ValueError as e:
+                    logger.warning("sse data decode failed: %s %s", e, bytes(data[:64]))
+
+            # Drop the consumed events, the partial one stays for the next chunk
+            del buf[:start]
+
+    async def _open_sse(self, name, url, handler, session, wait=False):
+        events = metrics.SSE_EVENTS.labels(self.base_url, name)
         try:
-            logger.info(f"open sse start: {url}")
-            async with sse_client_async.EventSource(url, session=session) as evts:
-                async for event in evts:
+            logger.info("open sse start: %s", url)
+            headers = {"Accept": "text/event-stream"}
+            async with session.get(url, headers=headers) as resp:
+                resp.raise_for_status()
+                async for data in self._read_sse(resp):
+                    events.inc()
                     if wait:
-                        await handler(event)
+                        await handler(data)
                     else:
-                        handler(event)
+                        handler(data)
         except Exception as e:
-            logger.info(f"sse error: {url} {e}")
+            logger.info("sse error: %s %s", url, e)
+
+    async def _keep_sse(self, name, url, handler, wait=False):
+        """Keep an SSE stream always on, auto-reconnect on disconnect"""
+        while True:
+            try:
+                logger.info("open %s sse start", name)
+                await self._open_sse(
+                    name, url, handler=handler, session=self.sse_sess, wait=wait
+                )
+                logger.warning("%s sse disconnected, reconnecting...", name)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("%s sse error: %s", name, e)
+            await asyncio.sleep(3)
 
     async def _print_text_and_raise(self, resp, mac=None):
         text = await resp.text()
-        logger.info(f"[{mac}] resp: {text}")
+        logger.info("[%s] resp: %s", mac, text)
         resp.raise_for_status()
         return text
 
     async def _print_status_text(self, mac, resp):
         text = await resp.text()
-        logger.info(f"[{mac}] status: {resp.status}, resp: {text}")
+        logger.info("[%s] status: %s, resp: %s", mac, resp.status, text)
         return text
 
     async def _print_json_and_raise(self, resp, mac=None):
         text = await resp.text()
-        logger.info(f"[{mac}] resp: {text}")
+        logger.info("[%s] resp: %s", mac, text)
         resp.raise_for_status()
         return json.loads(text)
 
     async def disconnect(self, mac):
-        logger.info(f"[{mac}] disconnect start")
+        logger.info("[%s] disconnect start", mac)
         url = f"{self.base_url}/gap/nodes/{mac}/connection"
         async with self.session.delete(url) as resp:
             await self._print_status_text(mac, resp)
 
     async def disconnect_ignore_ex(self, mac):
         try:
-            logger.info(f"[{mac}] disconnect start")
+            logger.info("[%s] disconnect start", mac)
             url = f"{self.base_url}/gap/nodes/{mac}/connection"
             async with self.session.delete(url) as resp:
                 await self._print_status_text(mac, resp)
         except Exception as ex:
             logger.warning(ex)
 
-    async def connect_by_list(self, nodes, chip=0, timeout=10000):
-        """Connect by List(Sync)"""
-        logger.info(f"connect by list start: {chip} {nodes}")
+    async def connect_by_list(
+        self, nodes, chip=0, timeout=10000, phy="2M", addr_types=None
+    ):
+        """Connect by List(Sync)
+
+        addr_types: {mac: "public"|"random"}, devices not in it are connected as random
+        """
+        logger.info("connect by list start: %s %s %s %s", chip, timeout, phy, nodes)
         url = f"{self.base_url}/gap/connection?chip={chip}"
 
         # TODO: Connection parameters, adjust as needed
-        list = [{"type": "random", "addr": mac} for mac in nodes]
+        addr_types = addr_types or {}
+        list = [{"type": addr_types.get(mac, "random"), "addr": mac} for mac in nodes]
         payload = {
             "timeout": timeout,
             "list": list,
             "dle": 251,
-            "phy": "2M",
+            "phy": phy,
         }
         async with self.session.post(url, json=payload) as resp:
             return await self._print_json_and_raise(resp, nodes)
@@ -90,7 +233,7 @@ class CassiaGatewayAsync:
 
         if noresponse:
             url += "noresponse=1"
-        logger.info(f"[{mac}] write handle start: {url}")
+        logger.info("[%s] write handle start: %s", mac, url)
 
         async with self.session.get(url) as resp:
             await self._print_text_and_raise(resp, mac)
@@ -106,9 +249,7 @@ class CassiaGatewayAsync:
 
     async def open_state(self):
         url = f"{self.base_url}/management/nodes/connection-state"
-        await self._open_sse(
-            url, handler=self.state_handler, session=self.sse_sess, wait=True
-        )
+        await self._keep_sse("state", url, handler=self.state_handler, wait=True)
 
     async def open_scan(self, chip=0):
         """Keep scan SSE always on, auto-reconnect on disconnect"""
@@ -117,25 +258,12 @@ class CassiaGatewayAsync:
             query = urlencode(self.scan_filter)
             url = f"{url}{query}"
 
-        while True:
-            try:
-                logger.info(f"open scan sse start")
-                timeout = aiohttp.ClientTimeout(total=None)
-                async with aiohttp.ClientSession(timeout=timeout) as session:
-                    await self._open_sse(url, handler=self.scan_handler, session=session)
-                logger.warning("scan sse disconnected, reconnecting...")
-            except asyncio.CancelledError:
-                raise
-            except Exception as e:
-                logger.error(f"scan sse error: {e}")
-            await asyncio.sleep(3)
+        await self._keep_sse("scan", url, handler=self.scan_handler)
 
     async def open_notify(self):
         """Enable Notification SSE, each device has a separate seqNum"""
         url = f"{self.base_url}/gatt/nodes?event=1&sequence=2&timestamp=1"
-        await self._open_sse(
-            url, handler=self.notification_handler, session=self.sse_sess
-        )
+        await self._keep_sse("notify", url, handler=self.notification_handler)
 
     def run_tasks(self):
         return [
@@ -148,7 +276,7 @@ class CassiaGatewayAsync:
 
     async def connect_batch(self, nodes, timeout=10000):
         """Connect Batch(Async)"""
-        logger.info(f"connect batch start: {nodes}")
+        logger.info("connect batch start: %s", nodes)
         url = f"{self.base_url}/gap/batch-connect"
         list = [{"type": "random", "addr": mac} for mac in nodes]
         payload = {
@@ -160,7 +288,7 @@ class CassiaGatewayAsync:
             await self._print_text_and_raise(resp, mac=nodes)
 
     async def update_phy(self, mac):
-        logger.info(f"update phy start: {mac}")
+        logger.info("update phy start: %s", mac)
         url = f"{self.base_url}/gap/nodes/{mac}/phy"
         payload = {
             "tx": "2M",
@@ -171,7 +299,7 @@ class CassiaGatewayAsync:
 
     async def connect(self, mac):
         """Connect Device(Sync)"""
-        logger.info(f"[{mac}] connect start")
+        logger.info("[%s] connect start", mac)
         url = f"{self.base_url}/gap/nodes/{mac}/connection"
         payload = {
             "type": "random",
@@ -181,47 +309,47 @@ class CassiaGatewayAsync:
 
     async def read_handle(self, mac, handle):
         url = f"{self.base_url}/gatt/nodes/{mac}/handle/{handle}/value"
-        logger.info(f"[{mac}] read handle start: {url}")
+        logger.info("[%s] read handle start: %s", mac, url)
 
         async with self.session.get(url) as resp:
             return await self._print_json_and_raise(resp, mac)
 
     async def get_interference(self):
         url = f"{self.base_url}/gap/connection/interference"
-        logger.info(f"get interference start: {url}")
+        logger.info("get interference start: %s", url)
 
         async with self.session.get(url) as resp:
             return await self._print_json_and_raise(resp)
 
     async def get_rate(self):
         url = f"{self.base_url}/gatt/nodes/rate"
-        logger.info(f"get rate start: {url}")
+        logger.info("get rate start: %s", url)
 
         async with self.session.get(url) as resp:
             return await self._print_json_and_raise(resp)
 
     async def set_link_track(self, enable=True):
         url = f"{self.base_url}/gap/link-track"
-        logger.info(f"set link track start: {url}")
+        logger.info("set link track start: %s", url)
         payload = {"enable": "1" if enable else "0"}
         async with self.session.post(url, json=payload) as resp:
             await self._print_text_and_raise(resp)
 
     async def get_conns(self):
         url = f"{self.base_url}/conns"
-        logger.info(f"get conns start: {url}")
+        logger.info("get conns start: %s", url)
 
         async with self.session.get(url) as resp:
             return await self._print_json_and_raise(resp)
 
     async def discover_gatt_all(self, mac):
-        logger.info(f"[{mac}] discover gatt start")
+        logger.info("[%s] discover gatt start", mac)
         url = f"{self.base_url}/gatt/nodes/{mac}/services/characteristics/descriptors"
         async with self.session.get(url) as resp:
             return await self._print_json_and_raise(resp, mac)
 
     async def get_connected(self):
-        logger.info(f"get connected start")
+        logger.info("get connected start")
         url = f"{self.base_url}/gap/nodes"
         async with self.session.get(url) as resp:
             return await self._print_json_and_raise(resp)
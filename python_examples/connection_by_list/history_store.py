@@ -0,0 +1,134 @@
+"""Columnar task history (Arrow IPC stream), one row per task stage.
+
+Requires pyarrow, TestDevices falls back to the JSON history without it.
+"""
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+from logger import logger
+
+# Stage rows of a task: (stage, start timestamp field, end timestamp field)
+TASK_STAGES = (
+    ("wait_in_queue", "scan_ts", "exec_connect_start_ts"),
+    ("connect", "exec_connect_start_ts", "exec_connect_end_ts"),
+    ("get_logs", "exec_data_start_ts", "exec_data_end_ts"),
+)
+# One row per round, start/end of the whole round
+ROUND_STAGE = "round"
+
+HISTORY_SCHEMA_FIELDS = (
+    ("round", "int32"),
+    ("mac", "string"),
+    ("transition", "string"),
+    ("attempt", "int32"),
+    ("chip", "int8"),
+    ("state", "int8"),
+    ("stage", "string"),
+    ("start_ts", "float64"),
+    ("end_ts", "float64"),
+)
+
+
+def available():
+    return pa is not None
+
+
+def history_schema(metadata=None):
+    fields = [
+        pa.field(name, getattr(pa, type)()) for name, type in HISTORY_SCHEMA_FIELDS
+    ]
+    return pa.schema(fields, metadata=metadata)
+
+
+class HistoryWriter:
+    """Buffers rows column by column into record batches, the file is written at the end
+
+    Rows are sealed into a record batch every flush_rows, in memory. write() does the
+    file I/O in one go and blocks, run it in a thread.
+    """
+
+    def __init__(self, file_name, metadata=None, flush_rows=4096):
+        self.file_name = file_name
+        self.flush_rows = flush_rows
+
+        metadata = {k: str(v) for k, v in (metadata or {}).items()}
+        self._schema = history_schema(metadata)
+        self._batches = []
+        self._columns = {name: [] for name, _ in HISTORY_SCHEMA_FIELDS}
+        self.rows = 0
+
+    def _append(self, round, mac, transition, attempt, chip, state, stage, start, end):
+        columns = self._columns
+        columns["round"].append(round)
+        columns["mac"].append(mac)
+        columns["transition"].append(transition)
+        columns["attempt"].append(attempt)
+        columns["chip"].append(chip)
+        columns["state"].append(state)
+        columns["stage"].append(stage)
+        columns["start_ts"].append(start)
+        columns["end_ts"].append(end)
+        self.rows += 1
+
+        if len(columns["round"]) >= self.flush_rows:
+            self._seal()
+
+    def add_task(self, round, transition, attempt, task):
+        """Stage rows of a done task, stages it never reached are skipped"""
+        for stage, start_key, end_key in TASK_STAGES:
+            start = task[start_key]
+            end = task[end_key]
+            if not start or not end:
+                continue
+            self._append(
+                round,
+                task["mac"],
+                transition,
+                attempt,
+                int(task["chip"]),
+                int(task["state"]),
+                stage,
+                start,
+                end,
+            )
+
+    def add_round(self, round, start, end):
+        self._append(round, "", "", 0, -1, -1, ROUND_STAGE, start, end)
+
+    def _seal(self):
+        """Buffered rows -> one record batch"""
+        if not self._columns["round"]:
+            return
+
+        batch = pa.record_batch(
+            [self._columns[name] for name, _ in HISTORY_SCHEMA_FIELDS],
+            schema=self._schema,
+        )
+        self._batches.append(batch)
+        for column in self._columns.values():
+            column.clear()
+
+    def write(self):
+        """Write all rows to the file (blocking)"""
+        self._seal()
+        with pa.OSFile(self.file_name, "wb") as sink:
+            with pa.ipc.new_stream(sink, self._schema) as writer:
+                for batch in self._batches:
+                    writer.write_batch(batch)
+        self._batches = []
+        logger.info("history file written: %s %s rows", self.file_name, self.rows)
+
+
+def read_history(file_name):
+    """-> (pandas.DataFrame of all rows, schema metadata dict)"""
+    with pa.memory_map(file_name, "r") as source:
+        reader = pa.ipc.open_stream(source)
+        table = reader.read_all()
+
+    metadata = {
+        k.decode(): v.decode() for k, v in (table.schema.metadata or {}).items()
+    }
+    return table.to_pandas(), metadata
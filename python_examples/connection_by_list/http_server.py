@@ -2,16 +2,19 @@ import asyncio
 
 from aiohttp import web
 
-from logger import logger
+import metrics
+from logger import logger, app_logger
 from task import TaskScheduler
+from gateway import CassiaGatewayAsync
 
 HTTP_HOST = "0.0.0.0"
 HTTP_PORT = 3000
 
 
 class HttpServer:
-    def __init__(self, task_scheduler: TaskScheduler):
+    def __init__(self, task_scheduler: TaskScheduler, gateway: CassiaGatewayAsync):
         self._task_scheduler = task_scheduler
+        self._gateway = gateway
 
     async def _health_check(self, _req):
         text = "OK"
@@ -20,6 +23,21 @@ class HttpServer:
     async def _get_tasks_state(self, _req):
         return web.json_response(self._task_scheduler.devices_task)
 
+    async def _get_tasks_stat(self, _req):
+        return web.json_response(self._task_scheduler.tasks_stat)
+
+    async def _get_debug_snapshot(self, _req):
+        return web.json_response(self._task_scheduler.snapshot())
+
+    async def _get_gateway_pool(self, _req):
+        return web.json_response(self._gateway.pool_stats())
+
+    async def _get_log_stats(self, _req):
+        return web.json_response(app_logger.stats())
+
+    async def _get_metrics(self, _req):
+        return web.Response(text=metrics.render(), content_type=metrics.CONTENT_TYPE)
+
     async def _get_tests_devices_state(self, _req):
         return web.json_response(self._task_scheduler.test_devices.devices)
 
@@ -35,6 +53,11 @@ class HttpServer:
 
         app.router.add_get("/api/health", self._health_check)
         app.router.add_get("/api/tasks/state", self._get_tasks_state)
+        app.router.add_get("/api/tasks/stat", self._get_tasks_stat)
+        app.router.add_get("/api/debug/snapshot", self._get_debug_snapshot)
+        app.router.add_get("/api/gateway/pool", self._get_gateway_pool)
+        app.router.add_get("/api/log/stats", self._get_log_stats)
+        app.router.add_get("/metrics", self._get_metrics)
         app.router.add_get("/api/tests/devices/state", self._get_tests_devices_state)
         app.router.add_get("/api/tests/devices/raw", self._get_tests_devices_raw)
         app.router.add_get("/api/tests/history", self._get_tests_history)
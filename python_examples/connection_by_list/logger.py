@@ -1,5 +1,10 @@
 import logging
+import logging.handlers
 import sys
+import json
+import time
+import queue
+import atexit
 import asyncio
 import os
 
@@ -16,6 +21,13 @@ LOG_LEVEL = {
 
 log_level = LOG_LEVEL.get(os.getenv("LOG_LEVEL")) or logging.INFO
 
+# Asyncio task name in each record, costs an asyncio.current_task() per record
+LOG_TASK_NAME = (os.getenv("LOG_TASK_NAME") or "1") != "0"
+# Minimum interval between two dumps of the same large structure (s)
+LOG_DUMP_INTERVAL = float(os.getenv("LOG_DUMP_INTERVAL") or "10")
+# Records buffered for the writer thread, the oldest are dropped when it can't keep up
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE") or "10000")
+
 
 class AsyncioTaskFilter(logging.Filter):
     def filter(self, record):
@@ -29,6 +41,74 @@ class AsyncioTaskFilter(logging.Filter):
         return True
 
 
+class LazyJson:
+    """JSON of a structure, only serialized if the record is emitted
+
+    logger.debug("tasks: %s", LazyJson(tasks))
+    """
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, default=str)
+
+
+class DumpLogger:
+    """Rate-limited DEBUG channel for large structure dumps, one record per key/interval"""
+
+    def __init__(self, logger, interval=LOG_DUMP_INTERVAL):
+        self.logger = logger
+        self.interval = interval
+        self._last = {}  # {key: (last dump time, suppressed count)}
+
+    def dump(self, key, obj):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+
+        now = time.monotonic()
+        last_ts, suppressed = self._last.get(key, (None, 0))
+        if last_ts is not None and now - last_ts < self.interval:
+            self._last[key] = (last_ts, suppressed + 1)
+            return
+
+        self._last[key] = (now, 0)
+        self.logger.debug("%s (%s suppressed): %s", key, suppressed, LazyJson(obj))
+
+
+def _put_drop_oldest(q, item):
+    """Put without blocking, drop the oldest items to make room. Returns the number dropped"""
+    dropped = 0
+    while True:
+        try:
+            q.put_nowait(item)
+            return dropped
+        except queue.Full:
+            try:
+                q.get_nowait()
+                dropped += 1
+            except queue.Empty:
+                pass
+
+
+class DropOldestQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread, never blocks the event loop on a slow stdout"""
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        self.dropped += _put_drop_oldest(self.queue, record)
+
+
+class DropOldestQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        _put_drop_oldest(self.queue, self._sentinel)
+
+
 class AppLogger:
     def __init__(self, name="app"):
         self.logger = logging.getLogger(name)
@@ -37,16 +117,40 @@ class AppLogger:
         if self.logger.handlers:
             return
 
-        formatter = logging.Formatter(
-            "[%(asctime)s] [%(name)s] [%(levelname)s] [%(task_name)s] %(message)s"
-        )
+        if LOG_TASK_NAME:
+            fmt = "[%(asctime)s] [%(name)s] [%(levelname)s] [%(task_name)s] %(message)s"
+        else:
+            fmt = "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s"
+        formatter = logging.Formatter(fmt)
         console_handler = logging.StreamHandler(sys.stdout)
         console_handler.setFormatter(formatter)
-        console_handler.addFilter(AsyncioTaskFilter())
-        self.logger.addHandler(console_handler)
+
+        # stdout is written from a background thread, the event loop only enqueues.
+        # The message is rendered at enqueue time (arguments may change later), the task
+        # name filter must run there too since it needs the current asyncio task.
+        self.queue_handler = DropOldestQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        if LOG_TASK_NAME:
+            self.queue_handler.addFilter(AsyncioTaskFilter())
+        self.logger.addHandler(self.queue_handler)
+
+        self.listener = DropOldestQueueListener(
+            self.queue_handler.queue, console_handler
+        )
+        self.listener.start()
+        atexit.register(self.listener.stop)
 
     def get_logger(self):
         return self.logger
 
+    def stats(self):
+        """Log sink metrics"""
+        return {
+            "queued": self.queue_handler.queue.qsize(),
+            "capacity": LOG_QUEUE_SIZE,
+            "dropped": self.queue_handler.dropped,
+        }
+
 
-logger = AppLogger().get_logger()
+app_logger = AppLogger()
+logger = app_logger.get_logger()
+dump_logger = DumpLogger(logger)
@@ -2,39 +2,75 @@
 
 import os
 import asyncio
+import contextlib
 
 from logger import logger
 from gateway import CassiaGatewayAsync
 from device_profile import DeviceProfile
+from device_cache import DeviceCache
+from state_store import StateStore
 from task import TaskScheduler
+from test_devices import TestDevices
+from cluster import GatewayCluster
 from http_server import HttpServer
 
 WORKER_NUM = int(os.getenv("WORKER_NUM") or "2")
 BASE_URL = os.getenv("BASE_URL") or "http://10.10.10.254"
 TEST_FILE = os.getenv("TEST_FILE")
 
+# Multiple gateways: BASE_URL=http://<GatewayIP1>,http://<GatewayIP2>
+BASE_URLS = [url.strip() for url in BASE_URL.split(",") if url.strip()]
+
 
 async def main():
     logger.info("app start")
 
     scan_filter = {"filter_name": "BLE_Sample_Dev"}
-    async with CassiaGatewayAsync(BASE_URL, scan_filter) as gateway:
-        # await gateway.init()
+    # Shared by all gateways, a device may be served by any of them
+    device_cache = DeviceCache()
+    state_store = StateStore()
+    # [TEST] One test device list for all gateways
+    test_devices = TestDevices(TEST_FILE) if TEST_FILE else None
+
+    async with contextlib.AsyncExitStack() as stack:
+        nodes = []
+        for base_url in BASE_URLS:
+            gateway = await stack.enter_async_context(
+                CassiaGatewayAsync(base_url, scan_filter)
+            )
+            # await gateway.init()
+
+            device_profile = DeviceProfile(gateway, device_cache, state_store)
+            gateway.reg_notification_handler(device_profile.notifier)
+            gateway.reg_scan_handler(device_profile.scanner)
 
-        device_profile = DeviceProfile(gateway)
-        gateway.reg_notification_handler(device_profile.notifier)
-        gateway.reg_scan_handler(device_profile.scanner)
+            task_scheduler = TaskScheduler(
+                gateway, device_profile, WORKER_NUM, test_devices
+            )
+            gateway.reg_state_handler(task_scheduler.stater)
+            device_profile.reg_scanned_handler(task_scheduler.wakeup)
 
-        task_scheduler = TaskScheduler(gateway, device_profile, WORKER_NUM, TEST_FILE)
-        gateway.reg_state_handler(task_scheduler.stater)
+            nodes.append((gateway, device_profile, task_scheduler))
 
-        gateway_tasks = gateway.run_tasks()
-        scheduler_tasks = task_scheduler.run_tasks()
+        if len(nodes) > 1:
+            cluster = GatewayCluster(nodes)
+            http_server = HttpServer(cluster, cluster)
+        else:
+            gateway, _, task_scheduler = nodes[0]
+            http_server = HttpServer(task_scheduler, gateway)
 
-        http_server = HttpServer(task_scheduler)
-        http_tasks = http_server.run_tasks()
+        # Chip slots held by a previous run are freed before any gateway schedules
+        await asyncio.gather(
+            *(
+                task_scheduler.release_stale_connections()
+                for _, _, task_scheduler in nodes
+            )
+        )
 
-        task_list = gateway_tasks + scheduler_tasks + http_tasks
+        task_list = device_cache.run_tasks() + state_store.run_tasks()
+        for gateway, _, task_scheduler in nodes:
+            task_list += gateway.run_tasks() + task_scheduler.run_tasks()
+        task_list += http_server.run_tasks()
 
         try:
             await asyncio.gather(*task_list)
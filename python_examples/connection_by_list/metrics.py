@@ -0,0 +1,191 @@
+"""Prometheus text-format metrics, updated in place by the scheduler, gateway and waiters.
+
+Served at /metrics. Every update is O(1) (one dict lookup per labelled child), nothing is
+computed from the task table on a scrape.
+"""
+
+import asyncio
+import bisect
+
+import aiohttp
+
+# Seconds, covers a fast connect up to a multi-second log pull
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_str(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    TYPE = ""
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}  # {label values: child}
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        """Child metric of one label set, callers on hot paths keep it"""
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self, values, child):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        for values, child in list(self._children.items()):
+            lines += self._samples(values, child)
+        return lines
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def _samples(self, values, child):
+        return [f"{self.name}{_labels_str(self.labelnames, values)} {child.value}"]
+
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def _samples(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), child.counts):
+            cumulative += count
+            labels = _labels_str(self.labelnames, values, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+        labels = _labels_str(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {child.sum}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+def failure_reason(ex):
+    """Bounded label value of a task failure"""
+    if isinstance(ex, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(ex, aiohttp.ClientError):
+        return "http"
+    return type(ex).__name__
+
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# Task stages, from the task timestamps (see TaskScheduler._tasks_update)
+QUEUE_WAIT = Histogram(
+    "cassia_task_queue_wait_seconds",
+    "Scanned until connect start (scan_ts -> exec_connect_start_ts)",
+    ["gateway"],
+)
+CONNECT_LATENCY = Histogram(
+    "cassia_task_connect_seconds",
+    "Connect start until connected (exec_connect_start_ts -> exec_connect_end_ts)",
+    ["gateway", "chip"],
+)
+DATA_LATENCY = Histogram(
+    "cassia_task_data_seconds",
+    "Log pull of a successful task (exec_data_start_ts -> exec_data_end_ts)",
+    ["gateway", "chip"],
+)
+TASKS_DONE = Counter(
+    "cassia_tasks_done_total", "Finished tasks by result", ["gateway", "state"]
+)
+TASK_FAILURES = Counter(
+    "cassia_task_failures_total", "Failed tasks by reason", ["gateway", "reason"]
+)
+CONNECT_REQUESTS = Counter(
+    "cassia_connect_requests_total",
+    "connect_by_list requests by result",
+    ["gateway", "chip", "result"],
+)
+CHIP_CONNECTIONS = Gauge(
+    "cassia_chip_connections",
+    "Devices holding a connection per chip and priority",
+    ["gateway", "chip", "priority"],
+)
+
+# Gateway streams
+SSE_EVENTS = Counter(
+    "cassia_sse_events_total", "SSE events received", ["gateway", "stream"]
+)
+NOTIFY_SEQ_ERRORS = Counter(
+    "cassia_notify_seq_errors_total",
+    "Notification sequence gaps between gateway and app (devices_seq_stats_gw)",
+    ["gateway"],
+)
+WAIT_TIMEOUTS = Counter("cassia_wait_timeouts_total", "Waiters timed out")
@@ -0,0 +1,415 @@
+"""Mock Cassia gateway emulating BLE_Sample_Dev devices, for benchmarks without BLE hardware.
+
+Emulates the REST/SSE API used by the main flow:
+- /gap/nodes?event=1 scan SSE, devices advertise while not connected
+- POST /gap/connection?chip=X connect_by_list, one request at a time per chip
+- /management/nodes/connection-state connection-state SSE
+- /gatt/nodes?event=1 notification SSE, seqNum per device
+- GATT write of the BLE_Sample_Dev log protocol (notify on, get logs size, get logs)
+- GATT discovery of the log characteristic (DEVICE_CHAR_UUID)
+"""
+
+import os
+import json
+import time
+import random
+import struct
+import asyncio
+
+from aiohttp import web
+
+from logger import logger
+
+MOCK_HOST = os.getenv("MOCK_HOST") or "127.0.0.1"
+MOCK_PORT = int(os.getenv("MOCK_PORT") or "8000")
+MOCK_DEVICES = int(os.getenv("MOCK_DEVICES") or "50")
+# Advertising interval of each device (s)
+MOCK_ADV_INTERVAL = float(os.getenv("MOCK_ADV_INTERVAL") or "0.1")
+# Connect latency: minimum plus an exponential part with this mean (s)
+MOCK_CONNECT_LATENCY_MIN = float(os.getenv("MOCK_CONNECT_LATENCY_MIN") or "0.05")
+MOCK_CONNECT_LATENCY = float(os.getenv("MOCK_CONNECT_LATENCY") or "0.5")
+# Probability that a listed device does not answer a connect request
+MOCK_CONNECT_FAIL = float(os.getenv("MOCK_CONNECT_FAIL") or "0.1")
+# Maximum connections per chip
+MOCK_CHIP_CONNS = int(os.getenv("MOCK_CHIP_CONNS") or "20")
+MOCK_LOGS_SIZE = int(os.getenv("MOCK_LOGS_SIZE") or "20480")
+# Notification throughput per device (bytes/s) and packet size (bytes, header included)
+MOCK_NOTIFY_RATE = int(os.getenv("MOCK_NOTIFY_RATE") or "100000")
+MOCK_PKT_SIZE = int(os.getenv("MOCK_PKT_SIZE") or "244")
+# Probability that the link drops during a log pull
+MOCK_LINK_LOSS = float(os.getenv("MOCK_LINK_LOSS") or "0")
+
+DEVICE_NAME = "BLE_Sample_Dev"
+NOTIFY_DATA_HANDLE = 0x17
+NOTIFY_HANDLE = 0x18
+DEVICE_SERVICE_UUID = "0000fff0-0000-1000-8000-00805f9b34fb"
+DEVICE_CHAR_UUID = "0000fff1-0000-1000-8000-00805f9b34fb"
+CCCD_UUID = "00002902-0000-1000-8000-00805f9b34fb"
+SSE_KEEPALIVE_INTERVAL = 10
+NOTIFY_TICK = 0.01
+
+
+class MockDevice:
+    def __init__(self, mac, logs_size):
+        self.mac = mac
+        self.rssi = random.randint(-90, -40)
+        self.logs_size = logs_size
+        self.next_adv_ts = 0
+        self.connected = False
+        self.chip = None
+        self.notify_on = False
+        self.seq = 0
+        self.transfer = None  # asyncio.Task of the running log pull
+
+
+class SseHub:
+    """Fan-out of events to every open SSE stream of one endpoint"""
+
+    def __init__(self):
+        self._queues = set()
+
+    def __bool__(self):
+        return bool(self._queues)
+
+    def publish(self, data):
+        if not self._queues:
+            return
+        chunk = f"data: {json.dumps(data)}\n\n".encode()
+        for queue in self._queues:
+            queue.put_nowait(chunk)
+
+    async def serve(self, request):
+        resp = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+        )
+        await resp.prepare(request)
+
+        queue = asyncio.Queue()
+        self._queues.add(queue)
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    chunk = b":keep-alive\n\n"
+
+                # Write what has piled up in one go
+                chunks = [chunk]
+                while not queue.empty():
+                    chunks.append(queue.get_nowait())
+                await resp.write(b"".join(chunks))
+        except ConnectionResetError:
+            pass
+        finally:
+            self._queues.discard(queue)
+
+        return resp
+
+
+class MockGateway:
+    def __init__(
+        self,
+        device_cnt=MOCK_DEVICES,
+        adv_interval=MOCK_ADV_INTERVAL,
+        connect_latency_min=MOCK_CONNECT_LATENCY_MIN,
+        connect_latency=MOCK_CONNECT_LATENCY,
+        connect_fail=MOCK_CONNECT_FAIL,
+        chip_conns=MOCK_CHIP_CONNS,
+        logs_size=MOCK_LOGS_SIZE,
+        notify_rate=MOCK_NOTIFY_RATE,
+        pkt_size=MOCK_PKT_SIZE,
+        link_loss=MOCK_LINK_LOSS,
+    ):
+        self.adv_interval = adv_interval
+        self.connect_latency_min = connect_latency_min
+        self.connect_latency = connect_latency
+        self.connect_fail = connect_fail
+        self.chip_conns = chip_conns
+        self.notify_rate = notify_rate
+        self.pkt_size = pkt_size
+        self.link_loss = link_loss
+
+        self.devices = {}
+        for i in range(device_cnt):
+            mac = f"C0:00:00:00:{i >> 8:02X}:{i & 0xFF:02X}"
+            self.devices[mac] = MockDevice(mac, logs_size)
+
+        self._chip_busy = set()
+        self.scan_hub = SseHub()
+        self.state_hub = SseHub()
+        self.notify_hub = SseHub()
+
+        name = DEVICE_NAME.encode()
+        self._ad_data = (
+            bytes.fromhex("020106") + bytes([len(name) + 1, 0x09]) + name
+        ).hex()
+
+        self.stat = {
+            "connect_requests": 0,
+            "connect_busy": 0,
+            "connect_timeouts": 0,
+            "connects": 0,
+            "disconnects": 0,
+            "link_losses": 0,
+            "notify_packets": 0,
+            "discoveries": 0,
+        }
+
+    def _chip_conn_cnt(self, chip):
+        return sum(
+            1 for dev in self.devices.values() if dev.connected and dev.chip == chip
+        )
+
+    def _disconnect(self, dev, reason):
+        if not dev.connected:
+            return
+        dev.connected = False
+        dev.chip = None
+        dev.notify_on = False
+        dev.next_adv_ts = 0
+        if dev.transfer is not None:
+            dev.transfer.cancel()
+            dev.transfer = None
+        self.state_hub.publish(
+            {"handle": dev.mac, "connectionState": "disconnected", "reason": reason}
+        )
+
+    def _notify(self, dev, value):
+        dev.seq += 1
+        self.stat["notify_packets"] += 1
+        self.notify_hub.publish(
+            {
+                "id": dev.mac,
+                "handle": NOTIFY_DATA_HANDLE,
+                "value": value.hex(),
+                "seqNum": dev.seq,
+                "timestamp": int(time.time() * 1000),
+            }
+        )
+
+    async def _advertiser(self):
+        tick = min(self.adv_interval, 0.05)
+        while True:
+            await asyncio.sleep(tick)
+            if not self.scan_hub:
+                continue
+
+            now = time.monotonic()
+            for dev in self.devices.values():
+                if dev.connected or dev.next_adv_ts > now:
+                    continue
+                dev.next_adv_ts = now + self.adv_interval * random.uniform(0.8, 1.2)
+                self.scan_hub.publish(
+                    {
+                        "bdaddrs": [{"bdaddr": dev.mac, "bdaddrType": "random"}],
+                        "rssi": dev.rssi + random.randint(-3, 3),
+                        "adData": self._ad_data,
+                        "name": DEVICE_NAME,
+                        "evtType": 0,
+                    }
+                )
+
+    async def _transfer_logs(self, dev):
+        """Stream the logs as notifications at the configured throughput"""
+        lost_at = (
+            dev.logs_size * random.random()
+            if random.random() < self.link_loss
+            else None
+        )
+        payload = bytes(i & 0xFF for i in range(self.pkt_size))
+        per_tick = max(int(self.notify_rate * NOTIFY_TICK), self.pkt_size)
+
+        offset = 0
+        while offset < dev.logs_size:
+            sent = 0
+            while sent < per_tick and offset < dev.logs_size:
+                if lost_at is not None and offset >= lost_at:
+                    self.stat["link_losses"] += 1
+                    dev.transfer = None
+                    self._disconnect(dev, "timeout")
+                    return
+
+                size = min(self.pkt_size, dev.logs_size - offset)
+                header = b"\xb5\x62\x06" + struct.pack("<I", offset)
+                self._notify(dev, (header + payload)[: max(size, len(header))])
+                offset += size
+                sent += size
+            await asyncio.sleep(NOTIFY_TICK)
+
+        dev.transfer = None
+
+    async def _scan_or_connected(self, request):
+        if request.query.get("event") == "1":
+            return await self.scan_hub.serve(request)
+
+        nodes = [
+            {"bdaddrs": {"bdaddr": dev.mac, "bdaddrType": "random"}, "chipId": dev.chip}
+            for dev in self.devices.values()
+            if dev.connected
+        ]
+        return web.json_response({"nodes": nodes})
+
+    async def _connect_by_list(self, request):
+        chip = int(request.query.get("chip", 0))
+        body = await request.json()
+        self.stat["connect_requests"] += 1
+
+        if chip in self._chip_busy:
+            self.stat["connect_busy"] += 1
+            return web.Response(status=500, text="chip busy")
+        if self._chip_conn_cnt(chip) >= self.chip_conns:
+            self.stat["connect_busy"] += 1
+            return web.Response(status=500, text="chip connection limit")
+
+        self._chip_busy.add(chip)
+        try:
+            timeout = body.get("timeout", 10000) / 1000
+
+            # Each listed device answers after its own latency, the first one wins
+            candidates = []
+            for item in body.get("list", []):
+                dev = self.devices.get(item["addr"])
+                if dev is None or dev.connected or random.random() < self.connect_fail:
+                    continue
+                latency = self.connect_latency_min + random.expovariate(
+                    1 / self.connect_latency
+                )
+                candidates.append((latency, dev.mac))
+
+            latency, mac = min(candidates) if candidates else (timeout, None)
+            await asyncio.sleep(min(latency, timeout))
+
+            dev = self.devices.get(mac)
+            if latency > timeout or dev is None or dev.connected:
+                self.stat["connect_timeouts"] += 1
+                return web.Response(status=500, text="connect timeout")
+
+            dev.connected = True
+            dev.chip = chip
+            dev.seq = 0
+            self.stat["connects"] += 1
+            self.state_hub.publish(
+                {"handle": dev.mac, "connectionState": "connected", "chipId": chip}
+            )
+            return web.json_response({"addr": dev.mac, "chip": chip})
+        finally:
+            self._chip_busy.discard(chip)
+
+    async def _disconnect_node(self, request):
+        dev = self.devices.get(request.match_info["mac"])
+        if dev is None or not dev.connected:
+            return web.Response(status=500, text="device not connected")
+
+        self.stat["disconnects"] += 1
+        self._disconnect(dev, "host")
+        return web.Response(text="OK")
+
+    async def _write_handle(self, request):
+        dev = self.devices.get(request.match_info["mac"])
+        if dev is None or not dev.connected:
+            return web.Response(status=500, text="device not connected")
+
+        handle = int(request.match_info["handle"])
+        value = request.match_info["value"].lower()
+
+        if handle == NOTIFY_HANDLE:
+            dev.notify_on = value == "0100"
+        elif handle == NOTIFY_DATA_HANDLE and dev.notify_on:
+            if value == "b56201":
+                loop = asyncio.get_running_loop()
+                loop.call_later(
+                    0.01, self._notify, dev, struct.pack("<I", dev.logs_size)
+                )
+            elif value == "b56206" and dev.transfer is None:
+                dev.transfer = asyncio.create_task(self._transfer_logs(dev))
+
+        return web.Response(text="OK")
+
+    async def _discover_gatt_all(self, request):
+        dev = self.devices.get(request.match_info["mac"])
+        if dev is None or not dev.connected:
+            return web.Response(status=500, text="device not connected")
+
+        self.stat["discoveries"] += 1
+        # Full discovery takes a few round trips on the air
+        await asyncio.sleep(0.2)
+        characteristic = {
+            "uuid": DEVICE_CHAR_UUID,
+            "handle": NOTIFY_DATA_HANDLE,
+            "properties": 0x1C,
+            "descriptors": [{"uuid": CCCD_UUID, "handle": NOTIFY_HANDLE}],
+        }
+        services = [
+            {
+                "uuid": DEVICE_SERVICE_UUID,
+                "primary": True,
+                "handle": NOTIFY_DATA_HANDLE - 2,
+                "characteristics": [characteristic],
+            }
+        ]
+        return web.json_response(services)
+
+    async def _ok(self, _req):
+        return web.Response(text="OK")
+
+    async def _get_stat(self, _req):
+        return web.json_response(self.stat)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/gap/nodes", self._scan_or_connected)
+        app.router.add_post("/gap/connection", self._connect_by_list)
+        app.router.add_delete("/gap/nodes/{mac}/connection", self._disconnect_node)
+        app.router.add_get(
+            "/gatt/nodes/{mac}/handle/{handle}/value/{value}", self._write_handle
+        )
+        app.router.add_get(
+            "/gatt/nodes/{mac}/services/characteristics/descriptors",
+            self._discover_gatt_all,
+        )
+        app.router.add_get("/gatt/nodes", self.notify_hub.serve)
+        app.router.add_get("/management/nodes/connection-state", self.state_hub.serve)
+        app.router.add_post("/gap/link-track", self._ok)
+        app.router.add_get("/mock/stat", self._get_stat)
+        return app
+
+    async def start(self, host=MOCK_HOST, port=MOCK_PORT):
+        """Serve in the running loop, returns the runner to clean up"""
+        self._advertiser_task = asyncio.create_task(
+            self._advertiser(), name="advertiser"
+        )
+
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        logger.info(
+            "mock gateway start ok: %s %s %s devices", host, port, len(self.devices)
+        )
+        return runner
+
+    async def stop(self, runner):
+        self._advertiser_task.cancel()
+        for dev in self.devices.values():
+            if dev.transfer is not None:
+                dev.transfer.cancel()
+        await runner.cleanup()
+
+
+async def serve():
+    gateway = MockGateway()
+    runner = await gateway.start()
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await gateway.stop(runner)
+
+
+if __name__ == "__main__":
+    """Run a mock gateway, then point the app or the benchmark to it
+
+    MOCK_DEVICES=100 python3 mock_gateway.py
+    BASE_URL=http://127.0.0.1:8000 python3 main.py
+    """
+    asyncio.run(serve())
@@ -0,0 +1,145 @@
+import heapq
+
+from const import DeviceType
+
+
+def device_priority_key(device_info):
+    """High priority first, then devices not served recently, then sensors before gateways,
+    sensors with stronger RSSI first
+
+    RSSI is the smoothed one when available, a single strong report doesn't jump the queue.
+    """
+    is_sensor = device_info["devicetype"] == DeviceType.SENSOR
+    rssi = device_info.get("rssi_avg", device_info["rssi"])
+    return (
+        -device_info["priority"],
+        device_info.get("served_recently", False),
+        not is_sensor,
+        -rssi if is_sensor else 0,
+    )
+
+
+class DeviceReadyQueue:
+    """Indexed priority heap of scanned devices
+
+    - Each MAC has one entry, a scan update moves that entry only: O(log N)
+    - Selection reads the top K entries without popping them: O(K log K)
+    """
+
+    def __init__(self, key=device_priority_key):
+        self._key = key
+        self._heap = []  # [(key, mac)]
+        self._index = {}  # {mac: heap position}
+        self._devices = {}  # {mac: device_info}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, mac):
+        return mac in self._index
+
+    def get(self, mac):
+        return self._devices.get(mac)
+
+    def items(self):
+        return self._devices.items()
+
+    def values(self):
+        return self._devices.values()
+
+    def to_dict(self):
+        return self._devices
+
+    def put(self, device_info):
+        """Add a device, or replace it and move it to its new position"""
+        mac = device_info["mac"]
+        self._devices[mac] = device_info
+        entry = (self._key(device_info), mac)
+
+        pos = self._index.get(mac)
+        if pos is None:
+            self._heap.append(entry)
+            self._index[mac] = len(self._heap) - 1
+            self._sift_up(len(self._heap) - 1)
+        else:
+            self._heap[pos] = entry
+            self._sift(pos)
+
+    def update(self, mac, **fields):
+        """Change fields of a queued device (e.g. priority) and reposition it"""
+        device_info = self._devices.get(mac)
+        if device_info is None:
+            return
+        device_info.update(fields)
+        self.put(device_info)
+
+    def remove(self, mac):
+        pos = self._index.pop(mac, None)
+        if pos is None:
+            return None
+
+        last = self._heap.pop()
+        if pos < len(self._heap):
+            self._heap[pos] = last
+            self._index[last[1]] = pos
+            self._sift(pos)
+
+        return self._devices.pop(mac, None)
+
+    def clear(self):
+        self._heap.clear()
+        self._index.clear()
+        self._devices.clear()
+
+    def top(self, k, skip=None):
+        """Best K devices in priority order (excluding MACs in skip), the queue is left unchanged"""
+        result = []
+        if not self._heap:
+            return result
+
+        heap = self._heap
+        frontier = [(heap[0], 0)]
+        while frontier and len(result) < k:
+            (_, mac), pos = heapq.heappop(frontier)
+            if skip is None or mac not in skip:
+                result.append(self._devices[mac])
+
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+
+        return result
+
+    def _swap(self, i, j):
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self._index[heap[i][1]] = i
+        self._index[heap[j][1]] = j
+
+    def _sift(self, pos):
+        if pos > 0 and self._heap[pos] < self._heap[(pos - 1) // 2]:
+            self._sift_up(pos)
+        else:
+            self._sift_down(pos)
+
+    def _sift_up(self, pos):
+        heap = self._heap
+        while pos > 0:
+            parent = (pos - 1) // 2
+            if not heap[pos] < heap[parent]:
+                break
+            self._swap(pos, parent)
+            pos = parent
+
+    def _sift_down(self, pos):
+        heap = self._heap
+        size = len(heap)
+        while True:
+            smallest = pos
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < size and heap[child] < heap[smallest]:
+                    smallest = child
+            if smallest == pos:
+                break
+            self._swap(pos, smallest)
+            pos = smallest
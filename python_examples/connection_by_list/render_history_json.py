@@ -2,20 +2,32 @@ import json
 import sys
 from enum import IntEnum
 
-
-import plotly.express as px
 import pandas as pd
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-import plotly.io as pio
 
 from logger import logger
+from const import TaskState
+from history_store import TASK_STAGES, ROUND_STAGE, read_history
+
+# One row per task attempt
+TASK_COLUMNS = [
+    "mac",
+    "transition",
+    "attempt",
+    "chip",
+    "state",
+    "scan_ts",
+    "exec_connect_start_ts",
+    "exec_connect_end_ts",
+    "exec_data_start_ts",
+    "exec_data_end_ts",
+]
 
 
 class Stage(IntEnum):
     WAIT_IN_QUEUE = 0
     CONNECT = 1
     GET_LOGS = 2
+    RETRY = 3
 
 
 COLOR_MAP = {
@@ -31,11 +43,134 @@ COLOR_MAP = {
 }
 
 
-def render_info_table(json_data, history_file):
-    worker_num = json_data["worker_num"]
-    all_start = json_data["history"][0]["start_ts"]
-    all_end = json_data["history"][0]["end_ts"]
-    devices = json_data["history"][0]["devices"]
+TRANSITION_LABELS = {
+    "3 -> 2": "[High->Medium]",
+    "2 -> 1": "[Medium->Low]",
+}
+
+# Stage: (start column, end column), retry runs from the first failed attempt
+# until the successful one was queued
+STAGE_SPANS = {
+    Stage.RETRY: ("first_connect_start_ts", "scan_ts"),
+    Stage.WAIT_IN_QUEUE: ("scan_ts", "exec_connect_start_ts"),
+    Stage.CONNECT: ("exec_connect_start_ts", "exec_connect_end_ts"),
+    Stage.GET_LOGS: ("exec_data_start_ts", "exec_data_end_ts"),
+}
+STAGE_NAMES = [stage.name.lower() for stage in STAGE_SPANS]
+
+SUMMARY_PERCENTILES = [0.5, 0.9, 0.99]
+
+
+def load_json_history(history_file):
+    """JSON history -> (all task attempts, round info)"""
+    with open(history_file, "r", encoding="utf-8") as f:
+        json_data = json.load(f)
+
+    history = json_data["history"][0]
+    devices = history["devices"]
+    records = [
+        {**task, "transition": transition, "attempt": attempt}
+        for device in devices.values()
+        for transition in TRANSITION_LABELS
+        for attempt, task in enumerate(device.get(transition) or [])
+    ]
+    tasks = pd.DataFrame.from_records(records, columns=TASK_COLUMNS)
+
+    info = {
+        "worker_num": json_data["worker_num"],
+        "all_start": history["start_ts"],
+        "all_end": history["end_ts"],
+        "devices": len(devices),
+    }
+    return tasks, info
+
+
+def load_arrow_history(history_file):
+    """Arrow IPC history -> (all task attempts, round info)"""
+    df, metadata = read_history(history_file)
+
+    rounds = df[df["stage"] == ROUND_STAGE]
+    stages = df[df["stage"] != ROUND_STAGE]
+
+    # Stage rows back to one row of timestamps per attempt
+    spans = stages.pivot_table(
+        index=["mac", "transition", "attempt", "chip", "state"],
+        columns="stage",
+        values=["start_ts", "end_ts"],
+        aggfunc="first",
+    )
+    tasks = pd.DataFrame(index=spans.index)
+    for stage, start_key, end_key in TASK_STAGES:
+        if ("start_ts", stage) not in spans.columns:
+            continue
+        # Adjacent stages share a timestamp field, a stage the attempt never
+        # reached must not blank the value of the one before it
+        for key, column in ((start_key, "start_ts"), (end_key, "end_ts")):
+            values = spans[(column, stage)]
+            tasks[key] = tasks[key].combine_first(values) if key in tasks else values
+    tasks = tasks.reset_index().reindex(columns=TASK_COLUMNS)
+
+    info = {
+        "worker_num": int(metadata.get("worker_num", 0)),
+        "all_start": float(rounds["start_ts"].iloc[0]),
+        "all_end": float(rounds["end_ts"].iloc[0]),
+        # All configured devices, as the JSON history counts them
+        "devices": int(metadata.get("devices") or stages["mac"].nunique()),
+    }
+    return tasks, info
+
+
+def load_history(history_file):
+    if history_file.endswith(".arrow"):
+        return load_arrow_history(history_file)
+    return load_json_history(history_file)
+
+
+def stage_durations(tasks):
+    """Successful tasks with their stage durations, computed column-wise"""
+    # Stages a failed attempt never reached are 0 (json) or missing (arrow)
+    connect_start = tasks["exec_connect_start_ts"].where(
+        tasks["exec_connect_start_ts"] > 0
+    )
+    group = tasks.groupby(["mac", "transition"])
+    tasks = tasks.assign(
+        first_connect_start_ts=connect_start.groupby(
+            [tasks["mac"], tasks["transition"]]
+        ).transform("min"),
+        attempts=group["attempt"].transform("max") + 1,
+    )
+
+    df = tasks[tasks["state"] == TaskState.SUCCESS].copy()
+    df["first_connect_start_ts"] = df["first_connect_start_ts"].where(
+        (df["attempts"] > 1) & (df["first_connect_start_ts"] < df["scan_ts"]),
+        df["scan_ts"],
+    )
+    for stage, (start_key, end_key) in STAGE_SPANS.items():
+        df[stage.name.lower()] = df[end_key] - df[start_key]
+
+    return df.reset_index(drop=True)
+
+
+def summarize(durations):
+    """Stage duration percentiles per priority transition and chip"""
+    keys = ["transition", "chip"]
+    grouped = durations.groupby(keys)
+
+    df = grouped[STAGE_NAMES].quantile(SUMMARY_PERCENTILES).unstack()
+    df.columns = [f"{stage}_p{int(q * 100)}" for stage, q in df.columns]
+    df.insert(0, "tasks", grouped.size())
+    df.insert(1, "attempts", grouped["attempts"].sum())
+    return df
+
+
+def render_info_table(durations, info, history_file):
+    import plotly.graph_objects as go
+    import plotly.io as pio
+    from plotly.subplots import make_subplots
+
+    worker_num = info["worker_num"]
+    all_start = info["all_start"]
+    all_end = info["all_end"]
 
     fig = make_subplots(
         rows=2,
@@ -44,12 +179,7 @@ def render_info_table(json_data, history_file):
         specs=[[{"type": "domain"}], [{"type": "domain"}]],
     )
 
-    tasks_count = 0
-    for _, v in devices.items():
-        if "3 -> 2" in v:
-            tasks_count = tasks_count + 1
-        if "2 -> 1" in v:
-            tasks_count = tasks_count + 1
+    tasks_count = len(durations)
 
     info_table_header = [
         "worker_num",
@@ -65,7 +195,7 @@ def render_info_table(json_data, history_file):
         worker_num,
         all_start,
         all_end,
-        len(devices),
+        info["devices"],
         tasks_count,
         all_end - all_start,
         (all_end - all_start) / tasks_count,
@@ -96,78 +226,31 @@ def render_info_table(json_data, history_file):
         "getlogs_rate_aver(KB/s)",
     ]
 
+    # Cost aggregates per chip, from the stage durations
+    chips = [0, 1]
+    aggs = ["count", "max", "min", "sum", "mean"]
+    by_chip = durations.groupby("chip")
+    conn = by_chip["connect"].agg(aggs).reindex(chips)
+    getlogs = by_chip["get_logs"].agg(aggs).reindex(chips)
+
+    def column(series):
+        return [None if pd.isna(v) else v for v in series.tolist()]
+
     chip_table_cells = [
-        [0, 1],
-        [0, 0],
-        [None, None],
-        [None, None],
-        [0, 0],
-        [0, 0],
-        [None, None],
-        [None, None],
-        [0, 0],
-        [0, 0],
-        [0, 0],
+        chips,
+        column(conn["count"].fillna(0)),
+        column(conn["max"]),
+        column(conn["min"]),
+        column(conn["sum"].fillna(0)),
+        column(conn["mean"]),
+        column(getlogs["max"]),
+        column(getlogs["min"]),
+        column(getlogs["sum"].fillna(0)),
+        column(getlogs["mean"]),
+        # 1000K / average_cost
+        column(1000 / getlogs["mean"]),
     ]
 
-    for mac, v in devices.items():
-        keys = ["3 -> 2", "2 -> 1"]
-
-        for key in keys:
-            if key in v:
-                success_task = v[key][-1]
-                chip_id = success_task["chip"]
-                conn_cost = (
-                    success_task["exec_connect_end_ts"]
-                    - success_task["exec_connect_start_ts"]
-                )
-                getlogs_cost = (
-                    success_task["exec_data_end_ts"]
-                    - success_task["exec_data_start_ts"]
-                )
-
-                chip_table_cells[1][chip_id] += 1
-
-                if chip_table_cells[2][chip_id] is None:
-                    chip_table_cells[2][chip_id] = conn_cost
-                else:
-                    chip_table_cells[2][chip_id] = max(
-                        chip_table_cells[2][chip_id], conn_cost
-                    )
-
-                if chip_table_cells[3][chip_id] is None:
-                    chip_table_cells[3][chip_id] = conn_cost
-                else:
-                    chip_table_cells[3][chip_id] = min(
-                        chip_table_cells[3][chip_id], conn_cost
-                    )
-                chip_table_cells[4][chip_id] += conn_cost
-
-                if chip_table_cells[6][chip_id] is None:
-                    chip_table_cells[6][chip_id] = getlogs_cost
-                else:
-                    chip_table_cells[6][chip_id] = max(
-                        chip_table_cells[6][chip_id], getlogs_cost
-                    )
-
-                if chip_table_cells[7][chip_id] is None:
-                    chip_table_cells[7][chip_id] = getlogs_cost
-                else:
-                    chip_table_cells[7][chip_id] = min(
-                        chip_table_cells[7][chip_id], getlogs_cost
-                    )
-                chip_table_cells[8][chip_id] += getlogs_cost
-
-    chip_table_cells[5][0] = chip_table_cells[4][0] / chip_table_cells[1][0]
-    chip_table_cells[5][1] = chip_table_cells[4][1] / chip_table_cells[1][1]
-
-    chip_table_cells[9][0] = chip_table_cells[8][0] / chip_table_cells[1][0]
-    chip_table_cells[9][1] = chip_table_cells[8][1] / chip_table_cells[1][1]
-
-    # 1000K / average_cost
-    chip_table_cells[10][0] = 1000 / chip_table_cells[9][0]
-    chip_table_cells[10][1] = 1000 / chip_table_cells[9][1]
-
     fig.add_trace(
         go.Table(
             header=dict(
@@ -184,63 +267,36 @@ def render_info_table(json_data, history_file):
     pio.write_html(fig, file=f"{history_file}.info_table.html", auto_open=True)
 
 
-def render_tasks_timeline_chart(devices, history_file):
-    if not devices:
+def render_tasks_timeline_chart(durations, history_file):
+    import plotly.express as px
+    import plotly.io as pio
+
+    if durations.empty:
         logger.info("no devices, do nothing")
         return
 
-    tasks_list = []
-
-    for mac, device in devices.items():
-        priority_update_str_map = {
-            "3 -> 2": "[High->Medium]",
-            "2 -> 1": "[Medium->Low]",
-        }
-
-        for key, val in device.items():
-            priority_update_str = priority_update_str_map.get(key, None)
-            if priority_update_str is not None:
-                # TODO: fail retries stats
-                task = val[-1]
-
-                tasks_list.append(
-                    {
-                        "task": f"{mac}-{priority_update_str}",
-                        "start": task["scan_ts"],
-                        "end": task["exec_connect_start_ts"],
-                        "stage": Stage.WAIT_IN_QUEUE,
-                        "priority_stage_str": f"{priority_update_str} wait_in_queue",
-                        "chip": task["chip"],
-                        "cost": task["exec_connect_start_ts"] - task["scan_ts"],
-                    }
-                )
-
-                tasks_list.append(
-                    {
-                        "task": f"{mac}-{priority_update_str}",
-                        "start": task["exec_connect_start_ts"],
-                        "end": task["exec_connect_end_ts"],
-                        "stage": Stage.CONNECT,
-                        "priority_stage_str": f"{priority_update_str} connect",
-                        "chip": task["chip"],
-                        "cost": task["exec_connect_end_ts"]
-                        - task["exec_connect_start_ts"],
-                    }
-                )
-
-                tasks_list.append(
-                    {
-                        "task": f"{mac}-{priority_update_str}",
-                        "start": task["exec_data_start_ts"],
-                        "end": task["exec_data_end_ts"],
-                        "stage": Stage.GET_LOGS,
-                        "priority_stage_str": f"{priority_update_str} get_logs",
-                        "chip": task["chip"],
-                        "cost": task["exec_data_end_ts"] - task["exec_data_start_ts"],
-                    }
-                )
-
-    df = pd.DataFrame(tasks_list)
+    # One bar per stage, retry only for tasks that took more than one attempt
+    label = durations["transition"].map(TRANSITION_LABELS)
+    retried = durations["attempts"] > 1
+    segments = []
+    for stage, (start_key, end_key) in STAGE_SPANS.items():
+        rows = retried if stage == Stage.RETRY else slice(None)
+        name = stage.name.lower()
+        segments.append(
+            pd.DataFrame(
+                {
+                    "task": durations["mac"] + "-" + label,
+                    "start": durations[start_key],
+                    "end": durations[end_key],
+                    "stage": int(stage),
+                    "priority_stage_str": label + " " + name,
+                    "chip": durations["chip"],
+                    "cost": durations[name],
+                }
+            )[rows]
+        )
+
+    df = pd.concat(segments, ignore_index=True)
     df = df.sort_values(by=["stage", "start"], ascending=[False, True])
 
     unique_tasks = df["task"].drop_duplicates().tolist()
@@ -249,9 +305,6 @@ def render_tasks_timeline_chart(devices, history_file):
     df["start_fmt"] = pd.to_datetime(df["start"].astype(float), unit="s")
     df["end_fmt"] = pd.to_datetime(df["end"].astype(float), unit="s")
 
-    df_str = df.to_string(formatters={"start": "{:.6f}".format, "end": "{:.6f}".format})
-    logger.info(f"\n{df_str}")
-
     fig = px.timeline(
         df,
         x_start="start_fmt",
@@ -292,29 +345,41 @@ def render_tasks_timeline_chart(devices, history_file):
     )
 
 
-def render(history_file):
-    logger.info(f"history json file path: {history_file}")
+def render_summary(history_file):
+    """Text tables only, plotly is not needed"""
+    tasks, info = load_history(history_file)
+    durations = stage_durations(tasks)
+
+    cost = info["all_end"] - info["all_start"]
+    print(
+        f"worker_num: {info['worker_num']}, devices: {info['devices']}, "
+        f"tasks: {len(durations)}, attempts: {len(tasks)}, cost(s): {cost:.3f}"
+    )
+    with pd.option_context("display.width", 250, "display.max_columns", None):
+        print(summarize(durations).round(3).to_string())
 
-    with open(history_file, "r", encoding="utf-8") as f:
-        json_str = f.read()
 
-        json_data = json.loads(json_str)
-        render_info_table(json_data, history_file)
+def render(history_file):
+    logger.info(f"history file path: {history_file}")
 
-        devices = json_data["history"][0]["devices"]
-        render_tasks_timeline_chart(devices, history_file)
+    tasks, info = load_history(history_file)
+    durations = stage_durations(tasks)
+    render_info_table(durations, info, history_file)
+    render_tasks_timeline_chart(durations, history_file)
 
 
 if __name__ == "__main__":
-    history_file = None
-
-    if len(sys.argv) > 1:
-        history_file = sys.argv[1]
+    args = sys.argv[1:]
+    summary_only = "--summary" in args
+    args = [arg for arg in args if arg != "--summary"]
 
-    if history_file is None:
+    if not args:
         logger.warning(
-            "Usage: python3 render_history_json ./test_devices_yyyymmddhhMMss.json"
+            "Usage: python3 render_history_json [--summary] ./test_devices_history_yyyymmddhhMMss.(arrow|json)"
         )
         exit()
 
-    render(history_file)
+    if summary_only:
+        render_summary(args[0])
+    else:
+        render(args[0])
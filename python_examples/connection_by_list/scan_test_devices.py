@@ -15,9 +15,8 @@ TEST_FILE = os.getenv("TEST_FILE") or "./test_devices.json"
 devices = {}
 
 
-def scanner(event):
-    logger.info(f"scan sse event: {event}")
-    scan_data = json.loads(event.data)
+def scanner(scan_data):
+    logger.info(f"scan sse event: {scan_data}")
     mac = scan_data["bdaddrs"][0]["bdaddr"]
 
     if mac not in devices:
@@ -0,0 +1,151 @@
+"""Scheduler state per MAC kept across restarts: an append-only JSONL journal, compacted.
+
+{mac: {"state", "done_ts", "success_ts", "priority"}}
+
+"priority" is the one the device was last served at.
+"""
+
+import os
+import json
+import asyncio
+
+import aiofiles
+
+from logger import logger
+from util import get_timestamp
+
+STATE_FILE = os.getenv("STATE_FILE") or "scheduler_state.jsonl"
+# A device that succeeded this recently before a restart is queued after the others of its
+# priority (s)
+STATE_RECENT_SUCCESS = float(os.getenv("STATE_RECENT_SUCCESS") or "300")
+
+
+class StateStore:
+    """Every change appends one line {"mac", ...fields}, the latest line of a MAC wins on load
+
+    - Lines are written in batches every FLUSH_INTERVAL
+    - The journal is rewritten with one line per MAC once it holds COMPACT_RATIO times more
+    """
+
+    def __init__(self, file_name=STATE_FILE, recent_success=STATE_RECENT_SUCCESS):
+        """file_name: None keeps the state in memory only"""
+        self.FLUSH_INTERVAL = 1
+        self.COMPACT_RATIO = 4
+        self.COMPACT_MIN_LINES = 1000
+
+        self.file_name = file_name
+        self.recent_success = recent_success
+        self.devices = {}
+        # Last success of the devices as loaded at startup: {mac: (success_ts, priority)}
+        self._restored = {}
+        self._pending = []
+        self._lines = 0
+        # The last line was cut by a crash, the next append starts on a new line
+        self._torn = False
+
+        self.load()
+
+    def load(self):
+        if not self.file_name or not os.path.exists(self.file_name):
+            return
+
+        with open(self.file_name, "r", encoding="utf-8") as f:
+            for line in f:
+                self._torn = not line.endswith("\n")
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut by a crash while appending
+                    logger.warning("state journal line skipped: %s", line[:64])
+                    continue
+                self.devices.setdefault(record.pop("mac"), {}).update(record)
+                self._lines += 1
+
+        # Only what was served before the restart, successes of this run don't reorder
+        self._restored = {
+            mac: (device["success_ts"], device.get("priority"))
+            for mac, device in self.devices.items()
+            if device.get("success_ts")
+        }
+
+        logger.info(
+            "state load ok: %s %s devices, %s lines",
+            self.file_name,
+            len(self.devices),
+            self._lines,
+        )
+
+    def get(self, mac):
+        return self.devices.get(mac)
+
+    def served_recently(self, mac, priority, now=None):
+        """Succeeded shortly before the restart at this priority or a higher one, a device
+        asking for more than it was served at is not held back"""
+        restored = self._restored.get(mac)
+        if restored is None:
+            return False
+        success_ts, served_priority = restored
+        if served_priority is not None and priority > served_priority:
+            return False
+        now = now if now is not None else get_timestamp()
+        return now - success_ts < self.recent_success
+
+    def macs_in_state(self, state):
+        return [
+            mac for mac, device in self.devices.items() if device.get("state") == state
+        ]
+
+    def update(self, mac, **fields):
+        self.devices.setdefault(mac, {}).update(fields)
+        if self.file_name:
+            self._pending.append({"mac": mac, **fields})
+
+    async def flush(self):
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, []
+        text = "".join(json.dumps(record) + "\n" for record in pending)
+        if self._torn:
+            text = "\n" + text
+            self._torn = False
+        async with aiofiles.open(self.file_name, "a") as f:
+            await f.write(text)
+        self._lines += len(pending)
+
+        limit = self.COMPACT_RATIO * len(self.devices) + self.COMPACT_MIN_LINES
+        if self._lines > limit:
+            await self.compact()
+
+    async def compact(self):
+        """Snapshot: one line per MAC, replaces the journal at once"""
+        tmp_file = f"{self.file_name}.tmp"
+        text = "".join(
+            json.dumps({"mac": mac, **device}) + "\n"
+            for mac, device in self.devices.items()
+        )
+        async with aiofiles.open(tmp_file, "w") as f:
+            await f.write(text)
+        os.replace(tmp_file, self.file_name)
+        self._torn = False
+
+        logger.info("state compact ok: %s lines -> %s", self._lines, len(self.devices))
+        self._lines = len(self.devices)
+
+    async def _writer(self):
+        try:
+            while True:
+                await asyncio.sleep(self.FLUSH_INTERVAL)
+                try:
+                    await self.flush()
+                except Exception as ex:
+                    logger.warning("state flush failed: %s", ex)
+        finally:
+            await self.flush()
+
+    def run_tasks(self):
+        if not self.file_name:
+            return []
+        return [
+            asyncio.create_task(self._writer(), name="state_store"),
+        ]
@@ -1,10 +1,12 @@
-import json
+import logging
 import asyncio
 
-from logger import logger
-from const import DeviceType, ChipId, TaskPriority, TaskState
+import metrics
+from logger import logger, dump_logger
+from const import ChipId, TaskPriority, TaskState
 from util import get_timestamp
 from gateway import CassiaGatewayAsync
+from adaptive import AdaptiveConnectController
 from device_profile import DeviceProfile
 from test_devices import TestDevices
 
@@ -15,27 +17,43 @@ class TaskScheduler:
         gateway: CassiaGatewayAsync,
         device_profile: DeviceProfile,
         worker_cnt,
-        test_file,
+        test_devices: TestDevices = None,
     ):
         self._gateway = gateway
         self._device_profile = device_profile
 
         self._worker_cnt = worker_cnt
         self._worker_queue = asyncio.Queue(maxsize=worker_cnt)
+        self.CONNECT_LIST_MAX = 8
 
         self._tasks_lock = asyncio.Lock()
         self.devices_task = {}
+        self.tasks_stat = self._tasks_stat_init()
 
-        # [TEST] Test Devices
-        self.test_devices: TestDevices = None
+        # Pipelined connection: at most one outstanding connect_by_list per chip
+        self._connecting = {}  # {chip: asyncio.Task}
+        self._connecting_macs = {}  # {mac: chip}
+        # Disconnects of late connected devices, referenced until they finish
+        self._disconnecting = set()  # {asyncio.Task}
 
-        if test_file:
-            self.test_devices = TestDevices(test_file)
+        # connect_by_list list length/timeout per chip and PHY per device
+        self._connect_ctl = AdaptiveConnectController(device_profile.device_cache)
 
-    def _tasks_add(self, mac, priority):
+        # Scheduler wakeup: new scanned device, worker released, chip load changed
+        self.IDLE_WAKEUP_INTERVAL = 1
+        self._schedule_event = asyncio.Event()
+
+        # Called with every finished (SUCCESS/FAILED) task, e.g. benchmark statistics
+        self.done_handler = None
+
+        # [TEST] Test Devices, one list shared by all the schedulers of a cluster
+        self.test_devices = test_devices
+
+    def _tasks_add(self, mac, priority, addr_type="random"):
         self.devices_task[mac] = {
             "mac": mac,
             "priority": priority,
+            "addr_type": addr_type,
             "chip": ChipId.NOP,
             "state": TaskState.INIT,
             "type": "get_logs",
@@ -48,7 +66,7 @@ class TaskScheduler:
             "exec_data_end_ts": 0,
             "exec_done_ts": 0,
         }
-        logger.debug(f"[{mac}] task add: {priority}")
+        logger.debug("[%s] task add: %s", mac, priority)
 
     def _tasks_get(self, mac):
         return self.devices_task.get(mac)
@@ -62,54 +80,87 @@ class TaskScheduler:
         state=None,
         chip=None,
     ):
-        logger.info(f"[{mac}] task update: state={state}, chip={chip}")
+        logger.info("[%s] task update: state=%s, chip=%s", mac, state, chip)
+        task = self.devices_task[mac]
 
         if state is not None:
-            pre_state = self.devices_task[mac]["state"]
+            pre_state = task["state"]
 
             if pre_state > state and state > TaskState.CONNECT_START:
                 logger.warning(
-                    f"[{mac}] task state update ignore: {pre_state} -> {state}?"
+                    "[%s] task state update ignore: %s -> %s?", mac, pre_state, state
                 )
                 return
 
-            self.devices_task[mac]["state"] = state
-            logger.info(f"[{mac}] task state update ok: {pre_state} -> {state}")
+        self._tasks_stat_count(task, -1)
+
+        if state is not None:
+            task["state"] = state
+            logger.info("[%s] task state update ok: %s -> %s", mac, pre_state, state)
 
             ts = get_timestamp()
             if state == TaskState.CONNECT_START:
-                self.devices_task[mac]["exec_start_ts"] = ts
-                self.devices_task[mac]["exec_connect_start_ts"] = ts
+                # A task back to INIT after a lost connect list keeps its first start
+                if not task["exec_start_ts"]:
+                    task["exec_start_ts"] = ts
+                task["exec_connect_start_ts"] = ts
             elif state == TaskState.CONNECTED:
-                self.devices_task[mac]["exec_connect_end_ts"] = ts
+                task["exec_connect_end_ts"] = ts
             elif state == TaskState.EXECUTING:
-                self.devices_task[mac]["exec_data_start_ts"] = ts
+                task["exec_data_start_ts"] = ts
             elif state == TaskState.SUCCESS:
-                self.devices_task[mac]["exec_data_end_ts"] = ts
-                self.devices_task[mac]["exec_done_ts"] = ts
+                task["exec_data_end_ts"] = ts
+                task["exec_done_ts"] = ts
             elif state == TaskState.FAILED:
-                self.devices_task[mac]["exec_data_end_ts"] = ts
-                self.devices_task[mac]["exec_done_ts"] = ts
+                task["exec_data_end_ts"] = ts
+                task["exec_done_ts"] = ts
                 pass
 
         if chip is not None:
-            self.devices_task[mac]["chip"] = chip
+            task["chip"] = chip
+
+        self._tasks_stat_count(task, 1)
+
+        if state is not None and state != pre_state:
+            self._tasks_metrics(task)
+
+        # Chip load is counted from CONNECTED on, let the scheduler re-evaluate
+        if state == TaskState.CONNECTED:
+            self.wakeup()
 
     async def _tasks_update_with_lock(self, mac, state=None, chip=None):
         async with self._tasks_lock:
             return self._tasks_update(mac, state=state, chip=chip)
 
     def _tasks_remove(self, mac):
-        self.devices_task.pop(mac, None)
-        logger.debug(f"[{mac}] task remove")
+        task = self.devices_task.pop(mac, None)
+        if task is not None:
+            self._tasks_stat_count(task, -1)
+        logger.debug("[%s] task remove", mac)
+        self.wakeup()
+        return task
 
     async def _tasks_remove_with_lock(self, mac):
         async with self._tasks_lock:
-            logger.info(f"[{mac}] task remove with lock")
-            return self.devices_task.pop(mac, None)
+            logger.info("[%s] task remove with lock", mac)
+            return self._tasks_remove(mac)
+
+    def reg_done_handler(self, handler):
+        self.done_handler = handler
 
-    async def _tasks_stat_with_lock(self):
-        tasks_stat = {
+    def task_active(self, mac):
+        """The device is being connected or served by this scheduler"""
+        task = self._tasks_get(mac)
+        return task is not None and task["state"] > TaskState.INIT
+
+    def load(self):
+        """Share of the workers held by connections and outstanding connects"""
+        tasks_stat = self._tasks_stat()
+        total = tasks_stat[ChipId.H0]["total"] + tasks_stat[ChipId.H1]["total"]
+        return (total + len(self._connecting)) / self._worker_cnt
+
+    def _tasks_stat_init(self):
+        return {
             ChipId.H0: {
                 TaskPriority.HIGH: 0,
                 TaskPriority.MEDIUM: 0,
@@ -123,18 +174,85 @@ class TaskScheduler:
                 "total": 0,
             },
         }
-        async with self._tasks_lock:
-            json_str = json.dumps(self.devices_task)
-            logger.info(f"devices task: {len(self.devices_task)} {json_str}")
 
-            for _, task in self.devices_task.items():
-                if task["state"] >= TaskState.CONNECTED:
-                    chip = ChipId(task["chip"])
-                    priority = TaskPriority(task["priority"])
-                    tasks_stat[chip][priority] += 1
-                    tasks_stat[chip]["total"] += 1
+    def _tasks_stat_count(self, task, delta):
+        """Adjust the chip counters of a task holding a connection (state >= CONNECTED)"""
+        if task["state"] < TaskState.CONNECTED:
+            return
 
-        return tasks_stat
+        chip_stat = self.tasks_stat.get(task["chip"])
+        if chip_stat is None:
+            return
+
+        priority = TaskPriority(task["priority"])
+        chip_stat[priority] += delta
+        chip_stat["total"] += delta
+
+        metrics.CHIP_CONNECTIONS.labels(
+            self._gateway.base_url, int(task["chip"]), priority.name.lower()
+        ).inc(delta)
+
+    def _tasks_metrics(self, task):
+        """Stage latencies of a task that just entered its state, from the task timestamps"""
+        gateway = self._gateway.base_url
+        state = task["state"]
+
+        # Queue wait once per task, not on each connect list it is put back into
+        if (
+            state == TaskState.CONNECT_START
+            and task["exec_start_ts"] == task["exec_connect_start_ts"]
+        ):
+            metrics.QUEUE_WAIT.labels(gateway).observe(
+                task["exec_connect_start_ts"] - task["scan_ts"]
+            )
+        elif state == TaskState.CONNECTED:
+            metrics.CONNECT_LATENCY.labels(gateway, int(task["chip"])).observe(
+                task["exec_connect_end_ts"] - task["exec_connect_start_ts"]
+            )
+        elif state == TaskState.SUCCESS:
+            metrics.DATA_LATENCY.labels(gateway, int(task["chip"])).observe(
+                task["exec_data_end_ts"] - task["exec_data_start_ts"]
+            )
+            metrics.TASKS_DONE.labels(gateway, "success").inc()
+        elif state == TaskState.FAILED:
+            metrics.TASKS_DONE.labels(gateway, "failed").inc()
+
+    def _tasks_stat(self):
+        """Per chip/priority counters, maintained by _tasks_update/_tasks_remove"""
+        return self.tasks_stat
+
+    def _state_save(self, task):
+        """Outcome of a finished task, reloaded at startup (StateStore)"""
+        fields = {"state": int(task["state"]), "done_ts": task["exec_done_ts"]}
+        if task["state"] == TaskState.SUCCESS:
+            fields["success_ts"] = task["exec_done_ts"]
+            fields["priority"] = int(task["priority"])
+        self._device_profile.state_store.update(task["mac"], **fields)
+
+    async def release_stale_connections(self):
+        """Devices a previous run left connected hold chip slots on the gateway, disconnect them
+
+        Awaited before run_tasks, the scheduler starts with the chip slots free.
+        """
+        state_store = self._device_profile.state_store
+        for mac in state_store.macs_in_state(TaskState.CONNECTED):
+            if self._tasks_has(mac):
+                continue
+            logger.warning("[%s] connected before restart, disconnect", mac)
+            await self._gateway.disconnect_ignore_ex(mac)
+            # Queued again while disconnecting, the task owns the state now
+            if self._tasks_has(mac):
+                continue
+            state_store.update(mac, state=int(TaskState.FAILED))
+
+    def snapshot(self):
+        """Full task table for debugging, serialised by the caller outside of the task lock"""
+        return {
+            "tasks_stat": self._tasks_stat(),
+            "devices_task": self.devices_task,
+            "scanned_devices": self._device_profile.get_scanned_devices().to_dict(),
+            "connect_ctl": self._connect_ctl.snapshot(),
+        }
 
     async def _worker(self):
         """Worker coroutine
@@ -144,34 +262,42 @@ class TaskScheduler:
         while True:
             mac = await self._worker_queue.get()
 
-            logger.info(f"[{mac}] do device task start")
+            logger.info("[%s] do device task start", mac)
             await self._tasks_update_with_lock(mac=mac, state=TaskState.EXECUTING)
 
             # Execute the work task. Regardless of success or failure, immediately release the task and wait for the broadcast trigger
             try:
+                # Disconnected while waiting for a worker
+                if self._tasks_get(mac)["state"] == TaskState.FAILED:
+                    raise Exception("device disconnected before execution")
+
                 await self._device_profile.task_get_logs(mac)
                 await self._tasks_update_with_lock(mac=mac, state=TaskState.SUCCESS)
             except Exception as ex:
-                logger.info(f"task failed: {mac} {ex}")
+                logger.info("task failed: %s %s", mac, ex)
+                # Already failed by the connection-state SSE
+                if self._tasks_get(mac)["state"] == TaskState.FAILED:
+                    reason = "disconnected"
+                else:
+                    reason = metrics.failure_reason(ex)
+                metrics.TASK_FAILURES.labels(self._gateway.base_url, reason).inc()
                 await self._tasks_update_with_lock(mac=mac, state=TaskState.FAILED)
             finally:
                 await self._gateway.disconnect_ignore_ex(mac)
                 task = await self._tasks_remove_with_lock(mac)
+                if task is not None:
+                    self._state_save(task)
+                if self.done_handler is not None and task is not None:
+                    self.done_handler(task)
                 if self.test_devices is not None:
                     self.test_devices.update_by_done_task(task)
 
     def _sort_devices(self, scanned_devices):
-        """Devices scanned in this cycle, prioritize sorting"""
-        sorted_devices = sorted(
-            scanned_devices.values(),
-            key=lambda x: (
-                x["priority"] != TaskPriority.HIGH,
-                x["devicetype"] != DeviceType.SENSOR,
-                x["priority"] != TaskPriority.MEDIUM,
-                (-x["rssi"] if x["devicetype"] == DeviceType.SENSOR else 0),
-            ),
-        )
-        return sorted_devices
+        """Devices scanned in this cycle, best candidates first (see ready_queue.device_priority_key)
+
+        Devices already in an outstanding connect list are skipped.
+        """
+        return scanned_devices.top(self.CONNECT_LIST_MAX, skip=self._connecting_macs)
 
     async def _select_connect_chip_and_devices(self, scanned_devices):
         """Select devices and allocate chip for connection.
@@ -179,28 +305,28 @@ class TaskScheduler:
         This implementation targets dual-chip gateways (e.g. E1000) with priority-based scheduling.
         For single-chip gateways, you can simplify this to always return (ChipId.H0, sorted_devices).
         """
-        tasks_stat = await self._tasks_stat_with_lock()
+        tasks_stat = self._tasks_stat()
 
-        json_str = json.dumps(tasks_stat)
-        logger.info(f"task stat: {json_str}")
+        dump_logger.dump("task stat", tasks_stat)
 
         sorted_devices = self._sort_devices(scanned_devices)
-        json_str = json.dumps(sorted_devices)
-        logger.info(f"scanned devices sorted: {json_str}")
+        dump_logger.dump("scanned devices top", sorted_devices)
 
         # The number of work tasks exceeds the number of workers
+        # Each outstanding connect may hand over one more device, reserve a worker for it
         total = tasks_stat[ChipId.H0]["total"] + tasks_stat[ChipId.H1]["total"]
+        total += len(self._connecting)
         if total >= self._worker_cnt:
-            logger.warning(f"exceed max worker, wait...: {total} {self._worker_cnt}")
-            return (ChipId.NOP, [])
+            logger.warning("exceed max worker, wait...: %s %s", total, self._worker_cnt)
+            return (ChipId.NOP, [], None)
 
         # Both chips are busy with high-priority tasks, no allocation processing will be done
         if (
             tasks_stat[ChipId.H1][TaskPriority.HIGH] > 0
             and tasks_stat[ChipId.H0][TaskPriority.HIGH] > 0
         ):
-            logger.warning(f"exceed high priority max count, wait...")
-            return (ChipId.NOP, [])
+            logger.warning("exceed high priority max count, wait...")
+            return (ChipId.NOP, [], None)
 
         # If there are high-priority tasks, process the high-priority tasks first
         highs = []
@@ -211,18 +337,19 @@ class TaskScheduler:
             elif device_info["priority"] == TaskPriority.MEDIUM:
                 mediums.append(device_info)
 
-        alloc_chip = ChipId.NOP
+        chips = []
         devices = []
 
         if len(highs) > 0:
             # High-priority chip allocation: each chip can handle a maximum of 1 task, with chip1 having a higher priority than chip0
             devices = highs
-            if tasks_stat[ChipId.H1][TaskPriority.HIGH] <= 0:
-                alloc_chip = ChipId.H1
-            elif tasks_stat[ChipId.H0][TaskPriority.HIGH] <= 0:
-                alloc_chip = ChipId.H0
-            else:
-                logger.warning(f"all chip has high task")
+            chips = [
+                chip
+                for chip in (ChipId.H1, ChipId.H0)
+                if tasks_stat[chip][TaskPriority.HIGH] <= 0
+            ]
+            if not chips:
+                logger.warning("all chip has high task")
         elif len(mediums) > 0:
             devices = mediums
 
@@ -231,39 +358,53 @@ class TaskScheduler:
                 and tasks_stat[ChipId.H1][TaskPriority.HIGH] <= 0
             ):
                 # Chip0 is busy with high-priority tasks, so temporarily choose chip1 to process low-priority tasks
-                alloc_chip = ChipId.H1
+                chips = [ChipId.H1]
             elif (
                 tasks_stat[ChipId.H1][TaskPriority.HIGH] > 0
                 and tasks_stat[ChipId.H0][TaskPriority.HIGH] <= 0
             ):
                 # Chip1 is busy with high-priority tasks, so temporarily choose chip0 to process low-priority tasks
-                alloc_chip = ChipId.H0
+                chips = [ChipId.H0]
             else:
                 # There are no high-priority tasks being processed currently. Choose the chip with fewer connections, prioritizing chip1
                 if tasks_stat[ChipId.H0]["total"] >= tasks_stat[ChipId.H1]["total"]:
-                    alloc_chip = ChipId.H1
+                    chips = [ChipId.H1, ChipId.H0]
                 else:
-                    alloc_chip = ChipId.H0
+                    chips = [ChipId.H0, ChipId.H1]
         else:
-            logger.warning(f"no devices task")
+            logger.warning("no devices task")
 
-        return (alloc_chip, devices[:8])
+        # A chip with an outstanding connect_by_list is busy, fall back to the next allowed chip
+        chips = [chip for chip in chips if chip not in self._connecting]
+        if not chips:
+            return (ChipId.NOP, [], None)
 
-    async def _connect_by_list(self, chip, devices):
-        """Connect using the batch list API (gateway.connect_by_list).
+        alloc_chip = chips[0]
 
-        If your gateway does not support connect_by_list, replace
-        gateway.connect_by_list() with gateway.connect(mac) to connect
-        devices one at a time.
-        """
+        # One PHY per connect_by_list request: the devices on the PHY of the best candidate,
+        # the list length is tuned per chip
+        phy, macs = self._connect_ctl.group_by_phy([x["mac"] for x in devices])
+        macs = set(macs)
+        devices = [x for x in devices if x["mac"] in macs]
+        devices = devices[: self._connect_ctl.batch_size(alloc_chip)]
+
+        return (alloc_chip, devices, phy)
+
+    async def _connect_start(self, chip, devices, phy):
+        """Register the connect list and run connect_by_list in the background"""
         connect_list = []
+        device_cache = self._device_profile.device_cache
 
         async with self._tasks_lock:
             for device_info in devices:
                 mac = device_info["mac"]
                 task = self._tasks_get(mac)
                 if task is None:
-                    self._tasks_add(mac, device_info["priority"])
+                    # The type a past session connected with, else the advertised one
+                    addr_type = device_cache.addr_type(
+                        mac, device_info.get("type") or "random"
+                    )
+                    self._tasks_add(mac, device_info["priority"], addr_type)
                     self._tasks_update(mac, state=TaskState.CONNECT_START, chip=chip)
                     connect_list.append(mac)
                 elif task["state"] < TaskState.CONNECTED:
@@ -274,33 +415,125 @@ class TaskScheduler:
                     continue
 
         if not connect_list:
-            logger.info(f"connect list empty")
-            return None
+            logger.info("connect list empty")
+            return
 
-        """Connect by List(Sync)"""
+        for mac in connect_list:
+            self._connecting_macs[mac] = chip
+
+        addr_types = {mac: self._tasks_get(mac)["addr_type"] for mac in connect_list}
+        self._connecting[chip] = asyncio.create_task(
+            self._connect_by_list(
+                chip,
+                connect_list,
+                timeout=self._connect_ctl.timeout(chip),
+                phy=phy,
+                addr_types=addr_types,
+            ),
+            name=f"connector{int(chip)}",
+        )
+
+    def _connected(self, mac, chip):
+        """Hand a connected device over to the workers, only once per connect"""
+        task = self._tasks_get(mac)
+        if task is None or task["state"] >= TaskState.CONNECTED:
+            return
+
+        self._tasks_update(mac=mac, state=TaskState.CONNECTED, chip=chip)
+        self._connect_ctl.on_connected(
+            chip, mac, task["exec_connect_end_ts"] - task["exec_connect_start_ts"]
+        )
+        # Released at startup if the process stops before the task is done
+        self._device_profile.state_store.update(mac, state=int(TaskState.CONNECTED))
+        # Trusted on the next visits once the session succeeds (DeviceProfile.task_get_logs)
+        device_cache = self._device_profile.device_cache
+        device_cache.update(mac, addr_type=task["addr_type"])
+        # Only a fallback PHY is worth remembering, connecting on the default clears it
+        fallback = self._connect_ctl.is_fallback(mac)
+        device_cache.set_phy(mac, self._connect_ctl.phy(mac) if fallback else None)
+        self._device_profile.remove_scanned_device(mac)
+        # A worker has been reserved for every outstanding connect
+        self._worker_queue.put_nowait(mac)
+
+    async def _connect_by_list(self, chip, connect_list, timeout, phy, addr_types):
+        """Connect using the batch list API (gateway.connect_by_list).
+
+        The device may already have been handed over by the connection-state SSE.
+        If your gateway does not support connect_by_list, replace
+        gateway.connect_by_list() with gateway.connect(mac) to connect
+        devices one at a time.
+        """
         connected_mac = ""
         try:
-            ret = await self._gateway.connect_by_list(connect_list, int(chip))
-            connected_mac = ret["addr"]
-        except Exception as ex:
-            logger.info(f"connect by list failed: {ex}")
+            try:
+                ret = await self._gateway.connect_by_list(
+                    connect_list,
+                    int(chip),
+                    timeout=timeout,
+                    phy=phy,
+                    addr_types=addr_types,
+                )
+                connected_mac = ret["addr"]
+            except Exception as ex:
+                logger.info("connect by list failed: %s", ex)
 
-        await self._tasks_lock.acquire()
+            async with self._tasks_lock:
+                self._connect_done(chip, connect_list, connected_mac)
+        except Exception as ex:
+            logger.error("connect by list done failed: %s %s", chip, ex)
+        finally:
+            # Whatever failed above, the chip must not stay reserved
+            for mac in connect_list:
+                self._connecting_macs.pop(mac, None)
+            self._connecting.pop(chip, None)
+            # The chip is free for the next connect_by_list
+            self.wakeup()
+
+    def _connect_done(self, chip, connect_list, connected_mac):
+        """Hand over the connected device, put the others back to INIT (under the task lock)"""
+        if connected_mac:
+            self._connected(connected_mac, chip)
+
+        connected = bool(connected_mac)
+        attempted = []
         for mac in connect_list:
-            if mac == connected_mac:
-                self._tasks_update(mac=mac, state=TaskState.CONNECTED, chip=chip)
-            else:
+            task = self._tasks_get(mac)
+            if task is None:
+                continue
+            if task["state"] == TaskState.CONNECT_START:
                 self._tasks_update(mac, state=TaskState.INIT)
-        self._tasks_lock.release()
+                attempted.append(mac)
+            else:
+                # Handed over by the connection-state SSE
+                connected = connected or task["state"] >= TaskState.CONNECTED
+
+        self._connect_ctl.on_connect_done(chip, attempted, connected)
+        metrics.CONNECT_REQUESTS.labels(
+            self._gateway.base_url, int(chip), "ok" if connected else "failed"
+        ).inc()
 
-        return connected_mac
+    def wakeup(self, *_):
+        """Trigger a scheduling round as soon as possible"""
+        self._schedule_event.set()
+
+    async def _wait_wakeup(self):
+        """Wait for a scheduling event, fall back to a periodic round so that failed connects are retried"""
+        try:
+            await asyncio.wait_for(
+                self._schedule_event.wait(), self.IDLE_WAKEUP_INTERVAL
+            )
+        except asyncio.TimeoutError:
+            pass
+        self._schedule_event.clear()
 
     async def _scheduler(self):
-        """Connection scheduling"""
+        """Connection scheduling, driven by scan/worker/chip load events"""
         while True:
             try:
+                await self._wait_wakeup()
                 logger.info("=============================================")
 
+                coalesced = self._device_profile.flush_scanned_devices()
                 scanned_devices = self._device_profile.get_scanned_devices()
 
                 if self.test_devices is not None:
@@ -308,36 +541,80 @@ class TaskScheduler:
                         scanned_devices
                     )
 
-                json_str = json.dumps(scanned_devices)
-                logger.info(f"scanned devices: {len(scanned_devices)} {json_str}")
+                logger.info(
+                    "scanned devices: %s updated: %s", len(scanned_devices), coalesced
+                )
+                dump_logger.dump("scanned devices", scanned_devices.to_dict())
 
                 if not scanned_devices:
-                    await asyncio.sleep(0.5)
                     continue
 
-                (chip, devices) = await self._select_connect_chip_and_devices(
+                (chip, devices, phy) = await self._select_connect_chip_and_devices(
                     scanned_devices
                 )
-                json_str = json.dumps(devices)
-                logger.info(f"scanned devices selected: {chip} {json_str}")
+                if logger.isEnabledFor(logging.INFO):
+                    macs = [device_info["mac"] for device_info in devices]
+                    logger.info("scanned devices selected: %s %s", chip, macs)
 
                 if not devices or chip == ChipId.NOP:
-                    await asyncio.sleep(0.5)
                     continue
 
-                connected_mac = await self._connect_by_list(chip, devices)
-                if connected_mac is None:
-                    await asyncio.sleep(1)
-                elif connected_mac:
-                    self._device_profile.remove_scanned_device(connected_mac)
-                    await self._worker_queue.put(connected_mac)
-                    await asyncio.sleep(1)
+                await self._connect_start(chip, devices, phy)
             except Exception as ex:
-                logger.error(f"schedule task failed:", ex)
+                logger.error("schedule task failed: %s", ex)
                 self._device_profile.clear_scanned_devices()
 
-    async def stater(self, event):
-        logger.info(f"state sse event: {event.data}")
+    async def _state_connected(self, mac):
+        task = self._tasks_get(mac)
+        if task is None or task["state"] >= TaskState.CONNECTED:
+            return
+
+        chip = self._connecting_macs.get(mac)
+        if chip is not None:
+            # Completes an outstanding connect before its HTTP response
+            self._connected(mac, chip)
+            return
+
+        # Late connect: the connect_by_list request has already given up on it
+        tasks_stat = self._tasks_stat()
+        total = tasks_stat[ChipId.H0]["total"] + tasks_stat[ChipId.H1]["total"]
+        if total + len(self._connecting) < self._worker_cnt:
+            logger.info("[%s] late connected, execute on chip %s", mac, task["chip"])
+            self._connected(mac, task["chip"])
+        else:
+            logger.warning("[%s] late connected, no free worker, disconnect", mac)
+            disconnect = asyncio.create_task(
+                self._gateway.disconnect_ignore_ex(mac), name=f"disconnect-{mac}"
+            )
+            self._disconnecting.add(disconnect)
+            disconnect.add_done_callback(self._disconnecting.discard)
+
+    def _state_disconnected(self, mac, reason):
+        task = self._tasks_get(mac)
+        if task is None:
+            return
+
+        state = task["state"]
+        if state not in (TaskState.CONNECTED, TaskState.EXECUTING):
+            return
+
+        # Fail the task now instead of waiting for the GATT timeouts, the worker releases it
+        self._tasks_update(mac, state=TaskState.FAILED)
+        if state == TaskState.EXECUTING:
+            self._device_profile.device_disconnected(mac, reason)
+
+    async def stater(self, data):
+        """Connection-state SSE, drives the task state of connecting/connected devices"""
+        logger.info("state sse event: %s", data)
+
+        mac = data.get("handle")
+        connection_state = data.get("connectionState")
+
+        async with self._tasks_lock:
+            if connection_state == "connected":
+                await self._state_connected(mac)
+            elif connection_state == "disconnected":
+                self._state_disconnected(mac, data.get("reason"))
 
     def run_tasks(self):
         task_list = [
@@ -4,10 +4,11 @@ import asyncio
 
 import aiofiles
 
-from logger import logger
+from logger import logger, dump_logger
 from const import DeviceType, TaskPriority, TaskState
 from util import get_timestamp
 from util import get_timestamp_str
+import history_store
 
 # Execution rounds: 0 - repeat execution, others - specific rounds
 TEST_ROUND = int(os.getenv("TEST_ROUND") or "1")
@@ -25,6 +26,9 @@ class TestDevices:
 
         self._run_counter = 0
 
+        # Columnar history (one row per task stage) when pyarrow is available, else JSON
+        self._history_writer = None
+
         with open(json_file, "r") as file:
             self.json_raw = file.read()
             self.devices = json.loads(self.json_raw)
@@ -40,14 +44,37 @@ class TestDevices:
                 "start_ts": self.start_ts,
                 "end_ts": self.end_ts,
                 "used_sec": self.used_sec,
+                # With the columnar history the tasks are in the file, the devices keep
+                # their priority and attempt count per transition
                 "devices": self.devices,
             }
         )
         if len(self.history) > 10:
             self.history.pop(0)
 
+    def _history_writer_get(self):
+        if self._history_writer is None:
+            file_name = f"../result/test_devices_history_{get_timestamp_str()}.arrow"
+            metadata = {
+                "worker_num": self.history_get()["worker_num"],
+                "test_round": TEST_ROUND,
+                "devices": len(self.devices),
+            }
+            self._history_writer = history_store.HistoryWriter(file_name, metadata)
+        return self._history_writer
+
     async def _history_save(self):
         """Save historical results to a file"""
+        if history_store.available():
+            writer = self._history_writer_get()
+            writer.add_round(self._run_counter, self.start_ts, self.end_ts)
+            self._history_writer = None
+            # The file I/O stays off the event loop
+            await asyncio.to_thread(writer.write)
+            self.history[-1]["file"] = writer.file_name
+            logger.info(f"[TEST] save history file ok: {writer.file_name}")
+            return writer.file_name
+
         ts_str = get_timestamp_str()
         file_name = f"../result/test_devices_history_{ts_str}.json"
         json_str = json.dumps(self.history_get(), indent=4)
@@ -77,18 +104,21 @@ class TestDevices:
         """Mock scan data based on the test status"""
         no_permit_list = []
 
-        for mac, val in scanned_devices.items():
+        for mac in list(scanned_devices.to_dict()):
             mock_device = self.devices.get(mac)
             logger.info(f"[TEST] [{mac}] update device info by mock: {mock_device}")
             if mock_device is not None:
-                val["priority"] = mock_device["priority"] or TaskPriority.HIGH
-                val["devicetype"] = mock_device["devicetype"] or DeviceType.SENSOR
+                scanned_devices.update(
+                    mac,
+                    priority=mock_device["priority"] or TaskPriority.HIGH,
+                    devicetype=mock_device["devicetype"] or DeviceType.SENSOR,
+                )
             else:
                 logger.warning(f"[TEST] [{mac}] no mock device")
                 no_permit_list.append(mac)
 
         for mac in no_permit_list:
-            scanned_devices.pop(mac, None)
+            scanned_devices.remove(mac)
             logger.warning(f"[TEST] [{mac}] no permit device")
 
     def history_get(self):
@@ -109,11 +139,18 @@ class TestDevices:
         if task["state"] == TaskState.SUCCESS:
             device["priority"] = device["priority"] - 1
 
-        self.devices[mac].setdefault(stat_key, []).append(task)
+        if history_store.available():
+            # Stage rows go to the history file, the device keeps an attempt count
+            attempt = device.get(stat_key, 0)
+            writer = self._history_writer_get()
+            writer.add_task(self._run_counter, stat_key, attempt, task)
+            device[stat_key] = attempt + 1
+        else:
+            self.devices[mac].setdefault(stat_key, []).append(task)
 
     async def check_reset_or_mock_scanned_devices(self, scanned_devices):
         logger.info(f"[TEST] all mocked state")
-        logger.info(f"{json.dumps(self.devices)}")
+        dump_logger.dump("[TEST] devices", self.devices)
 
         if self._is_all_priority_low():
             self._history_append()
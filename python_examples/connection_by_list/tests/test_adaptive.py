@@ -0,0 +1,83 @@
+from adaptive import AdaptiveConnectController
+from const import ChipId
+from device_cache import DeviceCache
+
+
+def test_batch_size_starts_full_and_grows_back_after_failures():
+    ctl = AdaptiveConnectController()
+    assert ctl.batch_size(ChipId.H0) == ctl.BATCH_MAX
+
+    for _ in range(20):
+        ctl.on_connect_done(ChipId.H0, ["C0:00:00:00:00:01"], False)
+    assert ctl.batch_size(ChipId.H0) == ctl.BATCH_MIN
+
+    for _ in range(40):
+        ctl.on_connected(ChipId.H0, "C0:00:00:00:00:01", 0.5)
+        ctl.on_connect_done(ChipId.H0, [], True)
+    assert ctl.batch_size(ChipId.H0) == ctl.BATCH_MAX
+    # The other chip is tuned on its own
+    assert ctl.batch_size(ChipId.H1) == ctl.BATCH_MAX
+
+
+def test_batch_size_halves_while_connects_fail():
+    ctl = AdaptiveConnectController()
+    for _ in range(20):
+        ctl.on_connect_done(ChipId.H0, [], True)
+    for _ in range(20):
+        ctl.on_connect_done(ChipId.H0, ["C0:00:00:00:00:01"], False)
+    assert ctl.batch_size(ChipId.H0) == ctl.BATCH_MIN
+    assert ctl.timeout(ChipId.H0) == ctl.TIMEOUT_MAX
+
+
+def test_list_failure_is_shared_by_the_attempted_devices():
+    ctl = AdaptiveConnectController()
+    macs = [f"C0:00:00:00:00:{i:02X}" for i in range(4)]
+    for _ in range(ctl.PHY_FALLBACK_FAILS):
+        ctl.on_connect_done(ChipId.H0, macs, False)
+    assert all(ctl.phy(mac) == ctl.PHY_DEFAULT for mac in macs)
+
+    # Alone in its lists, a device falls back after PHY_FALLBACK_FAILS failures
+    for _ in range(ctl.PHY_FALLBACK_FAILS):
+        ctl.on_connect_done(ChipId.H0, macs[:1], False)
+    assert ctl.phy(macs[0]) == ctl.PHY_FALLBACK
+    assert ctl.phy(macs[1]) == ctl.PHY_DEFAULT
+
+
+def test_fallback_retries_default_phy_after_interval():
+    ctl = AdaptiveConnectController()
+    mac = "C0:00:00:00:00:01"
+    for _ in range(ctl.PHY_FALLBACK_FAILS):
+        ctl.on_connect_done(ChipId.H0, [mac], False)
+    assert ctl.phy(mac) == ctl.PHY_FALLBACK
+
+    ctl.devices[mac]["fallback_ts"] -= ctl.PHY_RETRY_INTERVAL + 1
+    assert ctl.phy(mac) == ctl.PHY_DEFAULT
+
+
+def test_group_by_phy_keeps_order_of_first_device_phy():
+    ctl = AdaptiveConnectController()
+    slow = "C0:00:00:00:00:02"
+    for _ in range(ctl.PHY_FALLBACK_FAILS):
+        ctl.on_connect_done(ChipId.H0, [slow], False)
+
+    macs = ["C0:00:00:00:00:01", slow, "C0:00:00:00:00:03"]
+    assert ctl.group_by_phy(macs) == ("2M", [macs[0], macs[2]])
+    assert ctl.group_by_phy(macs[1:]) == ("1M", [slow])
+
+
+def test_cached_fallback_phy_expires():
+    device_cache = DeviceCache(file_name=None)
+    ctl = AdaptiveConnectController(device_cache)
+    mac = "C0:00:00:00:00:01"
+    device_cache.on_success(mac)
+    device_cache.set_phy(mac, ctl.PHY_FALLBACK)
+    assert ctl.phy(mac) == ctl.PHY_FALLBACK
+
+    # Cached in an earlier session, longer ago than the retry interval
+    ctl = AdaptiveConnectController(device_cache)
+    device_cache.devices[mac]["phy_ts"] -= ctl.PHY_RETRY_INTERVAL + 1
+    assert ctl.phy(mac) == ctl.PHY_DEFAULT
+
+    # Connecting on the default PHY clears the cached fallback
+    device_cache.set_phy(mac, None)
+    assert device_cache.phy(mac) == (None, 0)
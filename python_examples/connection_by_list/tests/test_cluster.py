@@ -0,0 +1,113 @@
+import asyncio
+
+from cluster import GatewayCluster
+from device_profile import DeviceProfile
+from task import TaskScheduler
+
+
+class FakeGateway:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.scan_handler = None
+
+    def reg_scan_handler(self, handler):
+        self.scan_handler = handler
+
+
+def _adv(mac, rssi):
+    return {
+        "bdaddrs": [{"bdaddr": mac, "bdaddrType": "random"}],
+        "rssi": rssi,
+        "adData": "0201",
+    }
+
+
+def _queued(device_profile, mac):
+    return mac in device_profile.scan_pending or mac in device_profile.scanned_devices
+
+
+def _cluster():
+    nodes = []
+    for base_url in ("http://a", "http://b"):
+        gateway = FakeGateway(base_url)
+        device_profile = DeviceProfile(gateway)
+        nodes.append(
+            (gateway, device_profile, TaskScheduler(gateway, device_profile, 2))
+        )
+    return GatewayCluster(nodes), nodes
+
+
+def _saturate(cluster, task_scheduler):
+    task_scheduler.load = lambda: cluster.SATURATION_LOAD
+
+
+def test_every_gateway_saturated_best_rssi_wins():
+    async def run():
+        cluster, nodes = _cluster()
+        for _, _, task_scheduler in nodes:
+            _saturate(cluster, task_scheduler)
+
+        # A new device is queued even though every gateway is busy
+        nodes[0][0].scan_handler(_adv("C0:00:00:00:00:01", -70))
+        assert cluster.snapshot()["owners"]["C0:00:00:00:00:01"] == "http://a"
+        assert _queued(nodes[0][1], "C0:00:00:00:00:01")
+
+        # Within the hysteresis the owner keeps it
+        nodes[1][0].scan_handler(_adv("C0:00:00:00:00:01", -67))
+        assert cluster.snapshot()["owners"]["C0:00:00:00:00:01"] == "http://a"
+
+        # Heard clearly better elsewhere, it moves
+        nodes[1][0].scan_handler(_adv("C0:00:00:00:00:01", -60))
+        assert cluster.snapshot()["owners"]["C0:00:00:00:00:01"] == "http://b"
+        assert _queued(nodes[1][1], "C0:00:00:00:00:01")
+        assert not _queued(nodes[0][1], "C0:00:00:00:00:01")
+
+    asyncio.run(run())
+
+
+def test_saturated_owner_hands_device_to_free_gateway():
+    async def run():
+        cluster, nodes = _cluster()
+        nodes[0][0].scan_handler(_adv("C0:00:00:00:00:01", -60))
+        assert cluster.snapshot()["owners"]["C0:00:00:00:00:01"] == "http://a"
+
+        _saturate(cluster, nodes[0][2])
+        nodes[1][0].scan_handler(_adv("C0:00:00:00:00:01", -70))
+        assert cluster.snapshot()["owners"]["C0:00:00:00:00:01"] == "http://b"
+        assert _queued(nodes[1][1], "C0:00:00:00:00:01")
+
+    asyncio.run(run())
+
+
+def test_load_counts_busy_workers_not_queued_devices():
+    async def run():
+        _, nodes = _cluster()
+        gateway, device_profile, task_scheduler = nodes[0]
+        for i in range(20):
+            gateway.scan_handler(_adv(f"C0:00:00:00:00:{i:02X}", -60))
+        device_profile.flush_scanned_devices()
+        assert task_scheduler.load() == 0
+
+        task_scheduler._connecting[0] = None
+        assert task_scheduler.load() == 0.5
+
+    asyncio.run(run())
+
+
+def test_devices_not_heard_are_forgotten():
+    async def run():
+        cluster, nodes = _cluster()
+        nodes[0][0].scan_handler(_adv("C0:00:00:00:00:01", -60))
+        nodes[0][1].flush_scanned_devices()
+
+        for readings in cluster._rssi.values():
+            for index, (rssi, ts) in readings.items():
+                readings[index] = (rssi, ts - cluster.DEVICE_EXPIRE - 1)
+        cluster._prune_ts = 0
+        nodes[0][0].scan_handler(_adv("C0:00:00:00:00:02", -60))
+
+        assert list(cluster.snapshot()["owners"]) == ["C0:00:00:00:00:02"]
+        assert list(cluster._rssi) == ["C0:00:00:00:00:02"]
+        assert not _queued(nodes[0][1], "C0:00:00:00:00:01")
+
+    asyncio.run(run())
@@ -0,0 +1,58 @@
+import asyncio
+import struct
+
+from device_profile import DeviceProfile
+
+MAC = "C0:00:00:00:00:01"
+
+
+class FakeGateway:
+    base_url = "http://fake"
+
+
+def _pkt(offset, size):
+    """Log packet: 3 bytes header, 4 bytes offset, payload; size bytes in total"""
+    hdr = bytes([0xB5, 0x62, 0x06]) + struct.pack("<I", offset)
+    return (hdr + bytes((offset + i) % 251 for i in range(size)))[:size]
+
+
+def _pull(logs_size, packets):
+    async def run():
+        device_profile = DeviceProfile(FakeGateway())
+        device_profile._logs_buf_alloc(MAC, logs_size)
+        future = device_profile.devices_waiter.add(
+            device_profile.gatt_gen_id(MAC, "gatt_get_logs"), timeout=1
+        )
+        for offset, size in packets:
+            device_profile._get_logs_res(MAC, _pkt(offset, size))
+        await asyncio.sleep(0)
+        done = future.done()
+        device_profile.devices_waiter._timer.cancel()
+        return done, device_profile.devices_logs_buf.get(MAC)
+
+    return asyncio.run(run())
+
+
+def test_overlapping_retransmission_does_not_complete_with_gaps():
+    # 0-20 and 20-40 arrive, then a retransmission 10-30, 40-60 is missing
+    done, logs_buf = _pull(60, [(0, 20), (10, 20), (20, 20)])
+    assert not done
+    assert logs_buf["received"] == 40
+
+    done, _ = _pull(60, [(0, 20), (10, 20), (20, 20), (40, 20)])
+    assert done
+
+
+def test_duplicates_and_out_of_order_packets():
+    done, logs_buf = _pull(50, [(20, 20), (0, 20), (20, 20), (0, 20)])
+    assert not done and logs_buf["received"] == 40
+
+    # The last packet may run past the logs size
+    done, _ = _pull(50, [(20, 20), (0, 20), (40, 20)])
+    assert done
+
+
+def test_in_order_packets_keep_one_interval():
+    done, logs_buf = _pull(100, [(0, 20), (20, 20), (40, 20)])
+    assert not done
+    assert (logs_buf["received_starts"], logs_buf["received_ends"]) == ([0], [60])
@@ -0,0 +1,71 @@
+import random
+
+from const import DeviceType, TaskPriority
+from ready_queue import DeviceReadyQueue, device_priority_key
+
+
+def _device(rng, mac):
+    return {
+        "mac": mac,
+        "priority": rng.choice(list(TaskPriority)),
+        "devicetype": rng.choice(list(DeviceType)),
+        "rssi": rng.randint(-100, -30),
+        "served_recently": rng.random() < 0.2,
+    }
+
+
+def _expected(devices, k, skip=()):
+    ordered = sorted(
+        (x for x in devices.values() if x["mac"] not in skip),
+        key=lambda x: (device_priority_key(x), x["mac"]),
+    )
+    return [x["mac"] for x in ordered[:k]]
+
+
+def test_top_matches_sorted_after_random_operations():
+    rng = random.Random(1)
+    queue = DeviceReadyQueue()
+    devices = {}
+
+    for _ in range(3000):
+        mac = f"C0:00:00:00:00:{rng.randrange(64):02X}"
+        op = rng.random()
+        if op < 0.5:
+            devices[mac] = _device(rng, mac)
+            queue.put(devices[mac])
+        elif op < 0.75:
+            if mac in devices:
+                rssi = rng.randint(-100, -30)
+                queue.update(mac, rssi=rssi, rssi_avg=rssi)
+        else:
+            assert (queue.remove(mac) is not None) == (mac in devices)
+            devices.pop(mac, None)
+
+        assert len(queue) == len(devices)
+        k = rng.randint(1, 10)
+        assert [x["mac"] for x in queue.top(k)] == _expected(devices, k)
+
+
+def test_top_skip_leaves_queue_unchanged():
+    rng = random.Random(2)
+    queue = DeviceReadyQueue()
+    devices = {}
+    for i in range(20):
+        mac = f"C0:00:00:00:01:{i:02X}"
+        devices[mac] = _device(rng, mac)
+        queue.put(devices[mac])
+
+    skip = set(_expected(devices, 3))
+    assert [x["mac"] for x in queue.top(5, skip=skip)] == _expected(devices, 5, skip)
+    assert [x["mac"] for x in queue.top(20)] == _expected(devices, 20)
+
+
+def test_update_unknown_and_clear():
+    queue = DeviceReadyQueue()
+    queue.update("C0:00:00:00:00:01", rssi=-40)
+    assert len(queue) == 0 and queue.top(3) == []
+
+    queue.put(_device(random.Random(3), "C0:00:00:00:00:01"))
+    assert "C0:00:00:00:00:01" in queue
+    queue.clear()
+    assert len(queue) == 0 and queue.top(3) == []
@@ -0,0 +1,149 @@
+import json
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import history_store
+from const import TaskState
+from render_history_json import load_arrow_history, load_json_history, stage_durations
+
+START_TS = 1000.0
+
+
+def _task(
+    mac, chip, state, scan, connect_start=0, connect_end=0, data_start=0, data_end=0
+):
+    return {
+        "mac": mac,
+        "chip": chip,
+        "state": state,
+        "scan_ts": scan,
+        "exec_connect_start_ts": connect_start,
+        "exec_connect_end_ts": connect_end,
+        "exec_data_start_ts": data_start,
+        "exec_data_end_ts": data_end,
+    }
+
+
+def _devices():
+    t = START_TS
+    return {
+        # Succeeds at once
+        "C0:00:00:00:00:01": {
+            "3 -> 2": [
+                _task(
+                    "C0:00:00:00:00:01",
+                    0,
+                    TaskState.SUCCESS,
+                    t,
+                    t + 1,
+                    t + 2,
+                    t + 2,
+                    t + 5,
+                )
+            ],
+        },
+        # Connect timeout, then a failed data transfer, then a success
+        "C0:00:00:00:00:02": {
+            "3 -> 2": [
+                _task("C0:00:00:00:00:02", 1, TaskState.FAILED, t, t + 2),
+                _task(
+                    "C0:00:00:00:00:02",
+                    1,
+                    TaskState.FAILED,
+                    t + 10,
+                    t + 11,
+                    t + 12,
+                    t + 12,
+                    t + 13,
+                ),
+                _task(
+                    "C0:00:00:00:00:02",
+                    0,
+                    TaskState.SUCCESS,
+                    t + 20,
+                    t + 22,
+                    t + 23,
+                    t + 23,
+                    t + 30,
+                ),
+            ],
+            "2 -> 1": [
+                _task(
+                    "C0:00:00:00:00:02",
+                    1,
+                    TaskState.SUCCESS,
+                    t + 40,
+                    t + 41,
+                    t + 43,
+                    t + 43,
+                    t + 44,
+                )
+            ],
+        },
+        # Configured but never done
+        "C0:00:00:00:00:03": {},
+    }
+
+
+@pytest.fixture
+def histories(tmp_path):
+    devices = _devices()
+
+    json_file = tmp_path / "history.json"
+    history = {"start_ts": START_TS, "end_ts": START_TS + 50, "devices": devices}
+    json_file.write_text(json.dumps({"worker_num": 2, "history": [history]}))
+
+    arrow_file = str(tmp_path / "history.arrow")
+    metadata = {"worker_num": 2, "devices": len(devices)}
+    writer = history_store.HistoryWriter(arrow_file, metadata)
+    for device in devices.values():
+        for transition, tasks in device.items():
+            for attempt, task in enumerate(tasks):
+                writer.add_task(0, transition, attempt, task)
+    writer.add_round(0, START_TS, START_TS + 50)
+    writer.write()
+
+    return str(json_file), arrow_file
+
+
+def _sorted(durations):
+    return durations.sort_values(["mac", "transition"]).reset_index(drop=True)
+
+
+def test_arrow_and_json_stage_durations_equal(histories):
+    json_file, arrow_file = histories
+    json_tasks, json_info = load_json_history(json_file)
+    arrow_tasks, arrow_info = load_arrow_history(arrow_file)
+
+    assert arrow_info == json_info
+    assert json_info["devices"] == 3
+
+    columns = [
+        "mac",
+        "transition",
+        "attempts",
+        "retry",
+        "wait_in_queue",
+        "connect",
+        "get_logs",
+    ]
+    json_durations = _sorted(stage_durations(json_tasks))[columns]
+    arrow_durations = _sorted(stage_durations(arrow_tasks))[columns]
+    assert len(json_durations) == 3
+    pd.testing.assert_frame_equal(arrow_durations, json_durations, check_dtype=False)
+
+
+def test_arrow_keeps_shared_timestamps_of_unfinished_stages(histories):
+    _, arrow_file = histories
+    tasks, _ = load_arrow_history(arrow_file)
+
+    # The connect timeout has a wait_in_queue row but no connect row
+    failed = tasks[
+        (tasks["mac"] == "C0:00:00:00:00:02")
+        & (tasks["transition"] == "3 -> 2")
+        & (tasks["attempt"] == 0)
+    ]
+    assert failed["exec_connect_start_ts"].tolist() == [START_TS + 2]
@@ -0,0 +1,83 @@
+import asyncio
+import json
+
+from const import TaskPriority, TaskState
+from state_store import StateStore
+
+
+def _records(file_name):
+    with open(file_name, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_journal_latest_line_wins(tmp_path):
+    file_name = str(tmp_path / "state.jsonl")
+    store = StateStore(file_name)
+    store.update("A", state=int(TaskState.CONNECTED))
+    store.update("B", state=int(TaskState.SUCCESS), success_ts=100.0, priority=3)
+    store.update("A", state=int(TaskState.FAILED), done_ts=90.0)
+    asyncio.run(store.flush())
+
+    loaded = StateStore(file_name)
+    assert loaded.devices == {
+        "A": {"state": int(TaskState.FAILED), "done_ts": 90.0},
+        "B": {"state": int(TaskState.SUCCESS), "success_ts": 100.0, "priority": 3},
+    }
+    assert loaded.macs_in_state(TaskState.FAILED) == ["A"]
+
+
+def test_torn_last_line_skipped_and_next_append_on_new_line(tmp_path):
+    file_name = str(tmp_path / "state.jsonl")
+    with open(file_name, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"mac": "A", "state": int(TaskState.CONNECTED)}) + "\n")
+        f.write('{"mac": "B", "sta')
+
+    store = StateStore(file_name)
+    assert list(store.devices) == ["A"]
+
+    store.update("C", state=int(TaskState.SUCCESS))
+    asyncio.run(store.flush())
+
+    loaded = StateStore(file_name)
+    assert sorted(loaded.devices) == ["A", "C"]
+    assert not loaded._torn
+
+
+def test_compaction_keeps_one_line_per_mac(tmp_path):
+    file_name = str(tmp_path / "state.jsonl")
+    store = StateStore(file_name)
+    store.COMPACT_MIN_LINES = 10
+
+    async def run():
+        for i in range(30):
+            store.update(f"M{i % 3}", state=int(TaskState.SUCCESS), done_ts=float(i))
+            await store.flush()
+
+    asyncio.run(run())
+
+    records = _records(file_name)
+    assert len(records) < 30
+    loaded = StateStore(file_name)
+    assert loaded.devices == store.devices
+    assert loaded.devices["M2"]["done_ts"] == 29.0
+
+
+def test_served_recently_only_before_restart(tmp_path):
+    file_name = str(tmp_path / "state.jsonl")
+    store = StateStore(file_name, recent_success=300)
+    store.update("A", success_ts=1000.0, priority=int(TaskPriority.MEDIUM))
+    # Served in this run, the steady-state order is left alone
+    assert not store.served_recently("A", TaskPriority.MEDIUM, now=1100.0)
+    asyncio.run(store.flush())
+
+    store = StateStore(file_name, recent_success=300)
+    assert store.served_recently("A", TaskPriority.MEDIUM, now=1100.0)
+    assert store.served_recently("A", TaskPriority.LOW, now=1100.0)
+    # Asks for more than it was served at
+    assert not store.served_recently("A", TaskPriority.HIGH, now=1100.0)
+    assert not store.served_recently("A", TaskPriority.MEDIUM, now=1400.0)
+    assert not store.served_recently("B", TaskPriority.MEDIUM, now=1100.0)
+
+    # Served again after the restart, still ordered by the restored state only
+    store.update("A", success_ts=1200.0, priority=int(TaskPriority.LOW))
+    assert not store.served_recently("A", TaskPriority.MEDIUM, now=1350.0)
@@ -1,36 +1,75 @@
 import asyncio
+import heapq
+import itertools
 import time
 
+import metrics
 from logger import logger
 
 
 class WaitFuture:
+    """Waiters with inactivity timeouts
+
+    - Deadlines are kept in a heap, the timer sleeps until the earliest one
+    - refresh() only moves the deadline in last_active: O(1), the heap entry is re-queued
+      lazily when it reaches the top; entries of ended waiters are dropped the same way
+    """
+
     def __init__(self):
-        self.CHECK_INTERVAL = 1
+        # Rebuild the heap when stale entries outnumber the live ones by this factor
+        self.COMPACT_RATIO = 2
 
         self.waits = {}
-        self.last_active = {}  # {id: (last_time, timeout)}
+        self.last_active = {}  # {id: [deadline, timeout, seq]}
+        self._deadlines = []  # heap [(deadline, seq, id)]
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
         self.loop = asyncio.get_event_loop()
         self._timer = self.loop.create_task(self._timer_checker())
 
     async def _timer_checker(self):
-        """Check the cycle and adjust based on the actual situation"""
+        """Sleep until the next deadline, or until an earlier one is added"""
         while True:
-            now = time.monotonic()
-            expired_ids = []
+            delay = self._expire(time.monotonic())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _expire(self, now):
+        """Time out the due waiters, return the delay to the next deadline (None if no waiter)"""
+        heap = self._deadlines
+        while heap:
+            deadline, seq, id = heap[0]
+            active = self.last_active.get(id)
+
+            if active is None or active[2] != seq:
+                # Ended, or re-added with a new entry
+                heapq.heappop(heap)
+            elif active[0] > deadline:
+                # Refreshed since the entry was pushed
+                heapq.heapreplace(heap, (active[0], seq, id))
+            elif deadline > now:
+                return deadline - now
+            else:
+                heapq.heappop(heap)
+                self._handle_timeout(id)
 
-            for id, (last_time, timeout) in self.last_active.items():
-                if now - last_time >= timeout:
-                    expired_ids.append(id)
+        return None
 
-            for id in expired_ids:
-                self._handle_timeout(id)
+    def _compact(self):
+        if len(self._deadlines) <= self.COMPACT_RATIO * len(self.last_active) + 64:
+            return
 
-            logger.info("wait timer checker")
-            await asyncio.sleep(self.CHECK_INTERVAL)
+        self._deadlines = [
+            (deadline, seq, id) for id, (deadline, _, seq) in self.last_active.items()
+        ]
+        heapq.heapify(self._deadlines)
 
     def _handle_timeout(self, id):
-        logger.warning(f"[{id}] wait handle timeout")
+        logger.warning("[%s] wait handle timeout", id)
+        metrics.WAIT_TIMEOUTS.labels().inc()
 
         wait = self.waits.pop(id, None)
         if wait and not wait["future"].done():
@@ -40,10 +79,17 @@ class WaitFuture:
             del self.last_active[id]
 
     def add(self, id, args=None, timeout=5):
-        logger.info(f"[{id}] wait add {args} {timeout}")
+        logger.info("[%s] wait add %s %s", id, args, timeout)
 
         future = asyncio.Future()
-        self.last_active[id] = (time.monotonic(), timeout)
+        seq = next(self._seq)
+        deadline = time.monotonic() + timeout
+        self.last_active[id] = [deadline, timeout, seq]
+        heapq.heappush(self._deadlines, (deadline, seq, id))
+
+        # The new deadline is the earliest, the timer is sleeping too long
+        if self._deadlines[0][1] == seq:
+            self._wakeup.set()
 
         self.waits[id] = {
             "id": id,
@@ -55,29 +101,32 @@ class WaitFuture:
         return future
 
     def get(self, id, refresh=True):
-        logger.debug(f"[{id}] wait get")
+        logger.debug("[%s] wait get", id)
         if refresh:
             self.refresh(id)
         return self.waits.get(id)
 
     def refresh(self, id):
         """Reset the timer for the specified ID"""
-        if id not in self.waits:
-            logger.debug(f"[{id}] refresh failed, no id")
+        active = self.last_active.get(id)
+        if active is None:
+            logger.debug("[%s] refresh failed, no id", id)
             return
 
-        timeout = self.waits[id]["timeout"]
-        self.last_active[id] = (time.monotonic(), timeout)
-        logger.debug(f"[{id}] refresh timeouter ok")
+        # Deadlines only move later, the heap entry is fixed up when it reaches the top
+        active[0] = time.monotonic() + active[1]
+        logger.debug("[%s] refresh timeouter ok", id)
 
     def end(self, id, data=None, error=None):
         if isinstance(data, bytearray) or isinstance(data, str):
-            logger.info(f"[{id}] wait end {id} {error} {len(data)} {data[:32]}...")
+            logger.info(
+                "[%s] wait end %s %s %s %s...", id, id, error, len(data), data[:32]
+            )
         else:
-            logger.info(f"[{id}] wait end {id} {error} data)")
+            logger.info("[%s] wait end %s %s data)", id, id, error)
 
-        if id in self.last_active:
-            del self.last_active[id]
+        if self.last_active.pop(id, None) is not None:
+            self._compact()
 
         wait = self.waits.pop(id, None)
         if wait and not wait["future"].done():
@@ -88,3 +137,10 @@ class WaitFuture:
                     wait["future"].set_exception(Exception(error))
             else:
                 wait["future"].set_result(data)
+
+    def end_by_id_prefix(self, prefix, error):
+        """End all waiters whose ID starts with prefix, e.g. every operation of a device"""
+        matched_ids = [id for id in self.waits.keys() if id.startswith(prefix)]
+
+        for id in matched_ids:
+            self.end(id, error=error)